@@ -0,0 +1,381 @@
+"""
+Generator benchmark: parametric synthetic models and per-phase timing.
+Driven by sm-bench.py; results are plain JSON so runs can be compared
+between commits.
+"""
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+from .build import build_model, load_model, validate_model
+from .cache import write_if_changed
+from .common import write_dot
+from .model import ModelIndex
+from .plan import ModelPlans
+from .profiling import BuildProfile
+
+# Every synthetic model counts ticks in a 'step' context field, so guards
+# fire in a predictable pattern when the generated code is actually run.
+# Guards and context are target-language code, hence one dialect per backend.
+DIALECTS = {
+    'rust': {'step': "ctx.step", 'context': "pub step: u64,\n", 'context_init': "step: 0,\n"},
+    'c': {'step': "ctx->step", 'context': "unsigned long long step;\n", 'context_init': ""},
+}
+
+
+class _Guards:
+    def __init__(self, lang):
+        self.step = DIALECTS[lang]['step']
+
+    def every(self, period, phase=0):
+        return f"{self.step} % {period} == {phase % period}"
+
+def _model(lang, initial, states, **extra):
+    dialect = DIALECTS[lang]
+    model = {'context': dialect['context'], 'context_init': dialect['context_init'], 'initial': initial, 'states': states}
+    model.update(extra)
+    return model
+
+
+# --- MODEL FAMILIES ---
+
+def deep_chain(depth=50, lang='rust'):
+    """
+    Composites nested depth levels deep: n0/n1/.../n{depth-1}/{a,b}. Every
+    level also has a leaf x{i} that re-enters the next level down; odd
+    levels keep history. Transitions go sideways at the bottom, up to the
+    middle of the chain and back down.
+    """
+    g = _Guards(lang)
+    names = [f"n{i}" for i in range(depth)]
+    mid = "/" + "/".join(names[:depth // 2] + [f"x{depth // 2 - 1}" if depth > 1 else "a"])
+    node = {
+        'initial': 'a',
+        'states': {
+            'a': {'transitions': [{'guard': g.every(3), 'to': 'b'}]},
+            'b': {'transitions': [{'guard': g.every(5), 'to': mid}]},
+        },
+    }
+    # Built bottom-up, so arbitrary depths need no recursion.
+    for i in reversed(range(depth - 1)):
+        node = {
+            'initial': names[i + 1],
+            'history': i % 2 == 1,
+            'states': {
+                names[i + 1]: node,
+                f"x{i}": {'transitions': [{'guard': g.every(2), 'to': names[i + 1]}]},
+            },
+            'transitions': [{'guard': g.every(101, i), 'to': f"./x{i}"}],
+        }
+    return _model(lang, names[0], {names[0]: node})
+
+def wide_flat(width=1000, lang='rust'):
+    """One level of width leaves, each with a ring transition and a long jump."""
+    g = _Guards(lang)
+    states = {}
+    for i in range(width):
+        states[f"s{i}"] = {
+            'entry': '// entry',
+            'transitions': [
+                {'guard': g.every(17, 5), 'to': f"s{(i * 7 + 3) % width}"},
+                {'guard': g.every(3), 'to': f"s{(i + 1) % width}"},
+            ],
+        }
+    return _model(lang, 's0', states)
+
+def nested_orthogonal(depth=4, regions=3, lang='rust'):
+    """
+    Orthogonal states nested depth levels deep, each with regions
+    composite regions. Region r0 of every level holds the next level.
+    """
+    g = _Guards(lang)
+    inner = None
+    for level in reversed(range(depth)):
+        region_states = {}
+        for r in range(regions):
+            leaves = {
+                'a': {'transitions': [{'guard': g.every(4, r), 'to': 'b'}]},
+                'b': {'transitions': [{'guard': g.every(6, r + level), 'to': 'a'}]},
+            }
+            if r == 0 and inner is not None:
+                leaves['a']['transitions'].append({'guard': g.every(9, level), 'to': f"o{level + 1}"})
+                leaves[f"o{level + 1}"] = inner
+            region_states[f"r{r}"] = {'initial': 'a', 'states': leaves}
+        inner = {'orthogonal': True, 'states': region_states,
+                 'transitions': [{'guard': g.every(97, level), 'to': f"./r{regions - 1}/b"}]}
+    return _model(lang, 'idle', {
+        'idle': {'transitions': [{'guard': g.every(2), 'to': 'o0'}]},
+        'o0': inner,
+    })
+
+def decision_heavy(states=200, decisions=20, chain=4, lang='rust'):
+    """
+    Every state leaves through a decision; decisions chain into the next one
+    up to chain long, so guard trees nest.
+    """
+    g = _Guards(lang)
+    decision_table = {}
+    for d in range(decisions):
+        rules = [{'guard': g.every(7 + k, d), 'to': f"s{(d * 13 + k * 5) % states}"} for k in range(3)]
+        if (d + 1) % chain and d + 1 < decisions:
+            rules.append({'guard': True, 'to': f"d{d + 1}"})
+        decision_table[f"d{d}"] = rules
+    state_table = {
+        f"s{i}": {'transitions': [{'guard': g.every(2, i), 'to': f"d{i % decisions}"}]}
+        for i in range(states)
+    }
+    return _model(lang, 's0', state_table, decisions=decision_table)
+
+def cross_limb(regions=8, leaves=8, lang='rust'):
+    """One orthogonal state whose region leaves all transition into the other regions, plus forks."""
+    g = _Guards(lang)
+    region_states = {}
+    for r in range(regions):
+        leaf_states = {}
+        for l in range(leaves):
+            transitions = [{'guard': g.every(regions * leaves + 1, r * leaves + l), 'to': f"l{(l + 1) % leaves}"}]
+            for other in range(regions):
+                if other != r:
+                    transitions.append({'guard': g.every(211, other * 7 + l), 'to': f"/grid/r{other}/l{(l + other) % leaves}"})
+            leaf_states[f"l{l}"] = {'transitions': transitions}
+        region_states[f"r{r}"] = {'initial': 'l0', 'history': r % 2 == 1, 'states': leaf_states}
+    fork = ", ".join(f"r{r}/l{r % leaves}" for r in range(0, regions, 2))
+    return _model(lang, 'idle', {
+        'idle': {'transitions': [{'guard': g.every(2), 'to': 'grid'}]},
+        'grid': {'orthogonal': True, 'states': region_states,
+                 'transitions': [{'guard': g.every(1009), 'to': f"/grid/[{fork}]"},
+                                 {'guard': g.every(1013), 'to': "/idle"}]},
+    })
+
+
+FAMILIES = {
+    'deep_chain': (deep_chain, {'small': {'depth': 20}, 'medium': {'depth': 200}, 'large': {'depth': 800}}),
+    'wide_flat': (wide_flat, {'small': {'width': 200}, 'medium': {'width': 2000}, 'large': {'width': 20000}}),
+    'nested_orthogonal': (nested_orthogonal, {'small': {'depth': 3, 'regions': 3}, 'medium': {'depth': 6, 'regions': 4},
+                                              'large': {'depth': 10, 'regions': 6}}),
+    'decision_heavy': (decision_heavy, {'small': {'states': 100, 'decisions': 10, 'chain': 3},
+                                        'medium': {'states': 1000, 'decisions': 50, 'chain': 5},
+                                        'large': {'states': 5000, 'decisions': 200, 'chain': 8}}),
+    'cross_limb': (cross_limb, {'small': {'regions': 4, 'leaves': 6}, 'medium': {'regions': 10, 'leaves': 20},
+                                'large': {'regions': 20, 'leaves': 40}}),
+}
+
+def make_model(family, size='small', lang='rust', **overrides):
+    factory, presets = FAMILIES[family]
+    params = dict(presets[size])
+    params.update(overrides)
+    return factory(lang=lang, **params), params
+
+
+# --- PHASE TIMING ---
+
+def _time(fn, *args):
+    t0 = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - t0, result
+
+def _summary(samples):
+    return {'min': min(samples), 'median': statistics.median(samples), 'runs': len(samples)}
+
+def _quiet(msg):
+    pass
+
+def bench_model(model, langs=('c', 'rust'), repeat=3, workdir=None, profile_top=0):
+    """
+    Time every generator phase on one model, repeat times each.
+    Returns {'states', 'transitions', 'bytes': {...}, 'phases': {phase: {'min', 'median', 'runs'}}};
+    profile_top > 0 adds 'profile' from one extra profiled build (see BuildProfile.report()).
+    """
+    from .c_lang import CGenerator
+    from .rust_lang import RustGenerator
+
+    own_dir = workdir is None
+    workdir = workdir or tempfile.mkdtemp(prefix="sm-bench-")
+    yaml_path = os.path.join(workdir, "model.yaml")
+    with open(yaml_path, 'w') as f:
+        yaml.safe_dump(model, f, sort_keys=False)
+
+    samples = {}
+    outputs = {}
+
+    def sample(phase, fn, *args):
+        seconds, result = _time(fn, *args)
+        samples.setdefault(phase, []).append(seconds)
+        return result
+
+    def render(write, *args):
+        sink = io.StringIO()
+        write(sink, *args)
+        return sink.getvalue()
+
+    for _ in range(repeat):
+        data = sample('load', load_model, yaml_path)
+        index = sample('index', ModelIndex, data)
+        sample('validate', validate_model, data, index, _quiet)
+        decisions = data.get('decisions', {})
+        plans = sample('plan', ModelPlans, index, decisions)
+        outputs['statemachine.dot'] = sample('dot', render, write_dot, data, decisions, index, plans)
+        if 'c' in langs:
+            header, source = sample('codegen_c', CGenerator(data, index, plans).generate)
+            outputs['statemachine.h'], outputs['statemachine.c'] = header, source
+        if 'rust' in langs:
+            outputs['statemachine.rs'] = sample('codegen_rust', RustGenerator(data, index, plans).generate)[0]
+        for name, content in outputs.items():
+            path = os.path.join(workdir, name)
+            if os.path.exists(path):
+                os.remove(path)
+            sample('write', write_if_changed, path, content)
+
+    profile = None
+    if profile_top:
+        profile = BuildProfile(profile_top)
+        build_model(yaml_path, langs, workdir, log=_quiet, profile=profile)
+
+    if own_dir:
+        for name in os.listdir(workdir):
+            os.remove(os.path.join(workdir, name))
+        os.rmdir(workdir)
+
+    # 'write' covers every output file of one repetition.
+    per_run = len(outputs)
+    writes = samples.pop('write')
+    samples['write'] = [sum(writes[i:i + per_run]) for i in range(0, len(writes), per_run)]
+    result = {
+        'states': len(index),
+        'transitions': len(plans.all),
+        'bytes': {name: len(content) for name, content in outputs.items()},
+        'phases': {phase: _summary(values) for phase, values in samples.items()},
+    }
+    if profile:
+        result['profile'] = profile.report()
+    return result
+
+def run_benchmarks(families, size='small', langs=('c', 'rust'), repeat=3, log=print, profile_top=0):
+    results = []
+    for family in families:
+        model, params = make_model(family, size)
+        log(f"{family} {params} ...")
+        entry = {'family': family, 'size': size, 'params': params}
+        try:
+            entry.update(bench_model(model, langs, repeat, profile_top=profile_top))
+        except Exception as e:
+            entry['error'] = f"{type(e).__name__}: {e}"
+        results.append(entry)
+    return {'meta': environment_info(), 'results': results}
+
+# --- STRESS ---
+
+# Builds every stress model goes through: (runtime, build_model options), per language.
+STRESS_BUILDS = {
+    'c': (('pointer', {}), ('pointer', {'compact': 'layout'}), ('pointer', {'instrument': 'counts'}),
+          ('pointer', {'compiled': True}), ('table', {})),
+    'rust': (('pointer', {}), ('pointer', {'compact': 'ticks'}), ('pointer', {'instrument': 'counts'}),
+             ('pointer', {'compiled': True}), ('table', {}), ('flat', {})),
+}
+
+def stress_models(lang='rust'):
+    """deep_chain nested past the Python recursion limit and a wide_flat as wide, as (family, model, params)."""
+    size = sys.getrecursionlimit() + 100
+    return [(family,) + make_model(family, lang=lang, **{key: size})
+            for family, key in (('deep_chain', 'depth'), ('wide_flat', 'width'))]
+
+def run_stress(langs=('c', 'rust'), log=print):
+    """
+    Build the stress models with every runtime and option of STRESS_BUILDS:
+    load, validate, DOT and code generation, as sm-builder.py runs them.
+    Any of them hitting the recursion limit shows up as an error entry.
+    """
+    results = []
+    for lang in langs:
+        for family, model, params in stress_models(lang):
+            workdir = tempfile.mkdtemp(prefix="sm-stress-")
+            yaml_path = os.path.join(workdir, "model.yaml")
+            _dump_deep(model, yaml_path)
+            for runtime, options in STRESS_BUILDS[lang]:
+                if runtime == 'flat' and family == 'deep_chain':
+                    # Each configuration of a deep chain holds the whole chain: the flat code
+                    # grows with depth squared, recursion is not what limits it.
+                    continue
+                log(f"{family} {params} [{lang}/{runtime}] {options or ''} ...")
+                entry = {'family': family, 'params': params, 'lang': lang, 'runtime': runtime, 'options': options}
+                try:
+                    # A compiled build runs twice: once writing the artifact, once loading it.
+                    for _ in range(2 if options.get('compiled') else 1):
+                        t0 = time.perf_counter()
+                        build_model(yaml_path, [lang], workdir, log=_quiet, runtime=runtime, **options)
+                    entry['seconds'] = time.perf_counter() - t0
+                except Exception as e:
+                    entry['error'] = f"{type(e).__name__}: {e}"
+                results.append(entry)
+            shutil.rmtree(workdir)
+    return {'meta': environment_info(), 'results': results}
+
+def _dump_deep(model, path):
+    # PyYAML's dumper recurses per nesting level; only writing the fixture gets a higher limit.
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(limit * 20)
+    try:
+        with open(path, 'w') as f:
+            yaml.safe_dump(model, f, sort_keys=False)
+    finally:
+        sys.setrecursionlimit(limit)
+
+def format_stress(report):
+    lines = []
+    for entry in report['results']:
+        options = " ".join(f"{k}={v}" for k, v in entry['options'].items())
+        head = f"{entry['family']} {entry['params']} [{entry['lang']}/{entry['runtime']}{' ' + options if options else ''}]"
+        lines.append(f"{head}: ERROR {entry['error']}" if 'error' in entry else f"{head}: ok, {entry['seconds']:.2f}s")
+    return "\n".join(lines)
+
+def environment_info():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ""
+    return {'commit': commit, 'python': platform.python_version(), 'platform': platform.platform(),
+            'yaml_libyaml': bool(getattr(yaml, '__with_libyaml__', False)), 'timestamp': time.time()}
+
+
+# --- REPORTING ---
+
+def _key(entry):
+    return (entry['family'], entry['size'])
+
+def format_results(report, baseline=None):
+    base = {_key(e): e for e in (baseline or {}).get('results', [])}
+    lines = []
+    for entry in report['results']:
+        head = f"{entry['family']} [{entry['size']}]"
+        if 'error' in entry:
+            lines.append(f"{head}: ERROR {entry['error']}")
+            continue
+        lines.append(f"{head}: {entry['states']} states, {entry['transitions']} transitions")
+        old = base.get(_key(entry), {}).get('phases', {})
+        for phase, stats in entry['phases'].items():
+            line = f"    {phase:14} {stats['min'] * 1000:10.2f} ms"
+            if phase in old and old[phase]['min'] > 0:
+                line += f"   x{stats['min'] / old[phase]['min']:.2f} vs baseline"
+            lines.append(line)
+        for backend, states in entry.get('profile', {}).get('slowest_states', {}).items():
+            lines.append(f"    slowest {backend} states: " +
+                         ", ".join(f"{s['state']} {s['seconds'] * 1000:.2f}ms" for s in states))
+    return "\n".join(lines)
+
+def save_results(report, path):
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+
+def load_results(path):
+    with open(path, 'r') as f:
+        return json.load(f)
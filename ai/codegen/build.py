@@ -0,0 +1,327 @@
+import contextlib
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+import yaml
+
+from .common import (write_dot, resolve_target_path, parse_fork_target, microstep_limit, trace_buffer_size,
+                     state_path, EVENT_NAME)
+from .model import ModelIndex
+from .plan import ModelPlans, decision_cycle, decision_feedback
+from .cache import OutputFile
+from .compiled import load_compiled, save_compiled
+from .instrument import MODES as INSTRUMENT_MODES, Heatmap, ProfileError, load_profile, format_profile
+from .layout import MODES as COMPACT_MODES
+from .machines import expand_machines, machine_errors, Instances
+
+LANGUAGES = ('c', 'rust')
+# pointer: one function per state linked through function pointers.
+# table: static state/transition tables run by a generic interpreter.
+# flat: (Rust) one enum variant per reachable configuration, matched per tick.
+RUNTIMES = ('pointer', 'table', 'flat')
+
+# libyaml's loader when PyYAML was built with it; the pure-Python one is several times slower.
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+class BuildError(Exception):
+    def __init__(self, message, details=()):
+        super().__init__(message)
+        self.details = list(details)
+
+def _is_duration(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and value >= 0
+
+def validate_model(data, index=None, log=print):
+    log("Validating model...")
+    errors = []
+    if index is None:
+        index = ModelIndex(data)
+    
+    def check_state(name_path, state_data):
+        display_name = "/" + "/".join(name_path[1:])
+        
+        if 'states' in state_data:
+            # CHANGED: Check 'orthogonal' instead of 'parallel'
+            if 'initial' not in state_data and not state_data.get('orthogonal', False):
+                errors.append(f"State '{display_name}' is composite but missing 'initial' property.")
+            elif 'initial' in state_data:
+                init = state_data['initial']
+                if init not in state_data['states']:
+                    errors.append(f"State '{display_name}' defines initial='{init}', but that child does not exist.")
+
+        transitions = state_data.get('transitions', [])
+        for i, t in enumerate(transitions):
+            if 'event' in t and not (isinstance(t['event'], str) and EVENT_NAME.match(t['event'])):
+                errors.append(f"State '{display_name}', transition #{i+1}: Event '{t['event']}' is not a valid identifier.")
+            if 'after' in t and not _is_duration(t['after']):
+                errors.append(f"State '{display_name}', transition #{i+1}: 'after' must be a non-negative number of seconds, got '{t['after']}'.")
+            if 'to' not in t:
+                errors.append(f"State '{display_name}', transition #{i+1}: Missing 'to'.")
+                continue
+            
+            raw_target = t['to']
+            
+            if raw_target is None or raw_target == "null":
+                continue
+
+            if raw_target in data.get('decisions', {}):
+                continue
+
+            base_target, forks = parse_fork_target(raw_target)
+            
+            target_path = resolve_target_path(name_path, base_target)
+            target_obj = index.data(target_path)
+            
+            if target_obj is None:
+                errors.append(f"State '{display_name}', transition #{i+1}: Target '{base_target}' (resolved: {'/'.join(target_path)}) does not exist.")
+                continue 
+
+            if forks:
+                if 'states' not in target_obj:
+                    errors.append(f"State '{display_name}': Fork target '{base_target}' is not a composite state.")
+                else:
+                    for fork in forks:
+                        fork_parts = fork.split('/')
+                        fork_abs_path = target_path + fork_parts
+                        fork_obj = index.data(fork_abs_path)
+                        if fork_obj is None:
+                            errors.append(f"State '{display_name}': Fork branch '{fork}' does not exist inside '{base_target}'.")
+
+    for name, rules in data.get('decisions', {}).items():
+        if any('event' in rule for rule in rules):
+            errors.append(f"Decision '{name}': events belong on the transition that uses the decision, not on its rules.")
+        for i, rule in enumerate(rules):
+            if 'after' in rule and not _is_duration(rule['after']):
+                errors.append(f"Decision '{name}', rule #{i+1}: 'after' must be a non-negative number of seconds, got '{rule['after']}'.")
+    cycle = decision_cycle(data.get('decisions', {}))
+    if cycle:
+        errors.append(f"Decisions {' -> '.join(cycle + cycle[:1])} lead into each other in a cycle.")
+    else:
+        for name, i, fields in decision_feedback(data.get('decisions', {})):
+            changed = ", ".join(field if field == 'ctx' else f"ctx.{field}" for field in fields)
+            errors.append(f"Decision '{name}', rule #{i+1}: its action may change {changed}, which a guard further "
+                          f"down the chain reads; decisions evaluate their guards before any action runs. "
+                          f"Move the action to the rules that end the chain.")
+    queue = data.get('event_queue')
+    if queue is not None and not (isinstance(queue, int) and not isinstance(queue, bool) and queue > 0):
+        errors.append(f"'event_queue' must be a positive integer, got '{queue}'.")
+    trace = data.get('trace_buffer')
+    if trace is not None and not (isinstance(trace, int) and not isinstance(trace, bool) and trace > 0):
+        errors.append(f"'trace_buffer' must be a positive integer, got '{trace}'.")
+    rtc = data.get('run_to_completion')
+    if rtc is not None and not (isinstance(rtc, bool) or (isinstance(rtc, int) and rtc > 0)):
+        errors.append(f"'run_to_completion' must be true, false or a positive number of microsteps, got '{rtc}'.")
+
+    errors.extend(machine_errors(data, index))
+
+    if 'initial' not in data:
+        errors.append("Root model missing 'initial' state.")
+    else:
+        if data['initial'] not in data['states']:
+             errors.append(f"Root initial state '{data['initial']}' does not exist.")
+    
+    for info in index:
+        check_state(list(info.path), info.data)
+
+    if errors:
+        log("\n!!! VALIDATION ERRORS !!!")
+        for e in errors:
+            log(f"- {e}")
+        log("-------------------------")
+        raise BuildError(f"{len(errors)} validation error(s)", errors)
+    log("Model OK.")
+
+def _quiet(msg):
+    pass
+
+def load_model(path):
+    if not os.path.exists(path):
+        raise BuildError(f"File '{path}' not found.")
+    try:
+        with open(path, 'r') as f:
+            return expand_machines(yaml.load(f, Loader=YamlLoader))
+    except yaml.YAMLError as e:
+        raise BuildError(f"YAML Syntax Error: {e}")
+
+def generator_class(lang, runtime='pointer'):
+    if lang == 'c':
+        if runtime == 'flat':
+            raise BuildError("The flat runtime is only available for Rust.")
+        if runtime == 'table':
+            from .c_table import CTableGenerator
+            return CTableGenerator
+        from .c_lang import CGenerator
+        return CGenerator
+    if lang == 'rust':
+        if runtime == 'table':
+            from .rust_table import RustTableGenerator
+            return RustTableGenerator
+        if runtime == 'flat':
+            from .rust_flat import RustFlatGenerator
+            return RustFlatGenerator
+        from .rust_lang import RustGenerator
+        return RustGenerator
+    raise BuildError(f"Unknown language '{lang}'.")
+
+def build_model(path, langs, out_dir=".", prefix="statemachine", log=print, profile=None,
+                compiled=False, runtime='pointer', instrument=None, heatmap=None,
+                compact=None):
+    """
+    Load, validate and generate one model for every language in langs.
+    Outputs are streamed to disk as they are generated. With compiled, the
+    validated model is reused from / saved to <file>.smc next to the YAML.
+    runtime selects the generated code's shape (see RUNTIMES).
+    instrument ('counts' or 'timing') adds profiling counters to the generated
+    code; heatmap is a profile they exported, drawn into the DOT output.
+    compact ('layout' or 'ticks') shrinks the pointer runtime's Context (layout.py).
+    Returns {'outputs': {file: written?}, 'timings': {phase: seconds}}, plus
+    'profile' (BuildProfile.report()) when a profile is given.
+    """
+    if runtime not in RUNTIMES:
+        raise BuildError(f"Unknown runtime '{runtime}'.")
+    if instrument is not None and instrument not in INSTRUMENT_MODES:
+        raise BuildError(f"Unknown instrumentation '{instrument}'.")
+    if compact is not None:
+        if compact not in COMPACT_MODES:
+            raise BuildError(f"Unknown compact layout '{compact}'.")
+        if runtime != 'pointer':
+            raise BuildError("--compact applies to the pointer runtime; the table and flat runtimes already keep state ids.")
+        if compact == 'ticks' and instrument:
+            raise BuildError("--compact ticks cannot be combined with --instrument, which accumulates time in seconds.")
+    timings = {}
+    outputs = {}
+
+    def phase(name, fn, *args):
+        t0 = time.perf_counter()
+        with profile.phase(name) if profile else contextlib.nullcontext():
+            result = fn(*args)
+        timings[name] = timings.get(name, 0.0) + time.perf_counter() - t0
+        return result
+
+    def emit(filenames, phase_name, write, *args):
+        # Stream straight into the output files; unchanged files are left untouched.
+        targets = [os.path.normpath(os.path.join(out_dir, name)) for name in filenames]
+        files = [OutputFile(target) for target in targets]
+        with contextlib.ExitStack() as stack:
+            sinks = [stack.enter_context(f) for f in files]
+            phase(phase_name, write, *sinks, *args)
+            # Closing compares each temp file with the old output and renames it into place.
+            phase('write', stack.close)
+        for target, f in zip(targets, files):
+            outputs[target] = f.written
+            log(f" -> {target} {'created' if f.written else 'unchanged'}.")
+
+    loaded = phase('load', load_compiled, path) if compiled and os.path.exists(path) else None
+    if loaded:
+        data, index = loaded
+        log("Using compiled model (YAML unchanged).")
+    else:
+        data = phase('load', load_model, path)
+        index = phase('index', ModelIndex, data)
+        phase('validate', validate_model, data, index, log)
+        if compiled and not phase('compile', save_compiled, path, index):
+            log("Model cannot be stored as a compiled artifact; skipped.")
+
+    decisions = data.get('decisions', {})
+    plans = phase('plan', ModelPlans, index, decisions, compact == 'ticks')
+    if compact == 'ticks':
+        if trace_buffer_size(data):
+            raise BuildError("--compact ticks cannot be combined with trace_buffer, whose records hold f64 time.")
+        fractional = [f"{plan.src_str} -> {plan.dst_str}: after {plan.transition['after']}" for plan in plans.all
+                      if plan.transition.get('after') is not None and plan.transition['after'] != int(plan.transition['after'])]
+        if fractional:
+            raise BuildError(f"--compact ticks counts time in whole ticks; 'after' must be an integer ({'; '.join(fractional)}).")
+    if microstep_limit(data):
+        cycle = plans.completion_cycle()
+        if cycle:
+            states = " -> ".join(state_path(index.states[i]) for i in cycle + cycle[:1])
+            raise BuildError(f"run_to_completion: the transitions {states} always fire, the machine would never settle.")
+    if runtime == 'pointer' and plans.outline_report():
+        log(plans.outline_report())
+    machines = Instances(index) if runtime == 'pointer' else None
+    if machines and (compact or instrument or trace_buffer_size(data)):
+        log("Machine instances are expanded: --compact, --instrument and trace_buffer keep per-state code.")
+    elif machines:
+        log(machines.report())
+    os.makedirs(out_dir, exist_ok=True)
+
+    heat = None
+    if heatmap:
+        try:
+            heat = Heatmap(phase('load', load_profile, heatmap, index, plans))
+        except (ProfileError, OSError) as e:
+            raise BuildError(f"Cannot read profile '{heatmap}': {e}")
+        log(format_profile(heat.profile, index, plans))
+
+    log("Generating Graphviz DOT...")
+    emit([f"{prefix}.dot"], 'dot', write_dot, data, decisions, index, plans, heat)
+
+    for lang in langs:
+        options = {'instrument': instrument} if instrument else {}
+        if compact:
+            options['compact'] = compact
+        if lang == 'c':
+            log("Generating C code...")
+            gen = generator_class(lang, runtime)(data, index, plans, profile, **options)
+            emit([f"{prefix}.h", f"{prefix}.c"], 'codegen_c', gen.write, f"{prefix}.h")
+        elif lang == 'rust':
+            log("Generating Rust code...")
+            gen = generator_class(lang, runtime)(data, index, plans, profile, **options)
+            emit([f"{prefix}.rs"], 'codegen_rust', gen.write)
+        else:
+            raise BuildError(f"Unknown language '{lang}'.")
+        if compact:
+            log(gen.layout.report(plans.events))
+
+    result = {'outputs': outputs, 'timings': timings}
+    if profile:
+        result['profile'] = profile.report()
+    return result
+
+def expand_job_template(template, path):
+    """'{stem}' in an --out-dir / --prefix template becomes the YAML file name without extension."""
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return template.format(stem=stem)
+
+def run_job(job):
+    """Process pool entry point: one YAML file, all its languages. Never raises."""
+    t0 = time.perf_counter()
+    result = {'file': job['file'], 'langs': job['langs'], 'out_dir': job['out_dir'], 'prefix': job['prefix']}
+    try:
+        result.update(build_model(job['file'], job['langs'], job['out_dir'], job['prefix'],
+                                  log=_quiet, compiled=job.get('compiled', False),
+                                  runtime=job.get('runtime', 'pointer'),
+                                  instrument=job.get('instrument'), heatmap=job.get('heatmap'),
+                                  compact=job.get('compact')))
+        result['status'] = 'ok'
+    except BuildError as e:
+        result['status'] = 'failed'
+        result['error'] = "\n".join([str(e)] + [f"- {d}" for d in e.details])
+    except Exception as e:
+        result['status'] = 'error'
+        result['error'] = f"{e}\n{traceback.format_exc()}"
+    result['seconds'] = time.perf_counter() - t0
+    return result
+
+def run_batch(jobs, workers=None):
+    """Fan jobs out over a process pool. Results come back in job order."""
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(run_job, jobs))
+
+def format_batch_report(results, wall_seconds):
+    lines = [f"{'STATUS':8} {'TIME':>9}  {'FILE':30} OUTPUT"]
+    for r in results:
+        where = os.path.join(r['out_dir'], r['prefix'])
+        lines.append(f"{r['status'].upper():8} {r['seconds']*1000:7.1f}ms  {r['file']:30} {where}.* ({','.join(r['langs'])})")
+        if 'error' in r:
+            lines.extend(f"         {line}" for line in r['error'].strip().splitlines())
+        else:
+            changed = sum(1 for written in r['outputs'].values() if written)
+            phases = ", ".join(f"{k} {v*1000:.1f}ms" for k, v in r['timings'].items())
+            lines.append(f"         {changed}/{len(r['outputs'])} files written; {phases}")
+    failed = sum(1 for r in results if r['status'] != 'ok')
+    lines.append(f"{len(results)} job(s), {failed} failed, {wall_seconds:.2f}s wall time.")
+    return "\n".join(lines)
@@ -1,24 +1,42 @@
-from .common import flatten_name, resolve_target_path, get_exit_sequence
+from .common import (flatten_name, walk_nested, event_queue_size, trace_buffer_size, microstep_limit, state_path,
+                     referenced_vars, preamble, decision_params, TRACE_LEVELS)
+from .model import ModelIndex
+from .trace import model_id, record_args
+from .instrument import profile_buckets, user_slot
+from .plan import ModelPlans, describe_steps
+from .layout import ContextLayout
+from .machines import Instances
+from .stream import Spool, write_template
+import io
+import time
 
 HEADER = """
 #ifndef STATEMACHINE_H
 #define STATEMACHINE_H
 #include <stdio.h>
 #include <stdbool.h>
+#include <stdint.h>
 #include <string.h>
 
+// Hooks above this level are compiled out; -DSM_TRACE_LEVEL=0 drops them all.
+#ifndef SM_TRACE_LEVEL
+#define SM_TRACE_LEVEL 3
+#endif
+
 #define TOTAL_STATES %d
+%s%s
 
 typedef struct SM_Context SM_Context;
-typedef void (*StateFunc)(SM_Context* ctx);
+typedef void (*StateFunc)(SM_Context* ctx);%s
 
 // --- Forward Declarations ---
 %s
 
 struct SM_Context {
-    void* owner;
-    double now; 
-    double state_timers[TOTAL_STATES];
+    void* owner;%s
+    bool transition_fired;
+    bool terminated;
+    uint64_t active_states[ACTIVE_WORDS];%s
 
     // User Context Variables
     %s
@@ -34,7 +52,13 @@ typedef struct {
 
 void sm_init(StateMachine* sm);
 void sm_tick(StateMachine* sm);
+bool sm_is_running(StateMachine* sm);
 void sm_get_state_str(StateMachine* sm, char* buffer, size_t max_len);
+bool sm_in_state(const SM_Context* ctx, int id);
+bool sm_in_substate_of(const SM_Context* ctx, int id);
+bool sm_next_deadline(const SM_Context* ctx, %s* deadline);
+int sm_active_ids(const SM_Context* ctx, uint32_t ids[SM_MAX_ACTIVE]);
+size_t sm_write_active_paths(const uint32_t* ids, int n, char* buf, size_t max);%s
 
 // --- Macros ---
 #define IN_STATE(statename) IN_STATE_##statename
@@ -44,128 +68,184 @@ void sm_get_state_str(StateMachine* sm, char* buffer, size_t max_len);
 """
 
 SOURCE_TOP = """
-#include "statemachine.h"
+#include "%s"
 
 // --- User Includes ---
 %s
 
 // --- Helpers ---
-static void safe_strcat(char* dest, const char* src, size_t* offset, size_t max) {
-    size_t len = strlen(src);
+// Append len bytes of src (and its terminator) unless that would overflow max.
+static void safe_append(char* dest, const char* src, size_t len, size_t* offset, size_t max) {
     if (*offset + len >= max) return;
-    strcpy(dest + *offset, src);
+    memcpy(dest + *offset, src, len + 1);
     *offset += len;
 }
+#define SM_APPEND(dest, literal, offset, max) safe_append(dest, literal, sizeof(literal) - 1, offset, max)
 
+%s
 // --- State Logic ---
 """
 
-FUNC_PREAMBLE = """
-    (void)ctx;
-    const char* state_name = "{short_name}";
-    const char* state_full_name = "{display_name}";
-    (void)state_name; (void)state_full_name;
-    double time = ctx->now - ctx->state_timers[{state_id}];
-    (void)time; 
-"""
+# Variables user code may use; a function declares only those its code mentions.
+PREAMBLE_LINES = (
+    (None, '(void)ctx;'),
+    ('state_name', 'const char* state_name = "{short_name}"; (void)state_name;'),
+    ('state_full_name', 'const char* state_full_name = "{display_name}"; (void)state_full_name;'),
+    ('time', 'double time = ctx->now - ctx->state_timers[{state_id}]; (void)time;'),
+)
 
 LEAF_TEMPLATE = """
-void state_{c_name}_start(SM_Context* ctx) {{
-    ctx->state_timers[{state_id}] = ctx->now;
-    {preamble}
+void state_{c_name}_start(SM_Context* ctx{params}) {{
+    {start_timer}
+    {entry_preamble}
     {hook_entry}
-    ctx->{parent_ptr} = state_{c_name}_run;
+    {entry}
+    {set_parent}
 }}
 
-void state_{c_name}_entry(SM_Context* ctx) {{
-    state_{c_name}_start(ctx);
+void state_{c_name}_entry(SM_Context* ctx{params}) {{
+    state_{c_name}_start(ctx{args});
+}}
+
+void state_{c_name}_exit(SM_Context* ctx{params}) {{
+    {exit_preamble}
+    {hook_exit}
+    {exit}
+    {clear_parent}
+}}
+
+void state_{c_name}_run(SM_Context* ctx{params}) {{
+    {do_preamble}
+    {hook_run}
+    {transitions}
+    {run}
 }}
-...
 """
 
 COMPOSITE_OR_TEMPLATE = """
-void state_{c_name}_start(SM_Context* ctx) {{
-    ctx->state_timers[{state_id}] = ctx->now;
-    {preamble}
+void state_{c_name}_start(SM_Context* ctx{params}) {{
+    {start_timer}
+    {entry_preamble}
     {hook_entry}
+    {entry}
     {set_parent}
 }}
 
-void state_{c_name}_entry(SM_Context* ctx) {{
-    state_{c_name}_start(ctx);
-    if (({history}) && ctx->{self_hist_ptr} != NULL) {{
-        ctx->{self_hist_ptr}(ctx);
-    }} else {{
-        state_{initial_target}_entry(ctx);
-    }}
+void state_{c_name}_entry(SM_Context* ctx{params}) {{
+    state_{c_name}_start(ctx{args});
+    {enter_child}
+}}
+
+void state_{c_name}_exit(SM_Context* ctx{params}) {{
+    {exit_preamble}
+    // RECURSIVE EXIT: Kill active child first
+    {exit_child}
+
+    {hook_exit}
+    {exit}
+    {clear_parent}
+}}
+
+void state_{c_name}_run(SM_Context* ctx{params}) {{
+    {do_preamble}
+    {hook_run}
+    {transitions}
+    {run}
+
+    // Tick active child
+    {run_child}
 }}
-...
 """
 
 COMPOSITE_AND_TEMPLATE = """
-void state_{c_name}_start(SM_Context* ctx) {{
-    ctx->state_timers[{state_id}] = ctx->now;
-    {preamble}
+void state_{c_name}_start(SM_Context* ctx{params}) {{
+    {start_timer}
+    {entry_preamble}
     {hook_entry}
-    {history_save}
+    {entry}
     {set_parent}
 }}
 
-void state_{c_name}_entry(SM_Context* ctx) {{
-    state_{c_name}_start(ctx);
+void state_{c_name}_entry(SM_Context* ctx{params}) {{
+    state_{c_name}_start(ctx{args});
     // Parallel Entry: Start all regions
-    {parallel_entries}
+{parallel_entries}
 }}
 
-void state_{c_name}_exit(SM_Context* ctx) {{
-    {preamble}
-    {hook_exit}
+void state_{c_name}_exit(SM_Context* ctx{params}) {{
+    {exit_preamble}
     // Parallel Exit: Force exit all active regions
-    {parallel_exits}
+{parallel_exits}
+    {hook_exit}
     {exit}
+    {clear_parent}
 }}
 
-void state_{c_name}_run(SM_Context* ctx) {{
-    {preamble}
+void state_{c_name}_run(SM_Context* ctx{params}) {{
+    {do_preamble}
     {hook_run}
+    {transitions}
     {run}
+
+    // Safety: Stop if we are exited OR if any transition fired globally
+    {safety_check}
+
     // Parallel Run: Tick all regions
-    {parallel_ticks}
-    {transitions}
+{parallel_ticks}
 }}
 """
 
-class CGenerator:
-    def __init__(self, data):
-        self.data = data
-        self.state_counter = 0
-        self.outputs = {'context_ptrs': [], 'functions': [], 'forwards': [], 'macros': []}
-        self.inspect_list = []
-        self.decisions = data.get('decisions', {})
-        self.hooks = data.get('hooks', {})
-        self.includes = data.get('includes', '')
+# Time fields of the pointer SM_Context.
+TIME_FIELDS = """
+    double now; 
+    double state_timers[TOTAL_STATES];"""
 
-    def generate(self):
-        root_data = {
-            'initial': self.data['initial'], 'states': self.data['states'],
-            'history': False, 'entry': "// Root Entry", 'run': "// Root Run", 'exit': "// Root Exit"
-        }
-        
-        self.recurse(['root'], root_data, None)
-        self.gen_inspector(['root'], root_data, 'root')
+# How an OR composite reaches its active child: function pointers by default.
+ENTER_CHILD = """if (({history}) && ctx->{hist} != NULL) {{
+        ctx->{hist}(ctx);
+    }} else {{
+        state_{initial}_entry(ctx);
+    }}"""
 
-        header = HEADER % (
-            self.state_counter,
-            "\n".join(self.outputs['forwards']),
-            self.data.get('context', ''),
-            "\n    ".join(self.outputs['context_ptrs']),
-            "\n".join(self.outputs['macros'])
-        )
+EXIT_CHILD = "if (ctx->{exit_ptr}) ctx->{exit_ptr}(ctx);"
 
-        source = SOURCE_TOP % (self.includes) + "\n".join(self.outputs['functions'])
-        source += "\n// --- Inspection ---\n" + "\n".join(self.inspect_list)
-        
-        source += """
+RUN_CHILD = "if (ctx->{ptr}) ctx->{ptr}(ctx);"
+
+# --compact: child numbers instead of function pointers, timers only where time is read (layout.py).
+COMPACT_HEADER = """
+// --- Compact Context ---
+typedef %s SM_Time;
+// States whose code reads `time` keep a timer
+#define SM_TIMERS %d
+#define SM_CONTEXT_SIZE sizeof(SM_Context)
+"""
+
+COMPACT_TIME_FIELDS = """
+    SM_Time now;
+    SM_Time state_timers[%d];"""
+
+# Functions shared by the instances of a machine: the id is an expression of the instance number.
+SHARED_PREAMBLE_LINES = (
+    (None, '(void)ctx; (void)inst;'),
+    PREAMBLE_LINES[1],
+    ('state_full_name', 'const char* state_full_name = SM_STATE_PATHS[{state_id}]; (void)state_full_name;'),
+    PREAMBLE_LINES[3],
+)
+
+COMPACT_PREAMBLE_LINES = PREAMBLE_LINES[:3] + (
+    ('time', 'SM_Time time = ctx->now - ctx->state_timers[{timer}]; (void)time;'),
+)
+
+COMPACT_CHILD_TEMPLATE = """
+void state_{c_name}_child_{op}(SM_Context* ctx{params}) {{
+    switch (ctx->{field}_{c_name}{slot}) {{
+{arms}
+    default: {default}
+    }}
+}}
+"""
+
+SOURCE_RUNTIME = """
 void sm_init(StateMachine* sm) {
     memset(&sm->ctx, 0, sizeof(sm->ctx));
     sm->ctx.owner = sm;
@@ -173,167 +253,1095 @@ void sm_init(StateMachine* sm) {
     sm->root = state_root_run; 
 }
 void sm_tick(StateMachine* sm) {
-    if (sm->root) sm->root(&sm->ctx);
+    sm->ctx.transition_fired = false;%s%s
+}
+bool sm_is_running(StateMachine* sm) {
+    return sm->root != NULL;
 }
 void sm_get_state_str(StateMachine* sm, char* buffer, size_t max_len) {
     size_t offset = 0;
     buffer[0] = '\\0';
     if (sm->root) inspect_root(&sm->ctx, buffer, &offset, max_len);
+    else SM_APPEND(buffer, "FINISHED", &offset, max_len);
+}%s
+"""
+
+# Events, shared by the C runtimes. Only emitted when a transition has an 'event:'.
+EVENT_HEADER = """
+// --- Events ---
+typedef enum {
+%s
+} SM_Event;
+
+#define SM_EVENT_QUEUE_SIZE %d
+"""
+
+EVENT_FIELDS = """
+
+    // Queued events (ring buffer), dispatched at the start of the next tick
+    SM_Event events[SM_EVENT_QUEUE_SIZE];
+    unsigned event_head;
+    unsigned event_count;"""
+
+EVENT_DECLS = """
+void sm_dispatch(StateMachine* sm, SM_Event event);
+bool sm_post_event(SM_Context* ctx, SM_Event event);"""
+
+EVENT_DRAIN = """
+    {
+        // Events queued before this tick, in order; events they post wait for the next one.
+        unsigned n = sm->ctx.event_count;
+        while (n--) {
+            SM_Event event = sm->ctx.events[sm->ctx.event_head];
+            sm->ctx.event_head = (sm->ctx.event_head + 1) % SM_EVENT_QUEUE_SIZE;
+            sm->ctx.event_count--;
+            sm_dispatch(sm, event);
+        }
+        sm->ctx.transition_fired = false;
+    }"""
+
+EVENT_POST = """
+// Queue an event for the next tick; false if the queue is full.
+bool sm_post_event(SM_Context* ctx, SM_Event event) {
+    if (ctx->event_count == SM_EVENT_QUEUE_SIZE) return false;
+    ctx->events[(ctx->event_head + ctx->event_count) % SM_EVENT_QUEUE_SIZE] = event;
+    ctx->event_count++;
+    return true;
+}
+"""
+
+def event_header(events, queue_size):
+    return EVENT_HEADER % (",\n".join(f"    SM_EVENT_{event}" for event in events), queue_size)
+
+POINTER_EVENT_TYPES = """
+typedef void (*EventFunc)(SM_Context* ctx, SM_Event event);"""
+
+POINTER_DISPATCH = """
+// Run the transitions listening to event on the active states, now.
+void sm_dispatch(StateMachine* sm, SM_Event event) {
+    if (!sm->root) return;
+    sm->ctx.transition_fired = false;
+    state_root_event(&sm->ctx, event);
+    if (sm->ctx.terminated) sm->root = NULL;
+}
+"""
+
+EVENT_TEMPLATE = """
+void state_{c_name}_event(SM_Context* ctx, SM_Event event{params}) {{
+    {preamble}
+    switch (event) {{
+{arms}
+    default: break;
+    }}
+    {children}
+}}
+"""
+
+# Active-state bitset shared by the pointer and table runtimes.
+ACTIVE_SET_HEADER = """#define ACTIVE_WORDS ((TOTAL_STATES + 63) / 64)
+
+// --- State Ids ---
+%s
+
+// One bit per active state id
+#define SM_IN_STATE(ctx, id) ((((ctx)->active_states[(id) >> 6]) >> ((id) & 63)) & 1u)
+
+// Most states active at once: the length of an sm_active_ids snapshot
+#define SM_MAX_ACTIVE %d
+
+extern const char* const SM_STATE_PATHS[TOTAL_STATES];
+"""
+
+ACTIVE_SET_SOURCE = """
+// --- Active States ---
+#define SM_SET_ACTIVE(ctx, id) ((ctx)->active_states[(id) >> 6] |= (uint64_t)1 << ((id) & 63))
+#define SM_CLEAR_ACTIVE(ctx, id) ((ctx)->active_states[(id) >> 6] &= ~((uint64_t)1 << ((id) & 63)))
+
+// Last descendant of each state; a state's subtree is the id range up to it
+static const uint32_t SUBTREE_END[TOTAL_STATES] = {%s};
+
+bool sm_in_state(const SM_Context* ctx, int id) {
+    return SM_IN_STATE(ctx, id);
+}
+
+// True if any state strictly below id is active.
+bool sm_in_substate_of(const SM_Context* ctx, int id) {
+    uint32_t lo = (uint32_t)id + 1, hi = SUBTREE_END[id] + 1;
+    while (lo < hi) {
+        uint32_t end = (lo | 63) + 1 < hi ? (lo | 63) + 1 : hi;
+        uint64_t mask = (~(uint64_t)0 >> (64 - (end - lo))) << (lo & 63);
+        if (ctx->active_states[lo >> 6] & mask) return true;
+        lo = end;
+    }
+    return false;
+}
+
+#if defined(__GNUC__) || defined(__clang__)
+#define SM_CTZ64(bits) ((uint32_t)__builtin_ctzll(bits))
+#else
+static uint32_t SM_CTZ64(uint64_t bits) {
+    uint32_t n = 0;
+    while (!(bits & 1)) { bits >>= 1; n++; }
+    return n;
+}
+#endif
+
+// Active state ids in pre-order (root first); returns how many were written.
+int sm_active_ids(const SM_Context* ctx, uint32_t ids[SM_MAX_ACTIVE]) {
+    int n = 0, w;
+    for (w = 0; w < ACTIVE_WORDS; w++) {
+        uint64_t bits = ctx->active_states[w];
+        while (bits) {
+            ids[n++] = (uint32_t)w * 64 + SM_CTZ64(bits);
+            bits &= bits - 1;
+        }
+    }
+    return n;
+}
+
+const char* const SM_STATE_PATHS[TOTAL_STATES] = {%s};
+static const uint32_t SM_STATE_PATH_LEN[TOTAL_STATES] = {%s};
+
+// Paths of the innermost states of an sm_active_ids snapshot, comma separated.
+// Returns the length written; paths that do not fit are left out.
+size_t sm_write_active_paths(const uint32_t* ids, int n, char* buf, size_t max) {
+    size_t off = 0;
+    int k;
+    if (max) buf[0] = '\\0';
+    for (k = 0; k < n; k++) {
+        /* Innermost: the next active id is outside this state's subtree. */
+        if (k + 1 < n && ids[k + 1] <= SUBTREE_END[ids[k]]) continue;
+        if (off) safe_append(buf, ",", 1, &off, max);
+        safe_append(buf, SM_STATE_PATHS[ids[k]], SM_STATE_PATH_LEN[ids[k]], &off, max);
+    }
+    return off;
+}
+"""
+
+# Timed transitions, shared by the C runtimes: lets the host sleep until the next one can fire.
+DEADLINE_AT = """
+// First `now` at which `now - since` reaches after, or exceeds it if strict: the
+// instant a guard `time >= after` (`time > after`) computed from it starts to hold.
+static double sm_deadline_at(double since, double after, bool strict) {
+    double at = since + after;
+    while (at - since < after || (strict && at - since <= after)) {
+        // Next double up
+        uint64_t bits;
+        memcpy(&bits, &at, sizeof bits);
+        if (at == 0.0) bits = 1;
+        else if (at > 0.0) bits++;
+        else bits--;
+        memcpy(&at, &bits, sizeof at);
+    }
+    return at;
+}
+"""
+
+DEADLINE_SOURCE = """
+// Polled transitions with a time-bound guard: source state, seconds in state before it can
+// hold, whether they must be exceeded
+typedef struct { uint32_t state; double after; bool strict; } SM_Timed;
+static const SM_Timed SM_TIMED[%d] = {%s};
+""" + DEADLINE_AT + """
+// Earliest `now` at or after which a timed transition of an active state can fire, past the
+// bound for `time > C`, so an sm_tick() at the deadline fires it; false if none.
+// Guards that do not depend on time are not considered: sm_tick() after changing what they read.
+bool sm_next_deadline(const SM_Context* ctx, double* deadline) {
+    bool found = false;
+    uint32_t i;
+    for (i = 0; i < %d; i++) {
+        double at;
+        if (!SM_IN_STATE(ctx, SM_TIMED[i].state)) continue;
+        at = sm_deadline_at(ctx->state_timers[SM_TIMED[i].state], SM_TIMED[i].after, SM_TIMED[i].strict);
+        if (!found || at < *deadline) *deadline = at;
+        found = true;
+    }
+    return found;
+}
+"""
+
+COMPACT_DEADLINE_SOURCE = """
+// Polled transitions with a time-bound guard: source state, its timer, time in state before it
+// can hold, whether it must be exceeded
+typedef struct { uint32_t state; uint32_t timer; SM_Time after; bool strict; } SM_Timed;
+static const SM_Timed SM_TIMED[%d] = {%s};
+%s
+// Earliest `now` at or after which a timed transition of an active state can fire, past the
+// bound for `time > C`, so an sm_tick() at the deadline fires it; false if none.
+// Guards that do not depend on time are not considered: sm_tick() after changing what they read.
+bool sm_next_deadline(const SM_Context* ctx, SM_Time* deadline) {
+    bool found = false;
+    uint32_t i;
+    for (i = 0; i < %d; i++) {
+        SM_Time at;
+        if (!SM_IN_STATE(ctx, SM_TIMED[i].state)) continue;
+        at = %s;
+        if (!found || %s) *deadline = at;
+        found = true;
+    }
+    return found;
+}
+"""
+
+NO_DEADLINE_SOURCE = """
+// No transition has a time-bound guard.
+bool sm_next_deadline(const SM_Context* ctx, %s* deadline) {
+    (void)ctx; (void)deadline;
+    return false;
+}
+"""
+
+# Exit/entry steps several transitions take (ModelPlans.shared_steps), outlined;
+# never inlined back, which is the point.
+STEPS_NOINLINE = """
+#if defined(__GNUC__)
+#define SM_NOINLINE __attribute__((noinline))
+#elif defined(_MSC_VER)
+#define SM_NOINLINE __declspec(noinline)
+#else
+#define SM_NOINLINE
+#endif
+"""
+
+STEPS_FUNCTION = """
+// {steps}
+SM_NOINLINE static void transition_steps_{number}(SM_Context* ctx) {{
+{calls}
+}}
+"""
+
+# Decisions of the pointer runtime: one function per decision evaluates its
+# flattened route table (plan.flatten_decisions).
+DECISION_FUNCTION = """
+// Decision '{name}': number of the first route whose guards hold, 0 if none.
+static int decision_{name}(SM_Context* ctx{params}) {{
+    (void)ctx;
+{routes}
+}}
+"""
+
+def decision_functions(plans, time_type="double"):
+    types = {'time': time_type, 'state_name': "const char*", 'state_full_name': "const char*"}
+    functions = []
+    for name in plans.used_decisions():
+        routes = plans.routes[name]
+        lines = []
+        for number, route in enumerate(routes, 1):
+            if route['guard'] is True:
+                lines.append(f"    return {number};")
+            else:
+                lines.append(f"    if ({route['guard']}) return {number};")
+        if not routes or routes[-1]['guard'] is not True:
+            lines.append("    return 0;")
+        params = "".join(f", {types[var]} {var}" for var in decision_params(routes))
+        functions.append(DECISION_FUNCTION.format(name=name, params=params, routes="\n".join(lines)))
+    return "".join(functions)
+
+def decision_call(plans, name):
+    return f"decision_{name}({', '.join(['ctx'] + decision_params(plans.routes[name]))})"
+
+# Transition trace, shared by the C runtimes. Only emitted with 'trace_buffer: N'; format in trace.py.
+TRACE_HEADER = """
+// --- Transition Trace ---
+#define SM_TRACE_BUFFER %d
+#define SM_TRACE_MODEL_ID 0x%08xu
+// Target of a transition that terminates the machine
+#define SM_TRACE_NONE UINT32_MAX
+
+typedef struct {
+    uint64_t tick;
+    double now;
+    uint32_t source;
+    uint32_t target;
+    uint32_t transition;
+} SM_TraceRecord;
+"""
+
+TRACE_FIELDS = """
+
+    // Last SM_TRACE_BUFFER fired transitions (ring buffer); trace_total counts all of them
+    SM_TraceRecord trace[SM_TRACE_BUFFER];
+    uint64_t trace_total;
+    uint64_t ticks;"""
+
+TRACE_DECLS = """
+size_t sm_trace_records(const SM_Context* ctx, SM_TraceRecord out[SM_TRACE_BUFFER]);
+bool sm_write_trace(const SM_Context* ctx, FILE* out);"""
+
+TRACE_TICK = """
+    sm->ctx.ticks++;"""
+
+TRACE_SOURCE = """
+// --- Transition Trace ---
+static inline void sm_record_transition(SM_Context* ctx, uint32_t source, uint32_t target, uint32_t transition) {
+    SM_TraceRecord* r = &ctx->trace[ctx->trace_total % SM_TRACE_BUFFER];
+    r->tick = ctx->ticks;
+    r->now = ctx->now;
+    r->source = source;
+    r->target = target;
+    r->transition = transition;
+    ctx->trace_total++;
+}
+
+static size_t sm_trace_start(const SM_Context* ctx, size_t* count) {
+    *count = ctx->trace_total < SM_TRACE_BUFFER ? (size_t)ctx->trace_total : SM_TRACE_BUFFER;
+    return (size_t)((ctx->trace_total - *count) % SM_TRACE_BUFFER);
+}
+
+// Copy the recorded transitions to out, oldest first; returns how many there are.
+size_t sm_trace_records(const SM_Context* ctx, SM_TraceRecord out[SM_TRACE_BUFFER]) {
+    size_t count, i;
+    size_t start = sm_trace_start(ctx, &count);
+    for (i = 0; i < count; i++) out[i] = ctx->trace[(start + i) % SM_TRACE_BUFFER];
+    return count;
+}
+
+// The buffer as sm-trace.py reads it; false on a write error.
+bool sm_write_trace(const SM_Context* ctx, FILE* out) {
+    const uint32_t head[3] = {1, SM_TRACE_MODEL_ID, SM_TRACE_BUFFER};
+    size_t count, i;
+    size_t start = sm_trace_start(ctx, &count);
+    bool ok = fwrite("SMTR", 1, 4, out) == 4 && fwrite(head, sizeof head, 1, out) == 1
+        && fwrite(&ctx->trace_total, sizeof ctx->trace_total, 1, out) == 1;
+    for (i = 0; ok && i < count; i++) {
+        const SM_TraceRecord* r = &ctx->trace[(start + i) % SM_TRACE_BUFFER];
+        ok = fwrite(&r->tick, sizeof r->tick, 1, out) == 1 && fwrite(&r->now, sizeof r->now, 1, out) == 1
+            && fwrite(&r->source, sizeof r->source, 1, out) == 1 && fwrite(&r->target, sizeof r->target, 1, out) == 1
+            && fwrite(&r->transition, sizeof r->transition, 1, out) == 1;
+    }
+    return ok;
 }
 """
-        return header, source
 
-    def emit_transition_logic(self, name_path, t, indent_level=1):
+def trace_header(size, index, plans):
+    return TRACE_HEADER % (size, model_id(index, plans))
+
+def trace_call(plan):
+    """The statement recording that plan fired."""
+    return "sm_record_transition(ctx, %du, %du, %du);" % record_args(plan)
+
+STEP = """
+    if (sm->root) {
+        sm->root(&sm->ctx);
+        if (sm->ctx.terminated) sm->root = NULL;
+    }"""
+
+# Run to completion, shared by the C runtimes. Only emitted with 'run_to_completion'.
+RTC_HEADER = """
+// --- Run to completion ---
+// Microsteps an sm_tick may take to settle; a tick whose next microstep still fires stops
+// after that one and sets ctx.livelock.
+#define SM_MAX_MICROSTEPS %du
+"""
+
+RTC_FIELDS = """
+
+    // Run to completion: microsteps (steps that fired a transition) the last tick took
+    uint32_t microsteps;
+    bool livelock;"""
+
+RTC_LOOP = """
+    // Run to completion: step until no transition fires, at most SM_MAX_MICROSTEPS times
+    // plus the one that tells a chain still firing from one that settled.
+    sm->ctx.microsteps = 0;
+    sm->ctx.livelock = false;
+    for (;;) {
+%s
+        if (!sm->ctx.transition_fired || sm->ctx.terminated) break;
+        if (++sm->ctx.microsteps > SM_MAX_MICROSTEPS) {
+            sm->ctx.livelock = true;
+            break;
+        }
+        sm->ctx.transition_fired = false;
+    }"""
+
+def run_to_completion(step):
+    """sm_tick's step, repeated by the run-to-completion loop."""
+    return RTC_LOOP % "\n".join("    " + line if line.strip() else "" for line in step.strip("\n").splitlines())
+
+def first_microstep(code):
+    """User do code, run only by the first microstep of a run-to-completion tick."""
+    if not code or not str(code).strip():
+        return code
+    return f"if (ctx->microsteps == 0) {{\n{code}\n}}"
+
+# Instrumentation, shared by the C runtimes. Only emitted with --instrument; layout in instrument.py.
+PROFILE_HEADER = """
+// --- Instrumentation ---
+#define SM_PROFILE_TRANSITIONS %d
+#define SM_PROFILE_BUCKETS %d
+#define SM_PROFILE_MODEL_ID 0x%08xu
+// Words sm_export_profile writes
+#define SM_PROFILE_LEN (6 + 2 * TOTAL_STATES + SM_PROFILE_TRANSITIONS + 3 * TOTAL_STATES * SM_PROFILE_BUCKETS)
+"""
+
+PROFILE_FIELDS = """
+
+    // Instrumentation: entries and time active per state, fires per transition
+    uint64_t entry_counts[TOTAL_STATES];
+    double dwell[TOTAL_STATES];
+    uint64_t fire_counts[SM_PROFILE_TRANSITIONS];"""
+
+PROFILE_TIMING_FIELDS = """
+    // log2 histograms of the cycles user entry/do/exit code took, 3 per state
+    uint64_t user_cycles[3 * TOTAL_STATES][SM_PROFILE_BUCKETS];"""
+
+PROFILE_DECLS = """
+void sm_export_profile(const SM_Context* ctx, uint64_t out[SM_PROFILE_LEN]);
+bool sm_write_profile(const SM_Context* ctx, FILE* out);"""
+
+PROFILE_SOURCE = """
+// --- Instrumentation ---
+// The counters as one flat array; active states include their current stay.
+void sm_export_profile(const SM_Context* ctx, uint64_t out[SM_PROFILE_LEN]) {
+    int s;
+    out[0] = 0x46504D53u; out[1] = 1; out[2] = SM_PROFILE_MODEL_ID;
+    out[3] = TOTAL_STATES; out[4] = SM_PROFILE_TRANSITIONS; out[5] = SM_PROFILE_BUCKETS;
+    for (s = 0; s < TOTAL_STATES; s++) {
+        double dwell = ctx->dwell[s] + (sm_in_state(ctx, s) ? ctx->now - ctx->state_timers[s] : 0.0);
+        out[6 + s] = ctx->entry_counts[s];
+        memcpy(&out[6 + TOTAL_STATES + s], &dwell, sizeof dwell);
+    }
+    memcpy(&out[6 + 2 * TOTAL_STATES], ctx->fire_counts, sizeof ctx->fire_counts);%s
+}
+
+// sm_export_profile as sm-builder --heatmap reads it; false on a write error.
+bool sm_write_profile(const SM_Context* ctx, FILE* out) {
+    static uint64_t flat[SM_PROFILE_LEN];
+    sm_export_profile(ctx, flat);
+    return fwrite(flat, sizeof flat, 1, out) == 1;
+}
+"""
+
+PROFILE_TIMING_EXPORT = """
+    memcpy(&out[6 + 2 * TOTAL_STATES + SM_PROFILE_TRANSITIONS], ctx->user_cycles, sizeof ctx->user_cycles);"""
+
+PROFILE_TIMING_SOURCE = """
+// Cycle counter on x86, nanoseconds elsewhere.
+#if (defined(__x86_64__) || defined(__i386__)) && defined(__GNUC__)
+static inline uint64_t sm_cycles(void) {
+    uint32_t lo, hi;
+    __asm__ __volatile__("rdtsc" : "=a"(lo), "=d"(hi));
+    return ((uint64_t)hi << 32) | lo;
+}
+#elif defined(_MSC_VER)
+#include <intrin.h>
+static inline uint64_t sm_cycles(void) { return __rdtsc(); }
+#else
+#include <time.h>
+static inline uint64_t sm_cycles(void) {
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return (uint64_t)ts.tv_sec * 1000000000u + (uint64_t)ts.tv_nsec;
+}
+#endif
+
+static inline void sm_time_user(SM_Context* ctx, int slot, uint64_t start) {
+    uint64_t cycles = sm_cycles() - start;
+    int bucket = 0;
+    while (cycles && bucket < SM_PROFILE_BUCKETS - 1) {
+        cycles >>= 1;
+        bucket++;
+    }
+    ctx->user_cycles[slot][bucket]++;
+}
+"""
+
+class CInstrumentation:
+    """What --instrument adds to a C runtime, by template slot."""
+    def __init__(self, mode, index, plans):
+        self.mode = mode
+        self.timing = mode == 'timing'
+        self.index = index
+        self.plans = plans
+
+    def header(self):
+        # C has no empty arrays: a model without transitions still gets one counter.
+        return PROFILE_HEADER % (max(len(self.plans.all), 1), profile_buckets(self.mode),
+                                 model_id(self.index, self.plans))
+
+    def fields(self):
+        return PROFILE_FIELDS + (PROFILE_TIMING_FIELDS if self.timing else "")
+
+    def source(self):
+        return (PROFILE_SOURCE % (PROFILE_TIMING_EXPORT if self.timing else "")
+                + (PROFILE_TIMING_SOURCE if self.timing else ""))
+
+    def fire(self, plan):
+        return f"ctx->fire_counts[{plan.number}]++;"
+
+    def timed(self, state_id, kind, code):
+        """User code, timed into its histogram when timing."""
+        if not self.timing or not code or not str(code).strip():
+            return code
+        return (f"uint64_t sm_cycles_start = sm_cycles();\n{code}\n"
+                f"sm_time_user(ctx, {user_slot(state_id, kind)}, sm_cycles_start);")
+
+    def entered(self, state):
+        return f"ctx->entry_counts[{state}]++;"
+
+    def exited(self, state):
+        return f"ctx->dwell[{state}] += ctx->now - ctx->state_timers[{state}];"
+
+    def user_code(self, state_id, kind, code):
+        """User code of one state with its counters: entries before entry code, dwell after exit code."""
+        code = self.timed(state_id, kind, code) or ""
+        if kind == 'entry':
+            return f"{self.entered(state_id)}\n{code}"
+        if kind == 'exit':
+            return f"{code}\n{self.exited(state_id)}"
+        return code
+
+def deadline_source(plans):
+    timed = plans.timed()
+    if not timed:
+        return NO_DEADLINE_SOURCE % "double"
+    rows = [f"{{{s}, {after!r}, {str(strict).lower()}}}" for s, after, strict in timed]
+    return DEADLINE_SOURCE % (len(rows), ", ".join(rows), len(timed))
+
+def compact_deadline_source(layout, plans):
+    timed = plans.timed()
+    if not timed:
+        return NO_DEADLINE_SOURCE % "SM_Time"
+    rows = []
+    for s, after, strict in timed:
+        after, strict = layout.timed_bound(after, strict)
+        rows.append(f"{{{s}, {layout.timers[s]}, {after!r}, {str(strict).lower()}}}")
+    timer = "ctx->state_timers[SM_TIMED[i].timer]"
+    if layout.ticks:
+        # Wrapping tick counts compare by signed distance.
+        at, earlier = f"{timer} + SM_TIMED[i].after + SM_TIMED[i].strict", "(int32_t)(at - *deadline) < 0"
+    else:
+        at, earlier = f"sm_deadline_at({timer}, SM_TIMED[i].after, SM_TIMED[i].strict)", "at < *deadline"
+    return COMPACT_DEADLINE_SOURCE % (len(rows), ", ".join(rows), "" if layout.ticks else DEADLINE_AT,
+                                      len(timed), at, earlier)
+
+# Machines (machines.py): the functions of a machine's states take the instance number.
+MACHINE_SOURCE = """
+// Machine '{name}': the states of instance k have ids MACHINE_{name}[k] + offset
+static const uint32_t MACHINE_{name}[{count}] = {{{ids}}};
+"""
+
+def machine_source(instances):
+    return "".join(MACHINE_SOURCE.format(name=name, count=len(users), ids=", ".join(str(u.index) for u in users))
+                   for name, users in instances.users.items())
+
+def active_set_header(index):
+    return ACTIVE_SET_HEADER % ("\n".join(f"#define STATE_{info.c_name} {info.index}" for info in index),
+                                index.max_active())
+
+def trace_hook(hook, code, indent="    "):
+    """Hook code, compiled in unless SM_TRACE_LEVEL is below the hook's level."""
+    if not code or not str(code).strip():
+        return ""
+    body = "\n".join(f"{indent}{line}" for line in str(code).splitlines())
+    return f"#if SM_TRACE_LEVEL >= {TRACE_LEVELS[hook]}\n{body}\n#endif"
+
+def c_str(text):
+    return '"' + str(text).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def _rows(values, per_line):
+    values = [str(v) for v in values]
+    return "\n    " + ",\n    ".join(", ".join(values[i:i + per_line]) for i in range(0, len(values), per_line)) + "\n"
+
+def active_set_source(index):
+    paths = [state_path(info) for info in index]
+    return ACTIVE_SET_SOURCE % (_rows(index.subtree_ends(), 16), _rows(map(c_str, paths), 4),
+                                _rows((len(path.encode()) for path in paths), 16))
+
+
+class CGenerator:
+    BACKEND = "c"
+
+    def __init__(self, data, index=None, plans=None, profile=None, instrument=None,
+                 compact=None):
+        self.data = data
+        self.profile = profile
+        self.index = index or ModelIndex(data)
+        self.outputs = {'context_ptrs': Spool("\n    "), 'functions': Spool("\n"),
+                        'forwards': Spool("\n"), 'macros': Spool("\n")}
+        self.inspect_list = Spool("\n")
+        self.decisions = data.get('decisions', {})
+        self.plans = plans or ModelPlans(self.index, self.decisions, ticks=compact == 'ticks')
+        self.hooks = data.get('hooks', {})
+        self.includes = data.get('includes', '')
+        self.events = self.plans.events
+        self.subtree_events = self.plans.subtree_events() if self.events else None
+        self.trace = trace_buffer_size(data)
+        self.microsteps = microstep_limit(data)
+        self.instrument = CInstrumentation(instrument, self.index, self.plans) if instrument else None
+        self.layout = ContextLayout(self.index, self.plans, self.hooks, compact, bool(instrument)) if compact else None
+        # Machine instances share their functions unless the layout or the counters need a state's own id.
+        self.instances = None if compact or self.trace or instrument else Instances(self.index)
+
+    def generate(self, header_name="statemachine.h"):
+        header, source = io.StringIO(), io.StringIO()
+        self.write(header, source, header_name)
+        return header.getvalue(), source.getvalue()
+
+    def write(self, header_sink, source_sink, header_name="statemachine.h"):
+        """Generate the machine and stream header and source to the two file-like sinks."""
+        root_data = {
+            'initial': self.data['initial'], 'states': self.data['states'],
+            'history': False,
+            'entry': self.data.get('entry', "// Root Entry"),
+            'run': self.data.get('do', self.data.get('run', "// Root Run")),
+            'exit': self.data.get('exit', "// Root Exit")
+        }
+        
+        if self.plans.used_decisions():
+            self.outputs['functions'].append(decision_functions(self.plans, "SM_Time" if self.layout else "double"))
+        if self.plans.shared_steps():
+            self.outputs['functions'].append(STEPS_NOINLINE)
+        for key, number in self.plans.shared_steps().items():
+            self.outputs['functions'].append(STEPS_FUNCTION.format(
+                steps=describe_steps(key), number=number,
+                calls="\n".join(f"    {self._fmt_step(op, path)}" for op, path in key)))
+        self.recurse(['root'], root_data, None)
+        self.gen_inspector(['root'], root_data, 'root')
+
+        events = self.events
+        write_template(header_sink, HEADER,
+            len(self.index),
+            active_set_header(self.index),
+            (COMPACT_HEADER % ("uint32_t" if self.layout.ticks else "double", len(self.layout.timers))
+             if self.layout else "")
+            + (event_header(events, event_queue_size(self.data)) if events else "")
+            + (trace_header(self.trace, self.index, self.plans) if self.trace else "")
+            + (self.instrument.header() if self.instrument else "")
+            + (RTC_HEADER % self.microsteps if self.microsteps else ""),
+            POINTER_EVENT_TYPES if events else "",
+            self.outputs['forwards'],
+            COMPACT_TIME_FIELDS % max(1, len(self.layout.timers)) if self.layout else TIME_FIELDS,
+            (EVENT_FIELDS if events else "") + (TRACE_FIELDS if self.trace else "")
+            + (self.instrument.fields() if self.instrument else "") + (RTC_FIELDS if self.microsteps else ""),
+            self.data.get('context', ''),
+            self.outputs['context_ptrs'],
+            "SM_Time" if self.layout else "double",
+            (EVENT_DECLS if events else "") + (TRACE_DECLS if self.trace else "")
+            + (PROFILE_DECLS if self.instrument else ""),
+            self.outputs['macros']
+        )
+
+        write_template(source_sink, SOURCE_TOP, header_name, self.includes,
+                       active_set_source(self.index)
+                       + (compact_deadline_source(self.layout, self.plans) if self.layout else deadline_source(self.plans))
+                       + (TRACE_SOURCE if self.trace else "")
+                       + (self.instrument.source() if self.instrument else "")
+                       + (machine_source(self.instances) if self.instances else ""))
+        self.outputs['functions'].copy_to(source_sink)
+        source_sink.write("\n// --- Inspection ---\n")
+        self.inspect_list.copy_to(source_sink)
+        write_template(source_sink, SOURCE_RUNTIME, (TRACE_TICK if self.trace else "") + (EVENT_DRAIN if events else ""),
+                       run_to_completion(STEP) if self.microsteps else STEP,
+                       EVENT_POST + POINTER_DISPATCH if events else "")
+
+        for spool in list(self.outputs.values()) + [self.inspect_list]:
+            spool.close()
+
+    def emit_transition_logic(self, plan, indent_level=1):
         indent = "    " * indent_level
         code = ""
-        target_str = t['transfer_to']
         
-        test_val = t.get('test', True)
+        test_val = plan.guard
         if test_val is True: test_cond = "true"
         elif test_val is False: test_cond = "false"
         else: test_cond = str(test_val)
         
         code += f"{indent}if ({test_cond}) {{\n"
+        code += self._fire_code(plan, indent)
+        code += f"{indent}}}\n"
+        return code
+
+    def _fire_code(self, plan, indent):
+        # Body of a plan's guard block (indent is the block's), from the hook to the return.
+        code = ""
+        hook_code = self.hooks.get('transition', '')
+        shared = self._shared(plan.source)
+        if plan.kind != 'decision':
+            used = referenced_vars(hook_code, plan.action)
+            src, dst = self._instance_paths(plan) if shared else (c_str(plan.src_str), c_str(plan.dst_str))
+            if 't_src' in used:
+                code += f'{indent}    const char* t_src = {src}; (void)t_src;\n'
+            if 't_dst' in used:
+                code += f'{indent}    const char* t_dst = {dst}; (void)t_dst;\n'
+            if hook_code:
+                code += trace_hook('transition', hook_code, indent + '    ') + "\n"
+
+        code += f"{indent}    ctx->transition_fired = true;\n"
+        if self.trace and plan.kind != 'decision':
+            code += f"{indent}    {trace_call(plan)}\n"
+        if self.instrument:
+            code += f"{indent}    {self.instrument.fire(plan)}\n"
 
-        if target_str in self.decisions:
-            decision_rules = self.decisions[target_str]
-            for rule in decision_rules:
-                code += self.emit_transition_logic(name_path, rule, indent_level + 1)
+        if plan.action:
+            code += "\n".join([f"{indent}    {line}" for line in plan.action.splitlines()]) + "\n"
+
+        if plan.kind == 'decision':
+            # The decision's guards are evaluated once, by its shared function.
+            code += f"{indent}    switch ({decision_call(self.plans, plan.decision)}) {{\n"
+            for number, branch in enumerate(plan.branches, 1):
+                code += f"{indent}    case {number}: {{\n{self._fire_code(branch, indent + '    ')}{indent}    }}\n"
+            code += f"{indent}    default: break;\n{indent}    }}\n"
         else:
-            target_path = resolve_target_path(name_path, target_str)
-            
-            exit_funcs = get_exit_sequence(name_path, target_path, lambda p: "state_" + flatten_name(p, "_") + "_exit")
-            
-            from .common import get_entry_sequence
-            entry_funcs = get_entry_sequence(name_path, target_path, lambda p, s: "state_" + flatten_name(p, "_") + s)
-            
-            exit_calls = "".join([f"{indent}    {fn}(ctx);\n" for fn in exit_funcs])
-            entry_calls = "".join([f"{indent}    {fn}(ctx);\n" for fn in entry_funcs])
-            
-            code += f"{exit_calls}"
-            code += f"{entry_calls}"
+            outlined = self.plans.shared_steps().get(plan.step_key)
+            if outlined is not None:
+                code += f"{indent}    transition_steps_{outlined}(ctx);\n"
+            else:
+                slot = "inst" if shared else None
+                code += "".join([f"{indent}    {self._fmt_step(op, path, slot)}\n" for op, path in plan.steps])
+            if plan.terminate:
+                code += f"{indent}    ctx->terminated = true;\n"
             code += f"{indent}    return;\n"
-
-        code += f"{indent}}}\n"
         return code
 
+    def _fmt_step(self, op, path, slot=None):
+        if self.instances:
+            info = self.index.get(path)
+            if self.instances.of(info) or (op == 'exit_child' and self.instances.using(info)):
+                return self._instance_step(op, info, slot)
+        c_name = flatten_name(path, "_")
+        if op == 'exit_child':
+            if self.layout:
+                return f"state_{c_name}_child_exit(ctx);"
+            return f"if (ctx->ptr_{c_name}_exit) ctx->ptr_{c_name}_exit(ctx);"
+        if op == 'exit_region':
+            if self.layout:
+                return f"if (SM_IN_STATE(ctx, {self.index.get(path).index})) state_{c_name}_exit(ctx);"
+            return f"if (ctx->ptr_{c_name}_region_exit) ctx->ptr_{c_name}_region_exit(ctx);"
+        return f"state_{c_name}_{op}(ctx);"
+
+    def _instance_step(self, op, info, slot):
+        # A step into a machine instance: the instance's number, or slot in the machine's shared functions.
+        name = self.instances.shared_name(info)
+        if slot is None:
+            owner = self.instances.of(info)
+            slot, state_id = (owner[1] if owner else self.instances.using(info)[1]), info.index
+        else:
+            state_id = self.instances.state_id(info, slot)
+        if op == 'exit_child':
+            return f"state_{name}_child_exit(ctx, {slot});"
+        if op == 'exit_region':
+            return f"if (SM_IN_STATE(ctx, {state_id})) state_{name}_exit(ctx, {slot});"
+        return f"state_{name}_{op}(ctx, {slot});"
+
+    def _shared(self, info):
+        # True for the states whose functions all instances of their machine share.
+        return bool(self.instances) and self.instances.of(info) is not None
+
+    def _instance_paths(self, plan):
+        # t_src / t_dst of a transition inside a machine, for the instance running it.
+        src = f"SM_STATE_PATHS[{self.instances.state_id(plan.source, 'inst')}]"
+        if not plan.forks:
+            return src, f"SM_STATE_PATHS[{self.instances.state_id(plan.target, 'inst')}]"
+        machine, _, first = self.instances.of(plan.source)
+        tail = plan.dst_str[len(state_path(first)):]
+        paths = ", ".join(c_str(state_path(user) + tail) for user in self.instances.users[machine])
+        return src, f"((const char* const[]){{{paths}}})[inst]"
+
+    def _transition_code(self, name_path, event=None):
+        return "".join(self.emit_transition_logic(plan, 1) for plan in self.plans.for_event(name_path, event))
+
+    def _event_function(self, info, children, c_name, params=""):
+        # Dispatch for one state: its own listeners, then the active child / each region.
+        arms = []
+        for event in self.events:
+            code = self._transition_code(info.path, event)
+            if code:
+                arms.append(f"    case SM_EVENT_{event}: {{\n{code}        break;\n    }}")
+        below = set()
+        for child in info.children:
+            below |= self.subtree_events[child.index]
+        return EVENT_TEMPLATE.format(c_name=c_name, params=params, preamble=self._preamble(info, *arms),
+                                     arms="\n".join(arms), children=children if below else "")
+
+    def _preamble(self, info, *code):
+        if self._shared(info):
+            return preamble(SHARED_PREAMBLE_LINES, info, *code, state_id=self.instances.state_id(info, "inst"))
+        if not self.layout:
+            return preamble(PREAMBLE_LINES, info, *code)
+        return preamble(COMPACT_PREAMBLE_LINES, info, *code, timer=self.layout.timer(info))
+
+    def _render(self, info, template, do_uses=(), **fields):
+        # One state's function bodies; timed per state when profiling.
+        # do_uses: the run function's code besides its transitions, for its preamble.
+        t0 = time.perf_counter()
+        transitions = self._transition_code(info.path)
+        t1 = time.perf_counter()
+        body = template.format(transitions=transitions, do_preamble=self._preamble(info, transitions, *do_uses),
+                               **fields)
+        if self.profile:
+            self.profile.record_state(self.BACKEND, info.path, time.perf_counter() - t0, t1 - t0)
+        return body
+
     def recurse(self, name_path, data, parent_ptrs):
-        my_id_num = self.state_counter
-        self.state_counter += 1
-        my_c_name = flatten_name(name_path, "_")
-        
-        disp_name = "/" + "/".join(name_path[1:]) if len(name_path) > 1 else "/"
-        preamble = FUNC_PREAMBLE.format(short_name=name_path[-1], display_name=disp_name, state_id=my_id_num)
+        walk_nested(self._recurse(self.index.get(name_path), data, parent_ptrs))
+
+    def _recurse(self, info, data, parent_ptrs):
+        # Visitor for walk_nested: 'yield self._recurse(...)' visits a child.
+        name_path = info.path
+        my_id_num = info.index
+        shared = self._shared(info)
+        if shared:
+            # A state of a machine instance: its functions take the instance number.
+            my_c_name = self.instances.shared_name(info)
+            state_id = self.instances.state_id(info, "inst")
+            shape = dict(params=", int inst", args=", inst")
+        else:
+            my_c_name = info.c_name
+            state_id = my_id_num
+            shape = dict(params="", args="")
 
         parent_run_ptr = parent_ptrs[0] if parent_ptrs else None
-        parent_hist_ptr = parent_ptrs[1] if parent_ptrs else None
+        parent_exit_ptr = parent_ptrs[1] if parent_ptrs else None
+        parent_hist_ptr = parent_ptrs[2] if parent_ptrs else None
 
         if parent_run_ptr:
-            self.outputs['macros'].append(f"#define IN_STATE_{my_c_name} (ctx->{parent_run_ptr} == state_{my_c_name}_run)")
+            self.outputs['macros'].append(f"#define IN_STATE_{info.c_name} SM_IN_STATE(ctx, {my_id_num})")
 
-        hist_save_code = f"ctx->{parent_hist_ptr} = state_{my_c_name}_entry;" if parent_hist_ptr else ""
-        set_parent_code = f"ctx->{parent_run_ptr} = state_{my_c_name}_run;" if parent_run_ptr else ""
+        if shared and not self.instances.is_first(info):
+            # The other instances run the functions of the machine's first one.
+            for child in info.children:
+                yield self._recurse(child, child.data, parent_ptrs)
+            return
 
-        trans_code = ""
-        for t in data.get('transitions', []):
-            trans_code += self.emit_transition_logic(name_path, t, 1)
+        set_parent_code = f"SM_SET_ACTIVE(ctx, {state_id});"
+        clear_parent_code = f"SM_CLEAR_ACTIVE(ctx, {state_id});"
+        if parent_run_ptr and (self.layout or shared):
+            if not info.parent.is_orthogonal:
+                number = ContextLayout.child_number(info)
+                parent = self.instances.shared_name(info.parent) + "[inst]" if shared else info.parent.c_name
+                set_parent_code += f"\n    ctx->active_{parent} = {number};"
+                if parent_hist_ptr:
+                    set_parent_code += f"\n    ctx->hist_{parent} = {number};"
+                clear_parent_code += f"\n    ctx->active_{parent} = 0;"
+        elif parent_run_ptr:
+            set_parent_code += f"\n    ctx->{parent_run_ptr} = state_{my_c_name}_run;\n    "
+            set_parent_code += f"ctx->{parent_exit_ptr} = state_{my_c_name}_exit;"
+            if parent_hist_ptr:
+                set_parent_code += f"\n    ctx->{parent_hist_ptr} = state_{my_c_name}_entry;"
+            clear_parent_code += f"\n    ctx->{parent_run_ptr} = NULL;\n    "
+            clear_parent_code += f"ctx->{parent_exit_ptr} = NULL;"
+            if self.events and not info.parent.is_orthogonal:
+                set_parent_code += f"\n    ctx->{parent_run_ptr}_event = state_{my_c_name}_event;"
+                clear_parent_code += f"\n    ctx->{parent_run_ptr}_event = NULL;"
 
         is_composite = 'states' in data
-        is_parallel = data.get('parallel', False)
+        is_parallel = data.get('parallel', data.get('orthogonal', False))
         
-        h_entry = self.hooks.get('entry', '')
-        h_run = self.hooks.get('run', '')
-        h_exit = self.hooks.get('exit', '')
+        h_entry = trace_hook('entry', self.hooks.get('entry', ''))
+        h_run = trace_hook('do', self.hooks.get('do', self.hooks.get('run', '')))
+        h_exit = trace_hook('exit', self.hooks.get('exit', ''))
+        user = {'entry': data.get('entry', ''), 'do': data.get('do', data.get('run', '')), 'exit': data.get('exit', '')}
+        if self.instrument:
+            user = {kind: self.instrument.user_code(my_id_num, kind, code) for kind, code in user.items()}
+        if self.microsteps:
+            user['do'], h_run = first_microstep(user['do']), first_microstep(h_run)
+        run_code = user['do']
+        timer = self.layout.timer(info) if self.layout else state_id
+        preambles = dict(start_timer="" if timer is None else f"ctx->state_timers[{timer}] = ctx->now;",
+                         entry_preamble=self._preamble(info, h_entry, user['entry']),
+                         exit_preamble=self._preamble(info, h_exit, user['exit']),
+                         do_uses=(h_run, run_code))
 
         if is_composite:
             if is_parallel:
+                if shared:
+                    safety_check = f"if (!SM_IN_STATE(ctx, {state_id}) || ctx->transition_fired) return;"
+                elif parent_run_ptr:
+                    safety_check = f"if (!IN_STATE_{my_c_name} || ctx->transition_fired) return;"
+                else:
+                    safety_check = "if (ctx->transition_fired) return;"
+
                 p_entries, p_exits, p_ticks = "", "", ""
-                for child_name, child_data in data['states'].items():
-                    child_path = name_path + [child_name]
-                    region_ptr = f"ptr_{flatten_name(child_path, '_')}"
-                    
-                    init_leaf = flatten_name(child_path + [child_data['initial']], "_")
-                    p_entries += f"    state_{init_leaf}_entry(ctx);\n"
-                    p_ticks += f"    if (ctx->{region_ptr}) ctx->{region_ptr}(ctx);\n"
-                    p_exits += f"    // Implicit exit {child_name}\n"
+                event_children = f"{safety_check}\n"
+                for child in info.children:
+                    child_c_name, args, child_id = self._child_ref(info, child)
+                    region_ptr = f"ptr_{child.c_name}_region"
+                    region_exit_ptr = f"{region_ptr}_exit"
+                    if self.layout or args:
+                        p_exits += f"    if (SM_IN_STATE(ctx, {child_id})) state_{child_c_name}_exit(ctx{args});\n"
+                    else:
+                        self.outputs['context_ptrs'].append(f"StateFunc {region_ptr};")
+                        self.outputs['context_ptrs'].append(f"StateFunc {region_exit_ptr};")
+                        p_exits += f"    if (ctx->{region_exit_ptr}) ctx->{region_exit_ptr}(ctx);\n"
+
+                    p_entries += f"    state_{child_c_name}_entry(ctx{args});\n"
+                    p_ticks += f"    state_{child_c_name}_run(ctx{args});\n"
+                    p_ticks += f"    {safety_check}\n"
+                    event_children += f"    state_{child_c_name}_event(ctx, event{args});\n    {safety_check}\n"
                     
-                    self.recurse(child_path, child_data, (region_ptr, None))
+                    yield self._recurse(child, child.data, (region_ptr, region_exit_ptr, None))
 
-                func_body = COMPOSITE_AND_TEMPLATE.format(
-                    c_name=my_c_name, state_id=my_id_num, preamble=preamble,
+                func_body = self._render(info, COMPOSITE_AND_TEMPLATE,
+                    c_name=my_c_name, **shape, **preambles,
                     hook_entry=h_entry, hook_run=h_run, hook_exit=h_exit,
-                    entry=data.get('entry', ''), exit=data.get('exit', ''), run=data.get('run', ''),
-                    transitions=trans_code, set_parent=set_parent_code,
+                    entry=user['entry'], exit=user['exit'], run=run_code,
+                    set_parent=set_parent_code, clear_parent=clear_parent_code,
                     parallel_entries=p_entries, parallel_exits=p_exits, parallel_ticks=p_ticks,
-                    history_save=hist_save_code
+                    safety_check=safety_check
                 )
             else:
                 my_ptr = f"ptr_{my_c_name}"
+                my_exit_ptr = f"{my_ptr}_exit"
                 my_hist = f"hist_{my_c_name}"
-                self.outputs['context_ptrs'].append(f"StateFunc {my_ptr};")
-                self.outputs['context_ptrs'].append(f"StateFunc {my_hist};")
-                
-                init_target = flatten_name(name_path + [data['initial']], "_")
-                hist_bool = "true" if data.get('history', False) else "false"
+                init_target = flatten_name(name_path + (data['initial'],), "_")
+                use_history = data.get('history', False)
+                hist_bool = "true" if use_history else "false"
 
-                func_body = COMPOSITE_OR_TEMPLATE.format(
-                    c_name=my_c_name, state_id=my_id_num, preamble=preamble,
+                if shared or (self.instances and self.instances.using(info)):
+                    children = self._machine_children(info)
+                elif self.layout:
+                    children = self._compact_children(info, init_target)
+                else:
+                    self.outputs['context_ptrs'].append(f"StateFunc {my_ptr};")
+                    self.outputs['context_ptrs'].append(f"StateFunc {my_exit_ptr};")
+                    self.outputs['context_ptrs'].append(f"StateFunc {my_hist};")
+                    if self.events:
+                        self.outputs['context_ptrs'].append(f"EventFunc {my_ptr}_event;")
+                    children = dict(
+                        enter_child=ENTER_CHILD.format(history=hist_bool, hist=my_hist, initial=init_target),
+                        exit_child=EXIT_CHILD.format(exit_ptr=my_exit_ptr),
+                        run_child=RUN_CHILD.format(ptr=my_ptr),
+                        event_children=f"if (ctx->{my_ptr}_event) ctx->{my_ptr}_event(ctx, event);")
+                event_children = children.pop('event_children')
+
+                func_body = self._render(info, COMPOSITE_OR_TEMPLATE,
+                    c_name=my_c_name, **shape, **preambles,
                     hook_entry=h_entry, hook_run=h_run, hook_exit=h_exit,
-                    entry=data.get('entry', ''), exit=data.get('exit', ''), run=data.get('run', ''),
-                    transitions=trans_code, history=hist_bool,
-                    self_ptr=my_ptr, self_hist_ptr=my_hist,
-                    initial_target=init_target, history_save=hist_save_code,
-                    set_parent=set_parent_code
+                    entry=user['entry'], exit=user['exit'], run=run_code,
+                    **children,
+                    set_parent=set_parent_code, clear_parent=clear_parent_code
                 )
                 
-                for child_name, child_data in data['states'].items():
-                    self.recurse(name_path + [child_name], child_data, (my_ptr, my_hist))
+                child_hist_ptr = my_hist if use_history else None
+                for child in info.children:
+                    yield self._recurse(child, child.data, (my_ptr, my_exit_ptr, child_hist_ptr))
         else:
-            func_body = LEAF_TEMPLATE.format(
-                c_name=my_c_name, state_id=my_id_num, preamble=preamble,
+            event_children = ""
+            func_body = self._render(info, LEAF_TEMPLATE,
+                c_name=my_c_name, **shape, **preambles,
                 hook_entry=h_entry, hook_run=h_run, hook_exit=h_exit,
-                entry=data.get('entry', ''), exit=data.get('exit', ''), run=data.get('run', ''),
-                transitions=trans_code, history_save=hist_save_code,
-                parent_ptr=parent_run_ptr
+                entry=user['entry'], exit=user['exit'], run=run_code,
+                set_parent=set_parent_code, clear_parent=clear_parent_code
             )
 
         self.outputs['functions'].append(func_body)
-        self.outputs['forwards'].append(f"void state_{my_c_name}_entry(SM_Context* ctx);")
-        self.outputs['forwards'].append(f"void state_{my_c_name}_run(SM_Context* ctx);")
-        self.outputs['forwards'].append(f"void state_{my_c_name}_exit(SM_Context* ctx);")
+        params = shape['params']
+        self.outputs['forwards'].append(f"void state_{my_c_name}_start(SM_Context* ctx{params});")
+        self.outputs['forwards'].append(f"void state_{my_c_name}_entry(SM_Context* ctx{params});")
+        self.outputs['forwards'].append(f"void state_{my_c_name}_run(SM_Context* ctx{params});")
+        self.outputs['forwards'].append(f"void state_{my_c_name}_exit(SM_Context* ctx{params});")
+        if self.events:
+            self.outputs['functions'].append(self._event_function(info, event_children, my_c_name, params))
+            self.outputs['forwards'].append(f"void state_{my_c_name}_event(SM_Context* ctx, SM_Event event{params});")
+
+    def _compact_children(self, info, initial):
+        # --compact: the OR composite's child number fields and the functions dispatching on them.
+        c_name = info.c_name
+        id_type = f"uint{self.layout.id_bits(info)}_t"
+        fields = ["active"] + (["hist"] if info.data.get('history', False) else [])
+        for field in fields:
+            self.outputs['context_ptrs'].append(f"{id_type} {field}_{c_name};")
+        helpers = [('run', 'active', "", "(ctx)", "break;"), ('exit', 'active', "", "(ctx)", "break;")]
+        if 'hist' in fields:
+            helpers.append(('entry', 'hist', "", "(ctx)", f"state_{initial}_entry(ctx); break;"))
+        if self.events:
+            helpers.append(('event', 'active', ", SM_Event event", "(ctx, event)", "break;"))
+        for op, field, params, args, default in helpers:
+            arms = "\n".join(f"    case {self.layout.child_number(child)}: state_{child.c_name}_{op}{args}; break;"
+                             for child in info.children)
+            self.outputs['functions'].append(COMPACT_CHILD_TEMPLATE.format(
+                c_name=c_name, op=op, params=params, field=field, slot="", arms=arms, default=default))
+            self.outputs['forwards'].append(f"void state_{c_name}_child_{op}(SM_Context* ctx{params});")
+        return dict(
+            enter_child=f"state_{c_name}_child_entry(ctx);" if 'hist' in fields else f"state_{initial}_entry(ctx);",
+            exit_child=f"state_{c_name}_child_exit(ctx);",
+            run_child=f"state_{c_name}_child_run(ctx);",
+            event_children=f"state_{c_name}_child_event(ctx, event);")
+
+    def _child_ref(self, info, child):
+        # How info's functions reach a child: (function name part, arguments after ctx, id expression).
+        if not self._shared(child):
+            return child.c_name, "", child.index
+        if self._shared(info):
+            return self.instances.shared_name(child), ", inst", self.instances.state_id(child, "inst")
+        return self.instances.shared_name(child), f", {self.instances.using(info)[1]}", child.index
+
+    def _machine_children(self, info):
+        # Children of a using state or of an OR composite inside a machine: child numbers per
+        # instance, in arrays indexed by the instance number, dispatched by functions the instances share.
+        name = self.instances.shared_name(info)
+        using = self.instances.using(info)
+        machine = using[0] if using else self.instances.of(info)[0]
+        slot = using[1] if using else "inst"
+        history = info.data.get('history', False)
+        first = self.instances.shared_name(next(c for c in info.children if c.name == info.data['initial']))
+        if slot in (0, "inst"):
+            count = len(self.instances.users[machine])
+            fields = ["active"] + (["hist"] if history else [])
+            for field in fields:
+                self.outputs['context_ptrs'].append(f"uint{ContextLayout.id_bits(info)}_t {field}_{name}[{count}];")
+            helpers = [('run', 'active', ", int inst", "(ctx, inst)", "break;"),
+                       ('exit', 'active', ", int inst", "(ctx, inst)", "break;")]
+            if history:
+                helpers.append(('entry', 'hist', ", int inst", "(ctx, inst)", f"state_{first}_entry(ctx, inst); break;"))
+            if self.events:
+                helpers.append(('event', 'active', ", SM_Event event, int inst", "(ctx, event, inst)", "break;"))
+            for op, field, params, args, default in helpers:
+                arms = "\n".join(f"    case {ContextLayout.child_number(child)}: "
+                                 f"state_{self.instances.shared_name(child)}_{op}{args}; break;"
+                                 for child in info.children)
+                self.outputs['functions'].append(COMPACT_CHILD_TEMPLATE.format(
+                    c_name=name, op=op, params=params, field=field, slot="[inst]", arms=arms, default=default))
+                self.outputs['forwards'].append(f"void state_{name}_child_{op}(SM_Context* ctx{params});")
+        return dict(
+            enter_child=f"state_{name}_child_entry(ctx, {slot});" if history else f"state_{first}_entry(ctx, {slot});",
+            exit_child=f"state_{name}_child_exit(ctx, {slot});",
+            run_child=f"state_{name}_child_run(ctx, {slot});",
+            event_children=f"state_{name}_child_event(ctx, event, {slot});")
 
     def gen_inspector(self, name_path, data, ptr_name_in_struct):
-        my_c_name = flatten_name(name_path, "_")
-        func_name = f"inspect_{my_c_name}"
-        disp_name = "" if name_path == ['root'] else "/" + name_path[-1]
+        walk_nested(self._gen_inspector(self.index.get(name_path), data))
 
-        body = f"void {func_name}(SM_Context* ctx, char* buf, size_t* off, size_t max) {{\n"
-        if disp_name: body += f"    safe_strcat(buf, \"{disp_name}\", off, max);\n"
+    def _gen_inspector(self, info, data):
+        # Same format as the Rust backend: /a/b, orthogonal regions as /[x/a,y/b].
+        shared = self._shared(info)
+        if shared and not self.instances.is_first(info):
+            return
+        my_c_name = self.instances.shared_name(info) if shared else info.c_name
+        func_name = f"inspect_{my_c_name}"
+        disp_name = "" if info.parent is None else info.name
 
+        params = ", int inst" if shared else ""
+        body = [f"void {func_name}(SM_Context* ctx, char* buf, size_t* off, size_t max{params}) {{\n"]
         is_composite = 'states' in data
+        if not is_composite:
+            body.append("    (void)ctx; (void)inst;\n" if shared else "    (void)ctx;\n")
+        if disp_name: body.append(f"    SM_APPEND(buf, \"{disp_name}\", off, max);\n")
+
         if is_composite:
-            if data.get('parallel', False):
-                body += f"    safe_strcat(buf, \"[\", off, max);\n"
-                children = list(data['states'].items())
-                for i, (child_name, child_data) in enumerate(children):
-                    child_path = name_path + [child_name]
-                    child_func = f"inspect_{flatten_name(child_path, '_')}"
-                    region_ptr = f"ptr_{flatten_name(child_path, '_')}"
-                    self.gen_inspector(child_path, child_data, region_ptr)
-                    body += f"    {child_func}(ctx, buf, off, max);\n"
-                    if i < len(children)-1: body += "    safe_strcat(buf, \",\", off, max);\n"
-                body += f"    safe_strcat(buf, \"]\", off, max);\n"
+            if data.get('parallel', data.get('orthogonal', False)):
+                body.append(f"    SM_APPEND(buf, \"/[\", off, max);\n")
+                for i, child in enumerate(info.children):
+                    yield self._gen_inspector(child, child.data)
+                    name, args, _ = self._child_ref(info, child)
+                    body.append(f"    inspect_{name}(ctx, buf, off, max{args});\n")
+                    if i < len(info.children)-1: body.append("    SM_APPEND(buf, \",\", off, max);\n")
+                body.append(f"    SM_APPEND(buf, \"]\", off, max);\n")
             else:
-                my_ptr = f"ptr_{my_c_name}"
-                for child_name, child_data in data['states'].items():
-                    self.gen_inspector(name_path + [child_name], child_data, my_ptr)
+                for child in info.children:
+                    yield self._gen_inspector(child, child.data)
                 
                 first = True
-                for child_name, child_data in data['states'].items():
-                    c_name = flatten_name(name_path + [child_name], "_")
+                for child in info.children:
+                    c_name, args, child_id = self._child_ref(info, child)
                     else_txt = "else " if not first else ""
-                    body += f"    {else_txt}if (ctx->{my_ptr} == state_{c_name}_run) inspect_{c_name}(ctx, buf, off, max);\n"
+                    body.append(f"    {else_txt}if (SM_IN_STATE(ctx, {child_id})) {{\n")
+                    body.append(f"        SM_APPEND(buf, \"/\", off, max);\n")
+                    body.append(f"        inspect_{c_name}(ctx, buf, off, max{args});\n")
+                    body.append("    }\n")
                     first = False
         
-        body += "}\n"
-        self.inspect_list.append(body)
+        body.append("}\n")
+        self.inspect_list.append("".join(body))
@@ -0,0 +1,479 @@
+from .model import ModelIndex
+from .plan import ModelPlans
+from .stream import write_template
+from .common import event_queue_size, trace_buffer_size, microstep_limit, referenced_vars
+from .c_lang import (c_str, trace_hook, active_set_header, active_set_source, deadline_source, event_header,
+                     EVENT_FIELDS, EVENT_DECLS, EVENT_DRAIN, EVENT_POST,
+                     trace_header, trace_call, TRACE_FIELDS, TRACE_DECLS, TRACE_TICK, TRACE_SOURCE,
+                     CInstrumentation, PROFILE_DECLS, RTC_HEADER, RTC_FIELDS, run_to_completion)
+from .tables import MachineTables, ROW_DECISION, merge_arms
+import io
+
+HEADER = """
+#ifndef STATEMACHINE_H
+#define STATEMACHINE_H
+#include <stdio.h>
+#include <stdbool.h>
+#include <stdint.h>
+#include <string.h>
+
+// Hooks above this level are compiled out; -DSM_TRACE_LEVEL=0 drops them all.
+#ifndef SM_TRACE_LEVEL
+#define SM_TRACE_LEVEL 3
+#endif
+
+#define TOTAL_STATES %d
+%s%s
+#define TOTAL_SLOTS %d
+#define NO_STATE %d
+
+typedef %s StateId;
+
+typedef struct SM_Context {
+    void* owner;
+    double now;
+    double state_timers[TOTAL_STATES];
+    bool transition_fired;
+    bool terminated;
+    uint64_t active_states[ACTIVE_WORDS];
+
+    // User Context Variables
+    %s
+
+    // State held by each slot, last child of each history composite
+    StateId active[TOTAL_SLOTS];
+    StateId hist[TOTAL_SLOTS];%s
+} SM_Context;
+
+typedef struct {
+    SM_Context ctx;
+    bool running;
+} StateMachine;
+
+void sm_init(StateMachine* sm);
+void sm_tick(StateMachine* sm);
+bool sm_is_running(StateMachine* sm);
+void sm_get_state_str(StateMachine* sm, char* buffer, size_t max_len);
+bool sm_in_state(const SM_Context* ctx, int id);
+bool sm_in_substate_of(const SM_Context* ctx, int id);
+bool sm_next_deadline(const SM_Context* ctx, double* deadline);
+int sm_active_ids(const SM_Context* ctx, uint32_t ids[SM_MAX_ACTIVE]);
+size_t sm_write_active_paths(const uint32_t* ids, int n, char* buf, size_t max);%s
+
+// --- Macros ---
+#define IN_STATE(statename) IN_STATE_##statename
+%s
+
+#endif
+"""
+
+SOURCE_TOP = """
+#include "%s"
+
+// --- User Includes ---
+%s
+
+// --- Helpers ---
+// Append len bytes of src (and its terminator) unless that would overflow max.
+static void safe_append(char* dest, const char* src, size_t len, size_t* offset, size_t max) {
+    if (*offset + len >= max) return;
+    memcpy(dest + *offset, src, len + 1);
+    *offset += len;
+}
+#define SM_APPEND(dest, literal, offset, max) safe_append(dest, literal, sizeof(literal) - 1, offset, max)
+"""
+
+TABLES = """
+// --- State Tables ---
+enum { LEAF = 0, OR = 1, AND = 2 };
+enum { ROW_NORMAL = 0, ROW_DECISION = 1, ROW_TERMINATE = 2 };
+enum { OP_EXIT_CHILD = 0, OP_EXIT_REGION = 1, OP_EXIT = 2, OP_START = 3, OP_ENTRY = 4 };
+
+// first..last: ops for transitions, branch rows for decisions
+typedef struct { uint8_t kind; StateId state; uint32_t first, last; } SM_Row;
+typedef struct { uint8_t op; StateId state; } SM_Op;
+typedef struct { uint32_t first, last; } SM_Range;
+
+static const StateId PARENT[TOTAL_STATES] = {%s};
+static const uint8_t KIND[TOTAL_STATES] = {%s};
+static const StateId SLOT[TOTAL_STATES] = {%s};
+static const StateId CHILD_SLOT[TOTAL_STATES] = {%s};
+static const StateId INITIAL[TOTAL_STATES] = {%s};
+static const bool HISTORY[TOTAL_STATES] = {%s};
+static const SM_Range CHILD_RANGE[TOTAL_STATES] = {%s};
+static const StateId CHILDREN[%d] = {%s};
+static const SM_Range ROW_RANGE[TOTAL_STATES] = {%s};
+static const char* const STATE_NAMES[TOTAL_STATES] = {%s};
+static const uint32_t STATE_NAME_LEN[TOTAL_STATES] = {%s};
+static const SM_Row ROWS[%d] = {%s};
+static const SM_Op OPS[%d] = {%s};
+"""
+
+EVENT_TABLES = """
+// Per state, its groups first..last in EVENT_ROWS; each group is one event's rows
+typedef struct { uint16_t event; uint32_t first, last; } SM_EventRows;
+static const SM_Range EVENT_RANGE[TOTAL_STATES] = {%s};
+static const SM_EventRows EVENT_ROWS[%d] = {%s};
+// Whether some descendant listens to an event
+static const bool LISTENING[TOTAL_STATES] = {%s};
+"""
+
+EVENT_INTERPRETER = """
+// Like sm_do, but only the rows listening to event; no hooks or do code.
+static void sm_event(SM_Context* ctx, StateId s, SM_Event event) {
+    uint32_t k;
+    for (k = EVENT_RANGE[s].first; k < EVENT_RANGE[s].last; k++) {
+        if (EVENT_ROWS[k].event != event) continue;
+        if (sm_fire(ctx, EVENT_ROWS[k].first, EVENT_ROWS[k].last)) return;
+        break;
+    }
+    if (!LISTENING[s]) return;
+    if (KIND[s] == OR) {
+        StateId child = ctx->active[CHILD_SLOT[s]];
+        if (child != NO_STATE) sm_event(ctx, child, event);
+    } else if (KIND[s] == AND) {
+        if (!SM_IN_STATE(ctx, s) || ctx->transition_fired) return;
+        for (k = CHILD_RANGE[s].first; k < CHILD_RANGE[s].last; k++) {
+            sm_event(ctx, CHILDREN[k], event);
+            if (!SM_IN_STATE(ctx, s) || ctx->transition_fired) return;
+        }
+    }
+}
+
+// Run the transitions listening to event on the active states, now.
+void sm_dispatch(StateMachine* sm, SM_Event event) {
+    if (!sm->running) return;
+    sm->ctx.transition_fired = false;
+    sm_event(&sm->ctx, 0, event);
+    if (sm->ctx.terminated) sm->running = false;
+}
+"""
+
+# User code: hooks run for every state, entry/exit/do code per state.
+USER_FUNC = """
+static void {name}(SM_Context* ctx, StateId s) {{
+    {preamble}
+    {hook}
+    switch (s) {{
+{arms}
+    default: break;
+    }}
+}}
+"""
+
+GUARD_FUNC = """
+static bool guard(SM_Context* ctx, uint32_t r) {{
+    StateId s = ROWS[r].state;
+    {preamble}
+    switch (r) {{
+{arms}
+    default: return true;
+    }}
+}}
+"""
+
+ACTION_FUNC = """
+static void action(SM_Context* ctx, uint32_t r) {{
+    StateId s = ROWS[r].state;
+    {preamble}
+    switch (r) {{
+{arms}
+    default:
+        ctx->transition_fired = true;
+        break;
+    }}
+}}
+"""
+
+# Variables user code may use, for the state id `s`; declared only when mentioned.
+PREAMBLE_LINES = (
+    (None, '(void)ctx; (void)s;'),
+    ('state_name', 'const char* state_name = STATE_NAMES[s]; (void)state_name;'),
+    ('state_full_name', 'const char* state_full_name = SM_STATE_PATHS[s]; (void)state_full_name;'),
+    ('time', 'double time = ctx->now - ctx->state_timers[s]; (void)time;'),
+)
+
+def _preamble(*code):
+    used = referenced_vars(*code)
+    return "\n    ".join(line for var, line in PREAMBLE_LINES if var is None or var in used)
+
+INTERPRETER = """
+// --- Interpreter ---
+static void sm_start(SM_Context* ctx, StateId s) {
+    StateId parent = PARENT[s];
+    ctx->state_timers[s] = ctx->now;
+    on_entry(ctx, s);
+    SM_SET_ACTIVE(ctx, s);
+    if (SLOT[s] != NO_STATE) ctx->active[SLOT[s]] = s;
+    if (parent != NO_STATE && HISTORY[parent]) ctx->hist[CHILD_SLOT[parent]] = s;
+}
+
+static void sm_entry(SM_Context* ctx, StateId s) {
+    uint32_t k;
+    sm_start(ctx, s);
+    if (KIND[s] == OR) {
+        StateId last = ctx->hist[CHILD_SLOT[s]];
+        sm_entry(ctx, HISTORY[s] && last != NO_STATE ? last : INITIAL[s]);
+    } else if (KIND[s] == AND) {
+        for (k = CHILD_RANGE[s].first; k < CHILD_RANGE[s].last; k++) sm_entry(ctx, CHILDREN[k]);
+    }
+}
+
+static void sm_exit(SM_Context* ctx, StateId s) {
+    uint32_t k;
+    if (KIND[s] == OR) {
+        StateId child = ctx->active[CHILD_SLOT[s]];
+        if (child != NO_STATE) sm_exit(ctx, child);
+    } else if (KIND[s] == AND) {
+        for (k = CHILD_RANGE[s].first; k < CHILD_RANGE[s].last; k++) {
+            StateId region = CHILDREN[k];
+            if (ctx->active[SLOT[region]] == region) sm_exit(ctx, region);
+        }
+    }
+    on_exit(ctx, s);
+    SM_CLEAR_ACTIVE(ctx, s);
+    if (SLOT[s] != NO_STATE) ctx->active[SLOT[s]] = NO_STATE;
+}
+
+// Fire the first enabled row of first..end; true if a transition was taken.
+static bool sm_fire(SM_Context* ctx, uint32_t first, uint32_t end) {
+    uint32_t r, k;
+    for (r = first; r < end; r++) {
+        const SM_Row* row = &ROWS[r];
+        if (!guard(ctx, r)) continue;
+        action(ctx, r);
+        if (row->kind == ROW_DECISION) {
+            if (sm_fire(ctx, row->first, row->last)) return true;
+            continue;
+        }
+        for (k = row->first; k < row->last; k++) {
+            StateId id = OPS[k].state;
+            switch (OPS[k].op) {
+            case OP_EXIT_CHILD:
+                if (ctx->active[CHILD_SLOT[id]] != NO_STATE) sm_exit(ctx, ctx->active[CHILD_SLOT[id]]);
+                break;
+            case OP_EXIT_REGION:
+                if (ctx->active[SLOT[id]] == id) sm_exit(ctx, id);
+                break;
+            case OP_EXIT: sm_exit(ctx, id); break;
+            case OP_START: sm_start(ctx, id); break;
+            default: sm_entry(ctx, id); break;
+            }
+        }
+        if (row->kind == ROW_TERMINATE) ctx->terminated = true;
+        return true;
+    }
+    return false;
+}
+
+static void sm_do(SM_Context* ctx, StateId s) {
+    uint32_t k;
+    on_do_hook(ctx, s);
+    if (sm_fire(ctx, ROW_RANGE[s].first, ROW_RANGE[s].last)) return;
+    on_do(ctx, s);
+    if (KIND[s] == OR) {
+        StateId child = ctx->active[CHILD_SLOT[s]];
+        if (child != NO_STATE) sm_do(ctx, child);
+    } else if (KIND[s] == AND) {
+        // Stop if we are exited OR if any transition fired globally
+        if (!SM_IN_STATE(ctx, s) || ctx->transition_fired) return;
+        for (k = CHILD_RANGE[s].first; k < CHILD_RANGE[s].last; k++) {
+            sm_do(ctx, CHILDREN[k]);
+            if (!SM_IN_STATE(ctx, s) || ctx->transition_fired) return;
+        }
+    }
+}
+
+static void sm_inspect(SM_Context* ctx, StateId s, char* buf, size_t* off, size_t max) {
+    uint32_t k;
+    if (s != 0) safe_append(buf, STATE_NAMES[s], STATE_NAME_LEN[s], off, max);
+    if (KIND[s] == OR) {
+        StateId child = ctx->active[CHILD_SLOT[s]];
+        if (child != NO_STATE) {
+            SM_APPEND(buf, "/", off, max);
+            sm_inspect(ctx, child, buf, off, max);
+        }
+    } else if (KIND[s] == AND) {
+        SM_APPEND(buf, "/[", off, max);
+        for (k = CHILD_RANGE[s].first; k < CHILD_RANGE[s].last; k++) {
+            if (k != CHILD_RANGE[s].first) SM_APPEND(buf, ",", off, max);
+            sm_inspect(ctx, CHILDREN[k], buf, off, max);
+        }
+        SM_APPEND(buf, "]", off, max);
+    }
+}
+%s
+void sm_init(StateMachine* sm) {
+    int i;
+    memset(&sm->ctx, 0, sizeof(sm->ctx));
+    sm->ctx.owner = sm;
+    for (i = 0; i < TOTAL_SLOTS; i++) {
+        sm->ctx.active[i] = NO_STATE;
+        sm->ctx.hist[i] = NO_STATE;
+    }
+    sm->running = true;
+    sm_entry(&sm->ctx, 0);
+}
+void sm_tick(StateMachine* sm) {
+    sm->ctx.transition_fired = false;%s%s
+}
+bool sm_is_running(StateMachine* sm) {
+    return sm->running;
+}
+void sm_get_state_str(StateMachine* sm, char* buffer, size_t max_len) {
+    size_t offset = 0;
+    buffer[0] = '\\0';
+    if (sm->running) sm_inspect(&sm->ctx, 0, buffer, &offset, max_len);
+    else SM_APPEND(buffer, "FINISHED", &offset, max_len);
+}
+%s"""
+
+STEP = """
+    if (sm->running) {
+        sm_do(&sm->ctx, 0);
+        if (sm->ctx.terminated) sm->running = false;
+    }"""
+
+
+def _join(values, per_line=16):
+    values = [str(v) for v in values]
+    if len(values) <= per_line:
+        return ", ".join(values)
+    lines = [", ".join(values[i:i + per_line]) for i in range(0, len(values), per_line)]
+    return "\n    " + ",\n    ".join(lines) + "\n"
+
+def _indent(code, prefix):
+    return "\n".join(prefix + line for line in code.splitlines())
+
+
+class CTableGenerator:
+    """
+    C backend for --runtime table: same public API as CGenerator, but the
+    machine is static tables walked by a generic interpreter.
+    profile is accepted for build_model; the output is generated
+    whole, there are no per-state bodies to time.
+    """
+    BACKEND = "c-table"
+
+    def __init__(self, data, index=None, plans=None, profile=None, instrument=None):
+        self.data = data
+        self.index = index or ModelIndex(data)
+        self.decisions = data.get('decisions', {})
+        self.plans = plans or ModelPlans(self.index, self.decisions)
+        self.tables = MachineTables(self.index, self.plans)
+        self.hooks = data.get('hooks', {})
+        self.trace = trace_buffer_size(data)
+        self.microsteps = microstep_limit(data)
+        self.instrument = CInstrumentation(instrument, self.index, self.plans) if instrument else None
+        self.includes = data.get('includes', '')
+
+    def generate(self, header_name="statemachine.h"):
+        header, source = io.StringIO(), io.StringIO()
+        self.write(header, source, header_name)
+        return header.getvalue(), source.getvalue()
+
+    def write(self, header_sink, source_sink, header_name="statemachine.h"):
+        """Generate the machine and stream header and source to the two file-like sinks."""
+        t = self.tables
+        macros = []
+        for info in self.index:
+            if info.parent:
+                macros.append(f"#define IN_STATE_{info.c_name} SM_IN_STATE(ctx, {info.index})")
+        events = t.events
+        write_template(header_sink, HEADER,
+            t.count, active_set_header(self.index),
+            (event_header(events, event_queue_size(self.data)) if events else "")
+            + (trace_header(self.trace, self.index, self.plans) if self.trace else "")
+            + (self.instrument.header() if self.instrument else "")
+            + (RTC_HEADER % self.microsteps if self.microsteps else ""),
+            t.slots, t.no_state, "uint16_t" if t.state_type_bits == 16 else "uint32_t",
+            self.data.get('context', ''), (EVENT_FIELDS if events else "") + (TRACE_FIELDS if self.trace else "")
+            + (self.instrument.fields() if self.instrument else "") + (RTC_FIELDS if self.microsteps else ""),
+            (EVENT_DECLS if events else "") + (TRACE_DECLS if self.trace else "")
+            + (PROFILE_DECLS if self.instrument else ""), "\n".join(macros))
+
+        write_template(source_sink, SOURCE_TOP, header_name, self.includes)
+        source_sink.write(active_set_source(self.index) + deadline_source(self.plans) + (TRACE_SOURCE if self.trace else "")
+                          + (self.instrument.source() if self.instrument else ""))
+        # C has no empty arrays: pad with one unused entry.
+        rows = [f"{{{r.kind}, {r.state}, {r.first}, {r.last}}}" for r in t.rows] or ["{0, 0, 0, 0}"]
+        ops = [f"{{{op}, {state}}}" for op, state in t.ops] or ["{0, 0}"]
+        source_sink.write(TABLES % (
+            _join(t.parent), _join(t.kind), _join(t.slot), _join(t.child_slot), _join(t.initial),
+            _join("true" if h else "false" for h in t.history),
+            _join(f"{{{a}, {b}}}" for a, b in t.child_range),
+            len(t.children), _join(t.children),
+            _join(f"{{{a}, {b}}}" for a, b in t.row_range),
+            _join((c_str(info.name) for info in self.index), 8),
+            _join(len(info.name.encode()) for info in self.index),
+            len(rows), _join(rows, 6), len(ops), _join(ops, 8)))
+        if events:
+            source_sink.write(EVENT_TABLES % (
+                _join(f"{{{a}, {b}}}" for a, b in t.event_range),
+                len(t.event_rows), _join((f"{{{e}, {a}, {b}}}" for e, a, b in t.event_rows), 8),
+                _join("true" if flag else "false" for flag in t.listening)))
+
+        self._write_user_code(source_sink)
+        self._write_transitions(source_sink)
+        write_template(source_sink, INTERPRETER, EVENT_INTERPRETER if events else "",
+                       (TRACE_TICK if self.trace else "") + (EVENT_DRAIN if events else ""),
+                       run_to_completion(STEP) if self.microsteps else STEP, EVENT_POST if events else "")
+
+    def _write_user_code(self, sink):
+        root = self.index.get(['root'])
+        defaults = {'entry': '// Root Entry', 'do': '// Root Run', 'exit': '// Root Exit'}
+        h_run = trace_hook('do', self.hooks.get('do', self.hooks.get('run', '')))
+        for func, key, hook in (('on_entry', 'entry', trace_hook('entry', self.hooks.get('entry', ''))),
+                                ('on_exit', 'exit', trace_hook('exit', self.hooks.get('exit', ''))),
+                                ('on_do_hook', None, h_run), ('on_do', 'do', '')):
+            arms = []
+            if key:
+                for info in self.index:
+                    code = info.data.get(key, info.data.get('run', '')) if key == 'do' else info.data.get(key, '')
+                    if info is root and key not in info.data and not (key == 'do' and 'run' in info.data):
+                        code = defaults[key]
+                    if code and code.strip():
+                        if self.instrument:
+                            code = self.instrument.timed(info.index, key, code)
+                        arms.append((info.index, code))
+                arms = [f"    {' '.join(f'case {s}:' for s in states)} {{\n{_indent(code, '        ')}\n        break;\n    }}"
+                        for states, code in merge_arms(arms)]
+            if self.instrument and func in ('on_entry', 'on_exit'):
+                count = self.instrument.entered if func == 'on_entry' else self.instrument.exited
+                hook = count("s") + ("\n    " + hook if hook else "")
+            if self.microsteps and func in ('on_do_hook', 'on_do') and (hook or arms):
+                # Run to completion: do code runs in the first microstep of a tick only.
+                hook = "if (ctx->microsteps != 0) return;" + ("\n    " + hook if hook else "")
+            sink.write(USER_FUNC.format(name=func, preamble=_preamble(hook, *arms), hook=hook, arms="\n".join(arms)))
+
+    def _write_transitions(self, sink):
+        guards, actions = [], []
+        hook = self.hooks.get('transition', '')
+        for row in self.tables.rows:
+            plan = row.plan
+            if plan.guard is not True:
+                guard = "false" if plan.guard is False else str(plan.guard)
+                guards.append((row.number, guard))
+            body = []
+            if row.kind != ROW_DECISION:
+                used = referenced_vars(hook, plan.action)
+                if 't_src' in used:
+                    body.append(f"const char* t_src = {c_str(plan.src_str)}; (void)t_src;")
+                if 't_dst' in used:
+                    body.append(f"const char* t_dst = {c_str(plan.dst_str)}; (void)t_dst;")
+                if hook:
+                    body.extend(trace_hook('transition', hook, "").splitlines())
+            if body or plan.action or (self.trace and row.kind != ROW_DECISION) or self.instrument:
+                body.append("ctx->transition_fired = true;")
+                if self.trace and row.kind != ROW_DECISION:
+                    body.append(trace_call(plan))
+                if self.instrument:
+                    body.append(self.instrument.fire(plan))
+                if plan.action:
+                    body.extend(plan.action.splitlines())
+                body.append("break;")
+                actions.append((row.number, "\n".join("        " + line for line in body)))
+        guards = [f"    {' '.join(f'case {r}:' for r in rows)} return ({guard});" for rows, guard in merge_arms(guards)]
+        actions = [f"    {' '.join(f'case {r}:' for r in rows)} {{\n{body}\n    }}" for rows, body in merge_arms(actions)]
+        sink.write(GUARD_FUNC.format(preamble=_preamble(*guards), arms="\n".join(guards)))
+        sink.write(ACTION_FUNC.format(preamble=_preamble(*actions), arms="\n".join(actions)))
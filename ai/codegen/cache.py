@@ -0,0 +1,43 @@
+import filecmp
+import os
+
+
+def atomic_write(path, content):
+    # Write next to the target and rename, so concurrent batch jobs never see half a file.
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'wb' if isinstance(content, bytes) else 'w') as f:
+        f.write(content)
+    os.replace(tmp, path)
+
+
+class OutputFile:
+    """
+    Streams a generated file into a temp file next to path. On a clean exit
+    the temp file replaces path only if the content differs, so unchanged
+    outputs keep their mtime and never appear half-written.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.tmp = f"{path}.{os.getpid()}.tmp"
+        self.written = False
+
+    def __enter__(self):
+        self.file = open(self.tmp, 'w')
+        return self.file
+
+    def __exit__(self, exc_type, exc, tb):
+        self.file.close()
+        if exc_type is None and not (os.path.exists(self.path) and filecmp.cmp(self.tmp, self.path, shallow=False)):
+            os.replace(self.tmp, self.path)
+            self.written = True
+        else:
+            os.remove(self.tmp)
+        return False
+
+
+def write_if_changed(path, content):
+    """Write content to path unless the file already holds exactly that. Returns True if written."""
+    out = OutputFile(path)
+    with out as f:
+        f.write(content)
+    return out.written
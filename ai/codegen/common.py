@@ -1,6 +1,93 @@
-import sys
+import io
 import re
 
+from .stream import Spool
+
+# Default capacity of the generated event queue; a model may set 'event_queue'.
+EVENT_QUEUE_SIZE = 16
+EVENT_NAME = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+def event_queue_size(data):
+    return data.get('event_queue', EVENT_QUEUE_SIZE)
+
+# Microsteps a run-to-completion tick takes at most for 'run_to_completion: true'.
+MICROSTEPS = 64
+
+def microstep_limit(data):
+    """Microsteps one tick may run (see 'run_to_completion'); 0 when a tick takes a single step."""
+    limit = data.get('run_to_completion', False)
+    return MICROSTEPS if limit is True else limit or 0
+
+def trace_buffer_size(data):
+    """Records in the generated transition trace (see trace.py); 0 when the model does not ask for one."""
+    return data.get('trace_buffer', 0)
+
+# `time > C`, `time >= C` (or `C < time`, `C <= time`), optionally parenthesised.
+_NUMBER = r'(\d+(?:\.\d*)?(?:[eE][+-]?\d+)?)'
+_TIME_BOUNDS = (re.compile(r'^\(?\s*time\s*(>=?)\s*' + _NUMBER + r'\s*\)?$'),
+                re.compile(r'^\(?\s*' + _NUMBER + r'\s*(<=?)\s*time\s*\)?$'))
+
+def time_bound(guard):
+    """
+    (seconds, strict) when guard is a time comparison or an && chain
+    containing one: the state must have been active for the seconds, and
+    for more than that if strict (`time > C`), before guard can hold.
+    Otherwise None. Bounds compare as tuples, the later one being larger.
+    """
+    if not isinstance(guard, str) or '||' in guard:
+        return None
+    bounds = []
+    for part in guard.split('&&'):
+        part = part.strip()
+        if part.count('(') != part.count(')'):
+            continue
+        for pattern in _TIME_BOUNDS:
+            match = pattern.match(part)
+            if match:
+                number, op = (match.group(2), match.group(1)) if pattern is _TIME_BOUNDS[0] else match.groups()
+                bounds.append((float(number), op in ('>', '<')))
+    return max(bounds) if bounds else None
+
+# Hooks are kept when the compile-time trace level is at least their level:
+# C `-DSM_TRACE_LEVEL=N`, Rust `--cfg sm_trace_level="N"`. Unset means MAX_TRACE_LEVEL.
+TRACE_LEVELS = {'transition': 1, 'entry': 2, 'exit': 2, 'do': 3}
+MAX_TRACE_LEVEL = 3
+
+_PREAMBLE_VAR = re.compile(r'\b(state_name|state_full_name|time|t_src|t_dst)\b')
+
+def referenced_vars(*code):
+    """Which of the variables generated code provides to user code the given code mentions."""
+    found = set()
+    for piece in code:
+        if piece:
+            found.update(_PREAMBLE_VAR.findall(str(piece)))
+    return found
+
+# Preamble variables a decision's guards may read; its shared function takes them as arguments.
+DECISION_VARS = ('time', 'state_name', 'state_full_name')
+
+def decision_params(routes):
+    """The DECISION_VARS the guards of a flattened decision (ModelPlans.routes) mention."""
+    used = referenced_vars(*(route['guard'] for route in routes))
+    return [var for var in DECISION_VARS if var in used]
+
+def preamble(lines, info, *code, indent="    ", timer=None, state_id=None):
+    """
+    The lines of a preamble table whose variable the code mentions, for state info.
+    A line whose variable is None is always kept. timer is the state's timer
+    slot in a compact context (layout.py), by default its id; state_id is an
+    expression for the id in code shared by machine instances (machines.py).
+    """
+    used = referenced_vars(*code)
+    state_id = info.index if state_id is None else state_id
+    return ("\n" + indent).join(line.format(short_name=info.path[-1], display_name=state_path(info), state_id=state_id,
+                                             timer=state_id if timer is None else timer)
+                                 for var, line in lines if var is None or var in used)
+
+def state_path(info):
+    """Display path of a state: '/' for the root, '/a/b' below it."""
+    return "/" + "/".join(info.path[1:]) if info.parent else "/"
+
 def flatten_name(path, separator="_"):
     return separator.join(path)
 
@@ -9,6 +96,40 @@ def get_graph_id(path):
     safe_id = re.sub(r'[^a-zA-Z0-9_]', '_', raw_id)
     return safe_id
 
+def walk_nested(root):
+    """
+    Run a recursive visitor without growing the Python call stack, so models
+    nested hundreds of levels deep cannot hit the recursion limit.
+
+    The visitor is a generator: instead of calling itself it yields the
+    generator for each sub-visit and receives that visit's return value.
+    An exception in a sub-visit is thrown into its parent at the yield, so
+    the visitor's own try/except blocks still see it.
+    """
+    stack = [root]
+    value = None
+    error = None
+    while stack:
+        try:
+            if error is not None:
+                child = stack[-1].throw(error)
+                error = None
+            else:
+                child = stack[-1].send(value)
+        except StopIteration as stop:
+            stack.pop()
+            value = stop.value
+            continue
+        except Exception as e:
+            stack.pop()
+            if not stack:
+                raise
+            error = e
+            continue
+        stack.append(child)
+        value = None
+    return value
+
 def resolve_target_path(current_path, target_str):
     if not target_str: return current_path 
 
@@ -39,19 +160,6 @@ def resolve_target_path(current_path, target_str):
     parent_scope = current_path[:-1]
     return parent_scope + target_str.split("/")
 
-def resolve_state_data(root_data, path_parts):
-    current = {'states': root_data.get('states', {}), 'initial': root_data.get('initial')}
-    if path_parts == ['root']:
-        return root_data
-    
-    start_idx = 1 if (path_parts and path_parts[0] == 'root') else 0
-    
-    for part in path_parts[start_idx:]:
-        if 'states' not in current or part not in current['states']:
-            return None
-        current = current['states'][part]
-    return current
-
 def parse_fork_target(target_str):
     if target_str is None:
         return None, None
@@ -98,29 +206,25 @@ def get_entry_sequence(source_path, target_path, func_formatter):
     return entries
 
 # --- VISUALIZATION ---
-def find_composites(name_path, data, result_set):
-    my_id = get_graph_id(name_path)
-    if 'states' in data:
-        result_set.add(my_id)
-        for child_name, child_data in data['states'].items():
-            find_composites(name_path + [child_name], child_data, result_set)
-
-def generate_dot_recursive(name_path, data, node_lines, edge_lines, composite_ids, decisions):
-    my_id = get_graph_id(name_path)
+def visit_dot_state(info, node_lines, edge_lines, composite_ids, plans, heat=None):
+    # Visitor for walk_nested: 'yield visit_dot_state(...)' visits a child.
+    # heat: an instrument.Heatmap to shade states and weight edges with, or None.
+    name_path = info.path
+    data = info.data
+    my_id = info.graph_id
     is_composite = 'states' in data
     indent = "    " * len(name_path)
 
     if is_composite:
         node_lines.append(f"{indent}subgraph cluster_{my_id} {{")
-        node_lines.append(f"{indent}    label = \"{name_path[-1]}\";")
+        node_lines.append(f"{indent}    label = \"{heat.state_label(info) if heat else name_path[-1]}\";")
         
         # CHANGED: 'parallel' -> 'orthogonal'
         if data.get('orthogonal', False):
              node_lines.append(f"{indent}    style=dashed; color=black; penwidth=1.5; node [style=filled, fillcolor=white];")
              node_lines.append(f"{indent}    {my_id}_start [shape=point, width=0.15];")
-             for child_name, child_data in data['states'].items():
-                 child_path = name_path + [child_name]
-                 child_id = get_graph_id(child_path)
+             for child in info.children:
+                 child_id = child.graph_id
                  tgt = f"{child_id}_start" if child_id in composite_ids else child_id
                  lhead = f"lhead=cluster_{child_id}" if child_id in composite_ids else ""
                  node_lines.append(f"{indent}    {my_id}_start -> {tgt} [style=dashed, {lhead}];")
@@ -129,15 +233,15 @@ def generate_dot_recursive(name_path, data, node_lines, edge_lines, composite_id
              if data.get('history', False):
                  node_lines.append(f"{indent}    {my_id}_hist [shape=circle, label=\"H\", width=0.3];")
              
-             init_child_path = name_path + [data['initial']]
+             init_child_path = name_path + (data['initial'],)
              init_child_id = get_graph_id(init_child_path)
              tgt = f"{init_child_id}_start" if init_child_id in composite_ids else init_child_id
              lhead = f"lhead=cluster_{init_child_id}" if init_child_id in composite_ids else ""
              node_lines.append(f"{indent}    {my_id}_start [shape=point, width=0.15];")
              node_lines.append(f"{indent}    {my_id}_start -> {tgt} [{lhead}];")
 
-        for child_name, child_data in data['states'].items():
-            generate_dot_recursive(name_path + [child_name], child_data, node_lines, edge_lines, composite_ids, decisions)
+        for child in info.children:
+            yield visit_dot_state(child, node_lines, edge_lines, composite_ids, plans, heat)
         node_lines.append(f"{indent}}}")
     else:
         label = name_path[-1]
@@ -147,38 +251,37 @@ def generate_dot_recursive(name_path, data, node_lines, edge_lines, composite_id
             shape = "diamond"
             style = "filled"
             label = "" 
-        node_lines.append(f"{indent}{my_id} [label=\"{label}\", shape={shape}, style=\"{style}\", fillcolor=white];")
+        fill = "white"
+        if heat:
+            label = heat.state_label(info)
+            fill = f'"{heat.state_fill(info)}"'
+        node_lines.append(f"{indent}{my_id} [label=\"{label}\", shape={shape}, style=\"{style}\", fillcolor={fill}];")
 
-    for t in data.get('transitions', []):
-        target_str = t.get('to')
-        
-        if target_str is None or target_str == "null":
+    for plan in plans.for_state(name_path):
+        if plan.terminate:
             # Termination node visualization could go here
             continue
 
-        base_str, _ = parse_fork_target(target_str)
-        
-        is_decision = target_str in decisions
-        target_path = resolve_target_path(name_path, base_str)
-        target_id = get_graph_id(target_path)
-        
         src = f"{my_id}_start" if is_composite else my_id
         ltail = f"ltail=cluster_{my_id}" if is_composite else ""
         
-        if is_decision:
-            tgt = get_graph_id(['root', target_str]) if target_str in decisions else target_str
+        if plan.kind == 'decision':
+            tgt = get_graph_id(['root', plan.decision])
             lhead = ""
         else:
+            target_id = get_graph_id(plan.target_path)
             tgt = f"{target_id}_start" if target_id in composite_ids else target_id
             lhead = f"lhead=cluster_{target_id}" if target_id in composite_ids else ""
 
         attrs = [x for x in [ltail, lhead] if x]
         
         # CHANGED: Visualizing [Guard] / Action
-        raw_guard = t.get('guard', '')
-        raw_action = t.get('action', '')
+        raw_guard = plan.guard
+        raw_action = plan.action
         
         label_parts = []
+        if plan.event is not None:
+            label_parts.append(str(plan.event))
         if raw_guard and raw_guard != True:
             label_parts.append(f"[{raw_guard}]")
         if raw_action:
@@ -188,17 +291,32 @@ def generate_dot_recursive(name_path, data, node_lines, edge_lines, composite_id
             label_parts.append(f"/ {act_text}")
             
         safe_label = " ".join(label_parts).replace('"', '\\"')
+        if heat:
+            fires, heat_attrs = heat.edge(plan)
+            safe_label += fires
+            attrs += heat_attrs
         
         attrs.append(f'label="{safe_label}"')
         attrs.append('fontsize=10')
         edge_lines.append(f"{src} -> {tgt} [{', '.join(attrs)}];")
 
-def generate_dot(root_data, decisions):
-    composite_ids = set()
-    find_composites(['root'], root_data, composite_ids)
-    node_lines = []
-    edge_lines = []
-    generate_dot_recursive(['root'], root_data, node_lines, edge_lines, composite_ids, decisions)
+def generate_dot(root_data, decisions, index=None, plans=None, heat=None):
+    sink = io.StringIO()
+    write_dot(sink, root_data, decisions, index, plans, heat)
+    return sink.getvalue()
+
+def write_dot(sink, root_data, decisions, index=None, plans=None, heat=None):
+    """Stream the Graphviz rendering of the model to the file-like sink, shaded by heat if given."""
+    if index is None:
+        from .model import ModelIndex
+        index = ModelIndex(root_data)
+    if plans is None:
+        from .plan import ModelPlans
+        plans = ModelPlans(index, decisions)
+    composite_ids = {s.graph_id for s in index if s.is_composite}
+    node_lines = Spool("\n")
+    edge_lines = Spool("\n")
+    walk_nested(visit_dot_state(index.get(['root']), node_lines, edge_lines, composite_ids, plans, heat))
     
     for name, transitions in decisions.items():
         dec_id = get_graph_id(['root', name])
@@ -221,10 +339,12 @@ def generate_dot(root_data, decisions):
             if lhead: attr += f", {lhead}"
             edge_lines.append(f"    {dec_id} -> {tgt_node} [{attr}];")
 
-    lines = ["digraph StateMachine {", "    compound=true; fontname=\"Arial\"; node [fontname=\"Arial\"]; edge [fontname=\"Arial\"];"]
-    lines.append("    // --- Structures ---")
-    lines.extend(node_lines)
-    lines.append("    // --- Transitions ---")
-    lines.extend(edge_lines)
-    lines.append("}")
-    return "\n".join(lines)
+    sink.write("digraph StateMachine {\n")
+    sink.write("    compound=true; fontname=\"Arial\"; node [fontname=\"Arial\"]; edge [fontname=\"Arial\"];\n")
+    sink.write("    // --- Structures ---")
+    for section, title in ((node_lines, "\n    // --- Transitions ---"), (edge_lines, "\n}")):
+        if len(section):
+            sink.write("\n")
+            section.copy_to(sink)
+        section.close()
+        sink.write(title)
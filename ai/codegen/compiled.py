@@ -0,0 +1,97 @@
+"""
+Compiled model artifact: a validated model stored next to its YAML file as
+<name>.smc, so repeat builds skip YAML parsing and validation.
+
+The file is gzip-compressed JSON (readable from the GUI with zlib + JSON.parse):
+    {"format": 1, "generator": <hash of the codegen sources>,
+     "source_sha256": <hash of the YAML bytes>, "states": [[path, node], ...]}
+States are listed flat in pre-order (the ModelIndex order); node is the
+state's YAML mapping with 'states' emptied, the root node holds the model's
+top-level keys. Flat storage keeps arbitrarily deep models loadable.
+An artifact written by another version of the generator is ignored, since
+that version may have validated the model against different rules.
+"""
+import functools
+import gzip
+import hashlib
+import json
+import os
+
+from .cache import atomic_write
+from .model import ModelIndex
+
+COMPILED_SUFFIX = ".smc"
+FORMAT = 1
+
+
+def compiled_path(yaml_path):
+    return os.path.splitext(yaml_path)[0] + COMPILED_SUFFIX
+
+@functools.cache
+def generator_hash():
+    """Hash of this package's sources: the validation rules an artifact was checked against."""
+    h = hashlib.sha256()
+    package = os.path.dirname(os.path.abspath(__file__))
+    for name in sorted(os.listdir(package)):
+        if name.endswith('.py'):
+            h.update(name.encode('utf-8'))
+            with open(os.path.join(package, name), 'rb') as f:
+                h.update(f.read())
+    return h.hexdigest()
+
+def source_hash(yaml_path):
+    h = hashlib.sha256()
+    with open(yaml_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def save_compiled(yaml_path, index, digest=None):
+    """
+    Write the artifact for a model that has passed validation. Returns False
+    (and writes nothing) if the model does not survive a JSON round trip,
+    e.g. non-string state names.
+    """
+    states = []
+    for info in index:
+        node = {k: v for k, v in info.data.items() if k != 'states'}
+        if info.is_composite:
+            node['states'] = {}
+        states.append([list(info.path), node])
+    payload = {'format': FORMAT, 'generator': generator_hash(),
+               'source_sha256': digest or source_hash(yaml_path), 'states': states}
+    try:
+        raw = json.dumps(payload, separators=(',', ':'))
+    except (TypeError, ValueError):
+        return False
+    if json.loads(raw) != payload:
+        return False
+    atomic_write(compiled_path(yaml_path), gzip.compress(raw.encode('utf-8'), compresslevel=6))
+    return True
+
+def load_compiled(yaml_path, digest=None):
+    """
+    (data, index) from the artifact of yaml_path, or None if there is none or
+    it does not match the YAML file's current content or this generator.
+    """
+    path = compiled_path(yaml_path)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            payload = json.loads(gzip.decompress(f.read()))
+    except (OSError, EOFError, ValueError):
+        return None
+    if (payload.get('format') != FORMAT or payload.get('generator') != generator_hash()
+            or payload.get('source_sha256') != (digest or source_hash(yaml_path))):
+        return None
+
+    # Pre-order guarantees every parent is rebuilt before its children.
+    nodes = {}
+    for path, node in payload['states']:
+        path = tuple(path)
+        nodes[path] = node
+        if len(path) > 1:
+            nodes[path[:-1]]['states'][path[-1]] = node
+    data = nodes[('root',)]
+    return data, ModelIndex(data)
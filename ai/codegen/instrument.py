@@ -0,0 +1,143 @@
+"""
+Instrumented builds (sm-builder --instrument [counts|timing]).
+
+The generated context counts, per state, how often it was entered and how
+long it was active (from state_timers, in the unit of ctx.now), and per
+transition plan how often it fired. With 'timing' it also keeps a log2
+histogram of the cycles each state's user entry/do/exit code took.
+
+export_profile / sm_export_profile flatten the counters into one array of
+64-bit words, write_profile / sm_write_profile dump that array in the
+writer's byte order:
+
+    magic, format, model id, states, transitions, buckets
+    entries[states]
+    dwell[states]                      f64 bit patterns
+    fires[transitions]                 indexed by TransitionPlan number
+    cycles[states][3][buckets]         entry, do, exit; only with timing
+
+Bucket b counts runs that took fewer than 2**b cycles (and at least
+2**(b-1)); the last bucket also takes everything longer. The model id is the
+one trace.py uses.
+"""
+import struct
+
+from .common import state_path
+from .trace import model_id
+
+MODES = ('counts', 'timing')
+MAGIC = 0x46504D53
+FORMAT = 1
+HEADER_WORDS = 6
+BUCKETS = 32
+USER_KINDS = ('entry', 'do', 'exit')
+
+
+class ProfileError(Exception):
+    pass
+
+
+def profile_buckets(mode):
+    return BUCKETS if mode == 'timing' else 0
+
+def user_slot(state_id, kind):
+    """Row of a state's user code in the cycle histograms."""
+    return 3 * state_id + USER_KINDS.index(kind)
+
+
+class Profile:
+    """A decoded export."""
+    def __init__(self, model, entries, dwell, fires, cycles, buckets):
+        self.model = model
+        self.entries = entries
+        self.dwell = dwell
+        self.fires = fires
+        self.cycles = cycles
+        self.buckets = buckets
+
+    def histogram(self, state_id, kind):
+        if not self.buckets:
+            return None
+        start = user_slot(state_id, kind) * self.buckets
+        return self.cycles[start:start + self.buckets]
+
+
+def read_profile(raw):
+    for order in '<>':
+        if len(raw) >= 8 * HEADER_WORDS and struct.unpack_from(order + 'Q', raw)[0] == MAGIC:
+            break
+    else:
+        raise ProfileError("not a state machine profile (bad magic)")
+    _, fmt, model, states, transitions, buckets = struct.unpack_from(f"{order}{HEADER_WORDS}Q", raw)
+    if fmt != FORMAT:
+        raise ProfileError(f"unsupported profile format {fmt}")
+    words = HEADER_WORDS + 2 * states + transitions + 3 * states * buckets
+    if len(raw) < 8 * words:
+        raise ProfileError(f"truncated profile: {words} words announced, {len(raw) // 8} present")
+    offset = 8 * HEADER_WORDS
+    entries = list(struct.unpack_from(f"{order}{states}Q", raw, offset))
+    offset += 8 * states
+    dwell = list(struct.unpack_from(f"{order}{states}d", raw, offset))
+    offset += 8 * states
+    fires = list(struct.unpack_from(f"{order}{transitions}Q", raw, offset))
+    offset += 8 * transitions
+    cycles = list(struct.unpack_from(f"{order}{3 * states * buckets}Q", raw, offset))
+    return Profile(model, entries, dwell, fires, cycles, buckets)
+
+def load_profile(path, index, plans):
+    """Read an exported profile and check it belongs to the model."""
+    with open(path, 'rb') as f:
+        profile = read_profile(f.read())
+    expected = model_id(index, plans)
+    if profile.model != expected:
+        raise ProfileError(f"profile was written by another model (id {profile.model:08x}, expected {expected:08x})")
+    return profile
+
+def _percentile(hist, fraction):
+    # Upper bound (cycles) of the bucket holding the given fraction of runs.
+    total = sum(hist)
+    seen = 0
+    for bucket, count in enumerate(hist):
+        seen += count
+        if count and seen >= fraction * total:
+            return 1 << bucket
+    return 0
+
+
+class Heatmap:
+    """DOT styling from a profile: leaves shaded by dwell time, edges weighted by fire count."""
+    def __init__(self, profile):
+        self.profile = profile
+        self.max_dwell = max(profile.dwell[1:], default=0.0) or 1.0
+        self.max_fires = max(profile.fires, default=0) or 1
+
+    def state_label(self, info):
+        p = self.profile
+        label = f"{info.path[-1]}\\n{p.entries[info.index]}x, {p.dwell[info.index]:.3g}"
+        for kind in USER_KINDS:
+            hist = p.histogram(info.index, kind)
+            if hist and sum(hist):
+                label += f"\\n{kind} p50<{_percentile(hist, 0.5)} p99<{_percentile(hist, 0.99)}"
+        return label
+
+    def state_fill(self, info):
+        share = min(self.profile.dwell[info.index] / self.max_dwell, 1.0)
+        return f"0.000 {share:.3f} 1.000"
+
+    def edge(self, plan):
+        """(label suffix, extra attributes) for the edge drawn for plan."""
+        fires = self.profile.fires[plan.number] if plan.number < len(self.profile.fires) else 0
+        share = fires / self.max_fires
+        return f" ({fires})", [f"penwidth={1.0 + 4.0 * share:.2f}", f'color="0.000 {share:.3f} {0.3 + 0.7 * share:.3f}"']
+
+
+def format_profile(profile, index, plans, top=10):
+    """Plain-text summary: states by dwell time and transitions by fire count."""
+    lines = [f"{'DWELL':>12} {'ENTRIES':>9}  STATE"]
+    for info in sorted(index, key=lambda i: -profile.dwell[i.index])[:top]:
+        lines.append(f"{profile.dwell[info.index]:>12.6g} {profile.entries[info.index]:>9}  {state_path(info)}")
+    lines.append(f"{'FIRES':>12}            TRANSITION")
+    for plan in sorted(plans.all, key=lambda p: -profile.fires[p.number])[:top]:
+        if profile.fires[plan.number]:
+            lines.append(f"{profile.fires[plan.number]:>12}            #{plan.number} {plan.src_str} -> {plan.dst_str}")
+    return "\n".join(lines)
@@ -0,0 +1,96 @@
+"""
+Compact context layout for the pointer runtime (sm-builder --compact).
+
+The default pointer Context keeps, for every OR composite, the active
+child's do and exit functions, its history entry and (with events) its event
+function as function pointers, two more pointers per orthogonal region, and
+one timer per state. With --compact it keeps instead
+
+    active_<composite>   number of the active child, 1-based, 0 for none
+    hist_<composite>     child number to resume, history composites only
+    state_timers[TIMERS] timers of the states whose code reads `time`
+
+with the child numbers in the smallest unsigned type that holds the
+composite's fan-out. Whether a region is active is read from the
+active-state bitset. '--compact ticks' also makes `now` and the timers u32
+tick counts instead of f64 seconds; time in state is a wrapping
+difference, so the counter may overflow.
+"""
+from .common import referenced_vars
+
+MODES = ('layout', 'ticks')
+POINTER_BYTES = 8
+
+
+def _plan_code(plan):
+    # Guard and action of a plan and of the branches it can take.
+    yield plan.guard
+    yield plan.action
+    for branch in plan.branches:
+        yield from _plan_code(branch)
+
+
+class ContextLayout:
+    """Per-state decisions of the compact layout, and its size next to the default one."""
+    def __init__(self, index, plans, hooks, mode, all_timers=False):
+        self.index = index
+        self.mode = mode
+        self.ticks = mode == 'ticks'
+        self.composites = [info for info in index if info.is_composite and not info.is_orthogonal]
+        self.regions = [child for info in index if info.is_orthogonal for child in info.children]
+        if all_timers or 'time' in referenced_vars(*hooks.values()):
+            timed = list(index)
+        else:
+            timed = [info for info in index if self._reads_time(info, plans)]
+        # Timer slot per state id, for the states that keep one.
+        self.timers = {info.index: slot for slot, info in enumerate(timed)}
+
+    @staticmethod
+    def _reads_time(info, plans):
+        code = [info.data.get(key) for key in ('entry', 'do', 'run', 'exit')]
+        for plan in plans.for_state(info.path):
+            code.extend(_plan_code(plan))
+        return 'time' in referenced_vars(*code)
+
+    def timer(self, info):
+        """The state's timer slot, None when nothing reads its time."""
+        return self.timers.get(info.index)
+
+    def timed_bound(self, after, strict):
+        """
+        A ModelPlans.timed() bound as the TIMED table stores it; with ticks the
+        whole ticks that must pass and whether one more must.
+        """
+        if not self.ticks:
+            return after, strict
+        whole = int(after)
+        return whole, strict or whole != after
+
+    @staticmethod
+    def child_number(info):
+        """Value of the parent's active_/hist_ field while info is its active child."""
+        return info.parent.children.index(info) + 1
+
+    @staticmethod
+    def id_bits(info):
+        """Bits of the child number field of an OR composite."""
+        fan_out = len(info.children)
+        return 8 if fan_out < 1 << 8 else 16 if fan_out < 1 << 16 else 32
+
+    def sizes(self, events):
+        """
+        (default, compact) bytes of the fields the layout changes, hierarchy
+        and time, added up field by field: an estimate that leaves out padding,
+        user fields and the other members. The real size is CONTEXT_SIZE.
+        """
+        pointers = len(self.composites) * (4 if events else 3) + len(self.regions) * 2
+        default = pointers * POINTER_BYTES + 8 * (len(self.index) + 1)
+        ids = sum(self.id_bits(info) // 8 * (2 if info.data.get('history', False) else 1) for info in self.composites)
+        compact = ids + (4 if self.ticks else 8) * (len(self.timers) + 1)
+        return default, compact
+
+    def report(self, events):
+        default, compact = self.sizes(events)
+        return (f"Compact context: hierarchy and timers take about {compact} bytes instead of {default} "
+                f"({len(self.timers)} of {len(self.index)} states keep a timer; estimate without padding and "
+                f"user fields, sm-bench.py --tick reports the real size).")
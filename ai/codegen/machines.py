@@ -0,0 +1,179 @@
+"""
+Reusable sub-machines ('machines:' at the model root).
+
+A machine is a composite defined once and instantiated by every state that
+says `use: <machine>`:
+
+    machines:
+      retry:
+        initial: wait
+        states:
+          wait:
+            transitions: [{after: 1.0, to: attempt}]
+          attempt: ...
+    states:
+      link_a: {use: retry, transitions: [...]}
+      link_b: {use: retry}
+
+expand_machines merges the definition into each using state when the model
+is loaded, so the index, the plans and every runtime see ordinary
+composites; keys of the using state win. The states below a using state are
+one instance of the machine. Pre-order ids keep an instance contiguous, so
+its states have the ids MACHINE_<name>[k] + offset, with the same offsets in
+every instance k. The pointer runtimes use that (Instances) to emit the
+functions of a machine's states once, taking the instance number, instead
+of once per instance.
+
+For the instances to be interchangeable, a machine's transitions stay inside
+it: in every instance their targets resolve to states below the using
+state (relative paths do, absolute ones name a single instance), and none
+terminates the machine. Machines do not use other machines.
+"""
+from .common import resolve_target_path, parse_fork_target, EVENT_NAME
+from .plan import flatten_decisions, decision_cycle
+
+# Keys of a using state that would make its instance differ from the others.
+DEFINITION_KEYS = ('states', 'initial', 'history', 'orthogonal')
+
+
+def expand_machines(data):
+    """Merge each used machine into the states using it, in place. Unknown machines are left to validation."""
+    machines = data.get('machines') if isinstance(data, dict) else None
+    if not isinstance(machines, dict) or not isinstance(data.get('states'), dict):
+        return data
+    pending = [data['states']]
+    while pending:
+        states = pending.pop()
+        for name, state in states.items():
+            if not isinstance(state, dict):
+                continue
+            machine = machines.get(state.get('use'))
+            if isinstance(machine, dict) and not any(key in state for key in DEFINITION_KEYS):
+                states[name] = {**machine, **state}
+            elif isinstance(state.get('states'), dict):
+                pending.append(state['states'])
+    return data
+
+def _uses(states):
+    # (path below states, machine name) of every 'use' in a tree of states.
+    pending = [((name,), state) for name, state in states.items()]
+    while pending:
+        path, state = pending.pop()
+        if not isinstance(state, dict):
+            continue
+        if 'use' in state:
+            yield path, state['use']
+        for name, child in (state.get('states') or {}).items():
+            pending.append((path + (name,), child))
+
+def machine_errors(data, index):
+    """Validation messages for the machine definitions and their instances."""
+    errors = []
+    machines = data.get('machines', {})
+    if not isinstance(machines, dict):
+        return ["'machines' must map machine names to composite states."]
+    for name, machine in machines.items():
+        if not (isinstance(name, str) and EVENT_NAME.match(name)):
+            errors.append(f"Machine '{name}': the name is not a valid identifier.")
+        elif not (isinstance(machine, dict) and isinstance(machine.get('states'), dict)):
+            errors.append(f"Machine '{name}' is not a composite state (it needs 'states').")
+        else:
+            for path, used in _uses(machine['states']):
+                errors.append(f"Machine '{name}', state '{'/'.join(path)}': uses machine '{used}'; "
+                              f"machines cannot use other machines.")
+
+    routes = None if decision_cycle(data.get('decisions', {})) else flatten_decisions(data.get('decisions', {}))
+    escapes = []
+    for info in index:
+        used = info.data.get('use')
+        if used is None:
+            continue
+        where = f"State '/{'/'.join(info.path[1:])}'"
+        if used not in machines:
+            errors.append(f"{where} uses machine '{used}', which is not defined.")
+            continue
+        if not isinstance(machines[used], dict):
+            continue
+        if info.data.get('states') is not machines[used].get('states'):
+            # expand_machines left the state alone.
+            key = next(key for key in DEFINITION_KEYS if key in info.data)
+            errors.append(f"{where} uses machine '{used}': '{key}' belongs to the machine definition.")
+            continue
+        # Every instance: an absolute target can stay inside one and leave the others.
+        if routes is not None:
+            escapes.extend(e for e in _escapes(used, info, index, data.get('decisions', {}), routes) if e not in escapes)
+    return errors + escapes
+
+def _escapes(machine, user, index, decisions, routes):
+    # Transitions of one instance that leave it or terminate.
+    start = user.index + 1
+    end = index.subtree_ends()[user.index]
+    for info in index.states[start:end + 1]:
+        where = f"Machine '{machine}', state '{'/'.join(info.path[len(user.path):])}'"
+        for i, t in enumerate(info.data.get('transitions', [])):
+            target = t.get('to', t.get('transfer_to'))
+            targets = [route['to'] for route in routes[target]] if target in decisions else [target]
+            for to in targets:
+                if to is None or to == "null" or to == "":
+                    yield f"{where}, transition #{i+1}: terminates the machine; transitions inside a machine must stay inside it."
+                    continue
+                path = tuple(resolve_target_path(list(info.path), parse_fork_target(to)[0]))
+                if len(path) <= len(user.path) or path[:len(user.path)] != user.path:
+                    yield f"{where}, transition #{i+1}: target '{to}' leaves the machine; transitions inside a machine must stay inside it."
+
+
+class Instances:
+    """Where the instances of each machine are in the index, and how shared code names their states."""
+    def __init__(self, index):
+        self.index = index
+        self.users = {}  # machine -> the states using it, by id
+        for info in index:
+            if info.parent is not None and 'use' in info.data:
+                self.users.setdefault(info.data['use'], []).append(info)
+        self.number = {}  # using state id -> instance number
+        self.owner = {}  # state id -> (machine, instance number, using state), for the states of instances
+        ends = index.subtree_ends()
+        for machine, users in self.users.items():
+            for k, user in enumerate(users):
+                self.number[user.index] = k
+                for state_id in range(user.index + 1, ends[user.index] + 1):
+                    self.owner[state_id] = (machine, k, user)
+
+    def __bool__(self):
+        return bool(self.users)
+
+    def of(self, info):
+        """(machine, instance number, using state) for a state of an instance, else None."""
+        return self.owner.get(info.index)
+
+    def using(self, info):
+        """(machine, instance number) when info uses a machine, else None."""
+        k = self.number.get(info.index)
+        return None if k is None else (info.data['use'], k)
+
+    def is_first(self, info):
+        """True for the states of each machine's first instance, the ones shared code is generated from."""
+        owner = self.of(info)
+        return owner is not None and owner[1] == 0
+
+    def shared_name(self, info):
+        """Name part of the shared functions of a state of an instance, or of a using state's children."""
+        owner = self.of(info)
+        if owner is None:
+            return f"machine_{info.data['use']}"
+        machine, _, user = owner
+        return "_".join(("machine", machine) + info.path[len(user.path):])
+
+    def state_id(self, info, slot):
+        """Expression for the id of a state of an instance, in the instance given by slot."""
+        machine, _, user = self.of(info)
+        return f"MACHINE_{machine}[{slot}] + {info.index - user.index}"
+
+    def report(self):
+        """One line on what sharing saves, None without machines."""
+        if not self.users:
+            return None
+        states = sum(1 for owner in self.owner.values() if owner[1] == 0)
+        total = len(self.owner)
+        return (f"Shared {len(self.users)} machine(s): functions for {states} states "
+                f"serve {total} states in {sum(len(u) for u in self.users.values())} instances.")
@@ -0,0 +1,85 @@
+from .common import flatten_name, get_graph_id
+
+
+class StateInfo:
+    """Everything the generators need to know about one state, resolved once."""
+    __slots__ = ('path', 'name', 'data', 'parent', 'depth', 'index', 'c_name', 'graph_id',
+                 'is_composite', 'is_orthogonal', 'orthogonal_ancestor', 'children')
+
+    def __init__(self, path, data, parent):
+        self.path = path
+        self.name = path[-1]
+        self.data = data
+        self.parent = parent
+        self.depth = len(path) - 1
+        self.index = None  # assigned by ModelIndex in pre-order
+        self.c_name = flatten_name(path, "_")
+        self.graph_id = get_graph_id(path)
+        self.is_composite = 'states' in data
+        self.is_orthogonal = bool(data.get('orthogonal', False))
+        # Outermost orthogonal state on the way from root down to (and including) this one.
+        inherited = parent.orthogonal_ancestor if parent else None
+        self.orthogonal_ancestor = inherited or (self if self.is_orthogonal else None)
+        self.children = []
+
+
+class ModelIndex:
+    """
+    Single pass over the model tree. Replaces repeated root-to-leaf walks
+    over the nested state data with dictionary lookups keyed on the state
+    path.
+    """
+    def __init__(self, root_data):
+        self.root_data = root_data
+        self.by_path = {}
+        self.states = []
+        self._build()
+
+    def _build(self):
+        # Explicit stack, pre-order: ids match the order the generators number states in.
+        pending = [StateInfo(('root',), self.root_data, None)]
+        while pending:
+            info = pending.pop()
+            info.index = len(self.states)
+            self.states.append(info)
+            self.by_path[info.path] = info
+            if info.is_composite:
+                for child_name, child_data in info.data['states'].items():
+                    info.children.append(StateInfo(info.path + (child_name,), child_data, info))
+                pending.extend(reversed(info.children))
+
+    def get(self, path):
+        """Lookup by path (list or tuple). Paths not starting at 'root' are taken relative to root."""
+        if not path:
+            return None
+        key = tuple(path)
+        if key[0] != 'root':
+            key = ('root',) + key
+        return self.by_path.get(key)
+
+    def data(self, path):
+        info = self.get(path)
+        return info.data if info else None
+
+    def subtree_ends(self):
+        """Per state id, the id of its last descendant (itself for leaves): pre-order keeps subtrees contiguous."""
+        ends = list(range(len(self.states)))
+        for info in reversed(self.states):
+            if info.children:
+                ends[info.index] = ends[info.children[-1].index]
+        return ends
+
+    def max_active(self):
+        """Most states that can be active at once: one child of an OR composite, every region of an AND."""
+        most = [1] * len(self.states)
+        for info in reversed(self.states):
+            if info.children:
+                below = [most[child.index] for child in info.children]
+                most[info.index] = 1 + (sum(below) if info.is_orthogonal else max(below))
+        return most[0] if self.states else 0
+
+    def __len__(self):
+        return len(self.states)
+
+    def __iter__(self):
+        return iter(self.states)
@@ -0,0 +1,465 @@
+import re
+
+from .common import time_bound, resolve_target_path, parse_fork_target, get_lca_index, get_exit_sequence, get_entry_sequence
+
+# Path formatters handed to the LCA helpers: the plan keeps raw paths and
+# leaves naming to the backends.
+def _as_path(path):
+    return list(path)
+
+def _as_entry(path, suffix):
+    return (list(path), suffix[1:])
+
+
+def rule_guard(rule, ticks=False):
+    """The guard of a transition or decision rule with its 'after' bound folded in."""
+    guard = rule.get('guard', rule.get('test', True))
+    after = rule.get('after')
+    if after is not None and guard is not False:
+        bound = f"time >= {int(after) if ticks else float(after)!r}"
+        guard = bound if guard is True else f"{bound} && ({guard})"
+    return guard
+
+def _conjunction(guards):
+    # True / False / the one guard / the guards joined with &&.
+    if False in guards:
+        return False
+    guards = [g for g in guards if g is not True]
+    if not guards:
+        return True
+    return guards[0] if len(guards) == 1 else " && ".join(f"({g})" for g in guards)
+
+
+class TransitionPlan:
+    """
+    One fully resolved transition. Backends only format this, they never
+    resolve targets themselves.
+
+    steps is the ordered list of (op, path) calls to make when the transition
+    fires, where op is one of:
+        exit_child   exit whatever child of the composite at path is active
+        exit_region  exit the orthogonal region at path if it is active
+        exit         state exit function
+        start        state start function (no initial / history descent)
+        entry        state entry function
+    """
+    __slots__ = ('source', 'transition', 'number', 'kind', 'event', 'guard', 'action',
+                 'target_path', 'target', 'forks', 'src_str', 'dst_str',
+                 'pre_exits', 'exits', 'entries', 'fork_entries', 'cross_limb',
+                 'decision', 'branches', 'deadline')
+
+    def __init__(self, source, transition, ticks=False):
+        self.source = source
+        self.transition = transition
+        self.number = None
+        self.kind = 'normal'
+        self.event = transition.get('event')
+        self.guard = rule_guard(transition, ticks)
+        # (seconds, strict) in the source state before the guard can hold; None if not time-bound.
+        self.deadline = time_bound(self.guard)
+        self.action = transition.get('action')
+        self.target_path = None
+        self.target = None
+        self.forks = None
+        self.src_str = "/" + "/".join(source.path[1:])
+        self.dst_str = "???"
+        self.pre_exits = []
+        self.exits = []
+        self.entries = []
+        self.fork_entries = []
+        self.cross_limb = False
+        self.decision = None
+        self.branches = []
+
+    @property
+    def terminate(self):
+        return self.kind == 'termination'
+
+    @property
+    def source_id(self):
+        return self.source.index
+
+    @property
+    def target_id(self):
+        return self.target.index if self.target else None
+
+    @property
+    def steps(self):
+        steps = list(self.pre_exits)
+        steps += [('exit', p) for p in self.exits]
+        steps += [(op, p) for p, op in self.entries]
+        steps += [(op, p) for p, op in self.fork_entries]
+        return steps
+
+    @property
+    def step_key(self):
+        """steps as a hashable tuple, to find transitions taking the same steps."""
+        return tuple((op, tuple(path)) for op, path in self.steps)
+
+
+class ModelPlans:
+    """
+    All transition plans of a model, compiled once and shared by every backend.
+    With ticks, time is an integer tick count ('--compact ticks').
+    """
+    def __init__(self, index, decisions, ticks=False):
+        self.index = index
+        self.decisions = decisions
+        self.ticks = ticks
+        self.routes = flatten_decisions(decisions, ticks)
+        self._shared = None
+        self.by_state = {}
+        self.all = []
+        for info in index:
+            self.by_state[info.path] = [self._compile(info, t) for t in info.data.get('transitions', [])]
+        # Events in order of first use; transitions without one run on every tick.
+        self.events = list(dict.fromkeys(plan.event for plan in self.all if plan.event is not None))
+
+    def for_state(self, path):
+        return self.by_state.get(tuple(path), [])
+
+    def for_event(self, path, event=None):
+        """The state's transitions triggered by event, or its per-tick ones for None."""
+        return [plan for plan in self.for_state(path) if plan.event == event]
+
+    def shared_steps(self):
+        """
+        Step sequences that several transitions take, as {step_key: number} in
+        order of first use. The pointer runtimes emit each once as a function
+        and call it from every transition that takes it. A sequence is only
+        outlined when that means fewer step calls: uses * steps inline against
+        one call per use plus the steps in the function. Transitions inside
+        machine instances are left out: their code is already shared by the
+        instances (machines.py).
+        """
+        if self._shared is None:
+            uses = {}
+            for plan in self.all:
+                if plan.kind != 'decision' and len(plan.steps) > 1 and not _in_machine(plan.source):
+                    uses[plan.step_key] = uses.get(plan.step_key, 0) + 1
+            self._shared = {key: n for n, key in enumerate(
+                key for key, count in uses.items() if count * len(key) > count + len(key))}
+        return self._shared
+
+    def outline_report(self):
+        """One line on what shared_steps saves, None if nothing is shared."""
+        shared = self.shared_steps()
+        if not shared:
+            return None
+        users = [plan for plan in self.all if plan.kind != 'decision' and plan.step_key in shared]
+        inline = sum(len(plan.steps) for plan in users)
+        outlined = len(users) + sum(len(key) for key in shared)
+        return (f"Outlined {len(shared)} exit/entry sequences taken by {len(users)} transitions: "
+                f"{outlined} step calls instead of {inline}.")
+
+    def used_decisions(self):
+        """Names of the decisions some transition leads to, in order of first use."""
+        return list(dict.fromkeys(plan.decision for plan in self.all if plan.kind == 'decision'))
+
+    def timed(self):
+        """
+        (source state id, seconds, strict) for each polled transition with a
+        time-bound guard. A transition into a decision has one per route whose
+        guard or the transition's own guard is time-bound, the later bound of
+        the two.
+        """
+        timed = []
+        for info in self.index:
+            for plan in self.for_event(info.path):
+                bounds = [plan.deadline]
+                if plan.kind == 'decision':
+                    bounds = [max(b for b in (plan.deadline, branch.deadline) if b is not None)
+                              for branch in plan.branches if plan.deadline or branch.deadline]
+                for seconds, strict in dict.fromkeys(b for b in bounds if b is not None):
+                    timed.append((info.index, seconds, strict))
+        return timed
+
+    def subtree_events(self):
+        """Per state id, the events some transition of the state or a descendant listens to."""
+        found = [set() for _ in range(len(self.index))]
+        for info in reversed(self.index.states):
+            mine = found[info.index]
+            mine.update(plan.event for plan in self.for_state(info.path) if plan.event is not None)
+            for child in info.children:
+                mine |= found[child.index]
+        return found
+
+    def completion_cycle(self):
+        """
+        State ids around a cycle of transitions that fire whenever their source
+        is active (no event, no guard), following each into the states it
+        enters; None if there is none. Run to completion never settles there.
+        """
+        edges = [[] for _ in range(len(self.index))]
+        for info in self.index:
+            for plan in self.for_event(info.path):
+                fired = self._always_fires(plan)
+                if fired:
+                    edges[info.index].extend(self._entered(fired))
+        return _find_cycle(edges)
+
+    def _always_fires(self, plan):
+        # The state-changing plan that fires whenever plan is evaluated, if any.
+        if plan.guard is not True or plan.terminate:
+            return None
+        if plan.kind == 'decision':
+            return self._always_fires(plan.branches[0]) if plan.branches else None
+        return plan
+
+    def _entered(self, plan):
+        # Ids of the states plan enters, down the initial states of each 'entry'.
+        entered = []
+        for path, op in plan.entries + plan.fork_entries:
+            todo = [self.index.get(path)]
+            while todo:
+                info = todo.pop()
+                entered.append(info.index)
+                if op == 'start' or not info.is_composite or info.data.get('history', False):
+                    continue
+                if info.is_orthogonal:
+                    todo.extend(info.children)
+                else:
+                    todo.append(self.index.get(list(info.path) + [info.data['initial']]))
+        return entered
+
+    def _compile(self, source, t):
+        plan = TransitionPlan(source, t, self.ticks)
+        plan.number = len(self.all)
+        self.all.append(plan)
+
+        name_path = list(source.path)
+        raw_target = t.get('to', t.get('transfer_to'))
+
+        if raw_target is None or raw_target == "null" or raw_target == "":
+            plan.kind = 'termination'
+            plan.dst_str = "Termination"
+            plan.exits = get_exit_sequence(name_path, ['root'], _as_path) + [['root']]
+            return plan
+
+        if raw_target in self.decisions:
+            plan.kind = 'decision'
+            plan.decision = raw_target
+            plan.dst_str = f"Decision({raw_target})"
+            # One branch per route of the flattened decision, resolved relative to the
+            # state that uses the decision.
+            plan.branches = [self._compile(source, route) for route in self.routes[raw_target]]
+            return plan
+
+        base_target, forks = parse_fork_target(raw_target)
+        target_path = resolve_target_path(name_path, base_target)
+        plan.target_path = target_path
+        plan.target = self.index.get(target_path)
+        plan.forks = forks
+        if forks:
+            plan.dst_str = "/" + "/".join(target_path[1:]) + str(forks)
+        else:
+            plan.dst_str = "/" + "/".join(target_path[1:])
+
+        lca_index = get_lca_index(name_path, target_path)
+
+        # --- CROSS-LIMB ORTHOGONAL CHECK ---
+        container_path = name_path[:lca_index]
+        lca_data = self.index.data(container_path)
+
+        if lca_data and lca_data.get('orthogonal', False):
+            limb_idx = lca_index
+            if len(name_path) > limb_idx and len(target_path) > limb_idx:
+                source_limb = name_path[limb_idx]
+                target_limb = target_path[limb_idx]
+                if source_limb != target_limb:
+                    plan.cross_limb = True
+                    target_limb_path = name_path[:lca_index] + [target_limb]
+
+                    # If the target limb is Composite (has children) and we are targeting deeper,
+                    # we only exit the active child of the limb, keeping the limb itself active.
+                    limb_data = self.index.data(target_limb_path)
+                    is_composite_limb = limb_data and 'states' in limb_data
+                    is_targeting_deeper = len(target_path) > len(target_limb_path)
+
+                    if is_composite_limb and is_targeting_deeper:
+                        plan.pre_exits.append(('exit_child', target_limb_path))
+                        entry_source = target_limb_path
+                    else:
+                        # Standard Reset (Exit Limb -> Enter Limb)
+                        plan.pre_exits.append(('exit_region', target_limb_path))
+                        entry_source = container_path
+
+                    plan.entries = get_entry_sequence(entry_source, target_path, _as_entry)
+                    if forks is not None:
+                        plan.entries = self._force_start(plan.entries, target_path)
+                    return plan
+
+        # --- IMPLICIT ORTHOGONAL / LOCAL LIMB LOGIC ---
+        if forks is None:
+            target_info = self.index.get(target_path)
+            ortho = target_info.orthogonal_ancestor if target_info else None
+            parallel_ancestor_idx = ortho.depth if ortho else -1
+
+            if parallel_ancestor_idx != -1 and parallel_ancestor_idx < len(target_path) - 1:
+                limb_idx = parallel_ancestor_idx + 1
+                is_same_limb = len(name_path) > limb_idx and name_path[limb_idx] == target_path[limb_idx]
+                if not is_same_limb:
+                    forks = ["/".join(target_path[parallel_ancestor_idx+1:])]
+                    target_path = target_path[:parallel_ancestor_idx+1]
+
+        # --- DYNAMIC CHILD EXIT (For Container Transitions) ---
+        if lca_index >= len(name_path):
+            if source.is_composite and not source.is_orthogonal:
+                plan.pre_exits.append(('exit_child', name_path))
+
+        plan.exits = get_exit_sequence(name_path, target_path, _as_path)
+        plan.entries = get_entry_sequence(name_path, target_path, _as_entry)
+
+        if forks is not None:
+            plan.entries = self._force_start(plan.entries, target_path)
+            parallel_data = self.index.data(target_path)
+            if parallel_data and 'states' in parallel_data:
+                for child_name in parallel_data['states']:
+                    matching_fork = None
+                    for fork in forks:
+                        if fork.split('/')[0] == child_name:
+                            matching_fork = fork
+                            break
+                    if matching_fork:
+                        fork_target_path = target_path + matching_fork.split('/')
+                        plan.fork_entries += get_entry_sequence(target_path, fork_target_path, _as_entry)
+                    else:
+                        plan.fork_entries.append((target_path + [child_name], 'entry'))
+        return plan
+
+    @staticmethod
+    def _force_start(entries, target_path):
+        # A fork target is only started; its regions are entered explicitly.
+        return [(p, 'start' if p == target_path else op) for p, op in entries]
+
+
+def _in_machine(info):
+    # True for the states below a state that uses a machine.
+    parent = info.parent
+    while parent is not None:
+        if 'use' in parent.data:
+            return True
+        parent = parent.parent
+    return False
+
+def describe_steps(key):
+    """A step_key as text, e.g. 'exit /a/b, exit /a, entry /c'."""
+    return ", ".join(f"{op} /{'/'.join(path[1:])}" for op, path in key)
+
+def decision_cycle(decisions):
+    """Names of decisions leading into each other in a cycle; None if there is none."""
+    names = list(decisions)
+    number = {name: i for i, name in enumerate(names)}
+    edges = [[number[target] for target in (rule.get('to', rule.get('transfer_to')) for rule in decisions[name])
+              if target in number] for name in names]
+    cycle = _find_cycle(edges)
+    return [names[i] for i in cycle] if cycle else None
+
+# Context fields code names (`ctx.x` in Rust, `ctx->x` in C), and ctx handed on whole.
+_CONTEXT_FIELD = re.compile(r'\bctx\s*(?:\.|->)\s*(\w+)')
+_WHOLE_CONTEXT = re.compile(r'\bctx\b(?!\s*(?:\.|->))')
+
+def decision_feedback(decisions):
+    """
+    (decision, rule index, fields) for each rule that leads to another
+    decision with an action touching context fields that a guard further
+    down the chain reads; fields is ['ctx'] when the action hands the whole
+    context on. Flattened routes evaluate those guards before the action
+    runs, so the chain would no longer see what the action wrote. The
+    decisions must be free of cycles (decision_cycle).
+    """
+    reads = {}
+
+    def read_by(name):
+        # Context fields the guards of a decision and the decisions it leads to read.
+        if name not in reads:
+            fields = set()
+            for rule in decisions[name]:
+                fields.update(_CONTEXT_FIELD.findall(str(rule.get('guard', rule.get('test', '')))))
+                target = rule.get('to', rule.get('transfer_to'))
+                if target in decisions:
+                    fields |= read_by(target)
+            reads[name] = fields
+        return reads[name]
+
+    found = []
+    for name, rules in decisions.items():
+        for i, rule in enumerate(rules):
+            target = rule.get('to', rule.get('transfer_to'))
+            action = rule.get('action')
+            if target not in decisions or not action:
+                continue
+            fields = read_by(target)
+            touched = sorted(fields.intersection(_CONTEXT_FIELD.findall(str(action))))
+            if fields and _WHOLE_CONTEXT.search(str(action)):
+                touched = ['ctx']
+            if touched:
+                found.append((name, i, touched))
+    return found
+
+def flatten_decisions(decisions, ticks=False):
+    """
+    Every decision as a flat table of routes, following rules that lead to
+    another decision down to a state or termination. A route is a rule
+    {'guard', 'action', 'to'}: the conjunction of the guards along the chain,
+    their actions in order, and the final target. All guards of a decision are
+    evaluated before any of its actions run, which validation makes sure no
+    guard can tell (decision_feedback). Routes that cannot fire, because
+    their guard is false or an earlier identical or unconditional route always
+    wins, are dropped. The decisions must be free of cycles (decision_cycle).
+    """
+    routes = {}
+
+    def flatten(name):
+        if name not in routes:
+            table = []
+            for rule in decisions[name]:
+                guard = rule_guard(rule, ticks)
+                target = rule.get('to', rule.get('transfer_to'))
+                if target in decisions:
+                    table += [([guard] + guards, [rule.get('action')] + actions, to)
+                              for guards, actions, to in flatten(target)]
+                else:
+                    table.append(([guard], [rule.get('action')], target))
+            routes[name] = table
+        return routes[name]
+
+    flat = {}
+    for name in decisions:
+        table, seen = [], set()
+        for guards, actions, to in flatten(name):
+            route = {'guard': _conjunction(guards), 'action': "\n".join(a for a in actions if a) or None, 'to': to}
+            key = (route['guard'], route['action'], to)
+            if route['guard'] is False or key in seen:
+                continue
+            seen.add(key)
+            table.append(route)
+            if route['guard'] is True:
+                break
+        flat[name] = table
+    return flat
+
+def _find_cycle(edges):
+    """Some cycle in the graph given as successor lists, as a list of nodes; None if acyclic."""
+    color = [0] * len(edges)  # 0 unseen, 1 on the current path, 2 done
+    for start in range(len(edges)):
+        if color[start]:
+            continue
+        path, todo = [], [(start, iter(edges[start]))]
+        color[start] = 1
+        path.append(start)
+        while todo:
+            node, successors = todo[-1]
+            for succ in successors:
+                if color[succ] == 1:
+                    return path[path.index(succ):]
+                if color[succ] == 0:
+                    color[succ] = 1
+                    path.append(succ)
+                    todo.append((succ, iter(edges[succ])))
+                    break
+            else:
+                color[node] = 2
+                path.pop()
+                todo.pop()
+    return None
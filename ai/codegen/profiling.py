@@ -0,0 +1,111 @@
+"""
+Build profiling for sm-builder.py --profile: wall time and allocations per
+phase, the slowest states per backend and an optional cProfile dump.
+"""
+import contextlib
+import cProfile
+import time
+import tracemalloc
+
+
+class BuildProfile:
+    """
+    Pass one to build_model() (or to a generator as profile=) to collect:
+        phases   {phase: {'seconds', and with memory 'allocations', 'allocated', 'peak'}}
+        states   {backend: {path: {'seconds', 'transitions'}}}
+    memory traces the phases with tracemalloc. 'allocations' and 'allocated'
+    add up, per source line, the blocks and bytes allocated there that are
+    still alive when the phase ends. 'peak' is the most memory the phase
+    held above its start, so it also covers temporaries freed before the
+    end. Tracing slows the build and the state timings down noticeably.
+    """
+    def __init__(self, top=10, memory=True, cprofile_path=None):
+        self.top = top
+        self.memory = memory
+        self.cprofile_path = cprofile_path
+        self.phases = {}
+        self.states = {}
+        self._cprofile = None
+
+    def start(self):
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if self.cprofile_path:
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+
+    def stop(self):
+        if self._cprofile:
+            self._cprofile.disable()
+            self._cprofile.dump_stats(self.cprofile_path)
+            self._cprofile = None
+        if self.memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+        return False
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            before = self._snapshot()
+            tracemalloc.reset_peak()
+            mem0 = tracemalloc.get_traced_memory()[0]
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            stats = self.phases.setdefault(name, {'seconds': 0.0})
+            stats['seconds'] += time.perf_counter() - t0
+            if tracing:
+                peak = tracemalloc.get_traced_memory()[1]
+                new = [d for d in self._snapshot().compare_to(before, 'lineno') if d.count_diff > 0]
+                stats['allocations'] = stats.get('allocations', 0) + sum(d.count_diff for d in new)
+                stats['allocated'] = stats.get('allocated', 0) + sum(max(d.size_diff, 0) for d in new)
+                stats['peak'] = max(stats.get('peak', 0), peak - mem0)
+
+    def _snapshot(self):
+        # Leave out what tracemalloc allocates for its own snapshots.
+        return tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+
+    def record_state(self, backend, path, seconds, transition_seconds):
+        """One state function rendered by backend; transition_seconds of it went to emit_transition_logic."""
+        self.states.setdefault(backend, {})["/" + "/".join(path[1:])] = {
+            'seconds': seconds, 'transitions': transition_seconds}
+
+    def slowest(self, backend, n=None, key='seconds'):
+        states = self.states.get(backend, {})
+        ranked = sorted(states.items(), key=lambda item: item[1][key], reverse=True)
+        return ranked[:self.top if n is None else n]
+
+    def report(self):
+        """Plain dict of everything collected (what the benchmark tooling consumes)."""
+        return {
+            'phases': self.phases,
+            'slowest_states': {backend: [dict(state=path, **stats) for path, stats in self.slowest(backend)]
+                               for backend in self.states},
+            'state_count': {backend: len(states) for backend, states in self.states.items()},
+            'cprofile': self.cprofile_path,
+        }
+
+    def format(self):
+        lines = ["--- Profile ---", f"{'PHASE':14} {'TIME':>10}"
+                 + (f" {'ALLOCATIONS':>11} {'ALLOCATED':>10} {'PEAK':>10}" if self.memory else "")]
+        for name, stats in self.phases.items():
+            line = f"{name:14} {stats['seconds'] * 1000:8.2f}ms"
+            if 'allocations' in stats:
+                line += f" {stats['allocations']:>11} {stats['allocated'] / 1024:8.1f}kB {stats['peak'] / 1024:8.1f}kB"
+            lines.append(line)
+        for backend in self.states:
+            lines.append(f"Slowest {backend} states (render / of which transitions):")
+            for path, stats in self.slowest(backend):
+                lines.append(f"    {stats['seconds'] * 1000:8.3f}ms {stats['transitions'] * 1000:8.3f}ms  {path}")
+        if self.cprofile_path:
+            lines.append(f"cProfile stats written to {self.cprofile_path}")
+        return "\n".join(lines)
@@ -0,0 +1,527 @@
+"""
+Flat Rust backend (--runtime flat): the hierarchy is resolved at build time.
+
+Every configuration the machine can reach (its set of active states) becomes
+one variant of `enum Config`. The tick is a single match on it; each arm runs
+the do/guard code of all active states in the pointer runtime's order, and
+every transition's exit/entry calls and the resulting configuration are
+precomputed per (configuration, transition). Entering a history composite
+branches on its recorded child at runtime.
+
+Events work the same way: dispatch matches on (configuration, event) and
+each arm runs only the listening transitions of that configuration.
+"""
+from .build import BuildError
+from .common import event_queue_size, trace_buffer_size, microstep_limit, preamble, referenced_vars, state_path
+from .model import ModelIndex
+from .plan import ModelPlans
+from .rust_lang import (PREAMBLE_LINES, trace_hook, ACTIVE_SET_METHODS, DEADLINE_METHOD, active_set_items, deadline_items,
+                        event_items, EVENT_FIELDS, EVENT_INIT, EVENT_DRAIN, EVENT_METHODS,
+                        trace_items, trace_call, TRACE_FIELDS, TRACE_INIT, TRACE_TICK, TRACE_METHODS,
+                        RustInstrumentation, RTC_ITEMS, RTC_FIELDS, RTC_INIT, run_to_completion, first_microstep,
+                        decision_functions, decision_call)
+from .stream import Spool, write_template
+import io
+import re
+
+# Past this many configurations the flat code grows faster than it pays off.
+MAX_CONFIGURATIONS = 4096
+
+# Hist value assumed for a composite during symbolic execution.
+UNKNOWN, NONE = "unknown", "none"
+
+HEADER = """
+#![allow(unused_variables)]
+#![allow(dead_code)]
+#![allow(non_snake_case)]
+#![allow(non_upper_case_globals)]
+#![allow(unreachable_code)]
+#![allow(unexpected_cfgs)]
+
+// --- User Includes / Context Types ---
+%s
+
+%s%s
+const NO_STATE: usize = usize::MAX;
+
+// --- Configurations (sets of active states) ---
+#[derive(Clone, Copy, PartialEq, Eq, Debug)]
+pub enum Config {
+%s
+}
+
+static CONFIG_NAMES: [&str; %d] = [%s];
+
+pub struct Context {
+    pub now: f64,
+    pub state_timers: [f64; TOTAL_STATES],
+    pub transition_fired: bool,
+    pub terminated: bool,
+
+    // One bit per active state id
+    pub active_states: [u64; ACTIVE_WORDS],
+    pub config: Config,%s
+
+    // Last child started in each history composite
+    %s
+
+    // User Context Fields
+    %s
+}
+
+pub struct StateMachine {
+    pub ctx: Context,
+    running: bool,
+}
+
+impl StateMachine {
+    pub fn new() -> Self {
+        let ctx = Context {
+            now: 0.0,
+            state_timers: [0.0; TOTAL_STATES],
+            transition_fired: false,
+            terminated: false,
+            active_states: [0; ACTIVE_WORDS],
+            config: Config::C0,%s
+            %s
+
+            // Init User Context
+            %s
+        };
+
+        let mut sm = StateMachine {
+            ctx,
+            running: true,
+        };
+
+        // Start Machine
+        sm_enter(&mut sm.ctx);
+        sm
+    }
+
+    pub fn tick(&mut self) {
+        self.ctx.transition_fired = false;%s%s
+    }
+
+    pub fn is_running(&self) -> bool {
+        self.running
+    }
+
+    pub fn get_state_str(&self) -> String {
+        let mut buffer = String::new();
+        self.write_state_str(&mut buffer);
+        buffer
+    }
+
+    // get_state_str into a caller-owned buffer: no allocation once it has grown.
+    pub fn write_state_str(&self, buffer: &mut String) {
+        buffer.clear();
+        if self.running {
+            buffer.push_str(CONFIG_NAMES[self.ctx.config as usize]);
+        } else {
+            buffer.push_str("FINISHED");
+        }
+    }%s
+}
+
+// --- Helper Macros/Methods ---
+impl Context {
+%s%s
+    %s
+}
+"""
+
+STEP = """
+
+        if self.running {
+            let ctx = &mut self.ctx;
+            match ctx.config {
+%s
+            }
+
+            if self.ctx.terminated {
+                self.running = false;
+            }
+        }"""
+
+DISPATCH = """
+
+    // Run the transitions listening to event on the active states, now.
+    pub fn dispatch(&mut self, event: Event) {
+        self.ctx.transition_fired = false;
+
+        if self.running {
+            let ctx = &mut self.ctx;
+            match (ctx.config, event) {
+%s
+                _ => {}
+            }
+
+            if self.ctx.terminated {
+                self.running = false;
+            }
+        }
+    }"""
+
+STATE_TEMPLATE = """
+fn start_{c_name}(ctx: &mut Context) {{
+    ctx.state_timers[{state_id}] = ctx.now;
+    {entry_preamble}
+    {hook_entry}
+    {entry}
+    ctx.set_active({state_id});{set_hist}
+}}
+
+fn exit_{c_name}(ctx: &mut Context) {{
+    {exit_preamble}
+    {hook_exit}
+    {exit}
+    ctx.clear_active({state_id});
+}}
+"""
+
+
+def _rust_str(text):
+    return '"' + str(text).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def _indent(code, prefix):
+    return [prefix + line for line in str(code).splitlines()]
+
+
+class RustFlatGenerator:
+    BACKEND = "rust-flat"
+
+    def __init__(self, data, index=None, plans=None, profile=None, max_configurations=MAX_CONFIGURATIONS,
+                 instrument=None):
+        self.data = data
+        self.index = index or ModelIndex(data)
+        self.decisions = data.get('decisions', {})
+        self.plans = plans or ModelPlans(self.index, self.decisions)
+        self.hooks = dict(data.get('hooks', {}))
+        if 'transition' not in self.hooks and 'transition' in data:
+             self.hooks['transition'] = data['transition']
+        self.includes = data.get('includes', '')
+        self.trace = trace_buffer_size(data)
+        self.microsteps = microstep_limit(data)
+        self.instrument = RustInstrumentation(instrument, self.index, self.plans) if instrument else None
+        self.max_configurations = max_configurations
+        self.states = list(self.index)
+        self.root_code = {'entry': data.get('entry', '// Root Entry'), 'do': data.get('do', '// Root Do'),
+                          'exit': data.get('exit', '// Root Exit')}
+        # The root never restores history, as in the other runtimes.
+        self.history = {info.index for info in self.states
+                        if info.parent and info.is_composite and not info.is_orthogonal and info.data.get('history', False)}
+        self.initial = {info.index: self.index.get(info.path + (info.data['initial'],)).index
+                        for info in self.states if info.is_composite and not info.is_orthogonal}
+        self.configs = {}
+        self.config_list = []
+
+    def _code(self, info, key):
+        if info.parent is None:
+            return self.root_code[key]
+        return info.data.get(key, '')
+
+    def generate(self):
+        sink = io.StringIO()
+        self.write(sink)
+        return sink.getvalue(), ""
+
+    def write(self, sink):
+        """Generate the machine and stream it to the file-like sink."""
+        functions = Spool("\n")
+        try:
+            if self.plans.used_decisions():
+                functions.append(decision_functions(self.plans))
+            for info in self.states:
+                functions.append(self._state_functions(info))
+
+            # Initial entry: every history slot is known to be empty.
+            known = {s: NONE for s in self.history}
+            enter = self._steps([('entry', 0)], frozenset(), known, "    ")
+            functions.append("fn sm_enter(ctx: &mut Context) {\n" + "\n".join(enter) + "\n}\n")
+
+            # Breadth-first over reachable configurations; _steps registers new ones.
+            events = self.plans.events
+            dispatch = []
+            done = 0
+            while done < len(self.config_list):
+                functions.append(self._tick_function(done))
+                for event in events:
+                    if any(self.plans.for_event(self.states[s].path, event) for s in self.config_list[done]):
+                        functions.append(self._tick_function(done, event))
+                        dispatch.append(f"                (Config::C{done}, Event::{event}) => event_c{done}_{event}(ctx),")
+                done += 1
+
+            impls = [f"""
+        pub fn in_state_{info.c_name}(&self) -> bool {{
+            self.in_state({info.index})
+        }}""" for info in self.states if info.parent]
+            hist_fields = [f"pub hist_{self.states[s].c_name}: usize," for s in sorted(self.history)]
+            hist_init = [f"hist_{self.states[s].c_name}: NO_STATE," for s in sorted(self.history)]
+            variants = [f"    /// {self._config_name(cfg)}\n    C{i}," for i, cfg in enumerate(self.config_list)]
+            names = [_rust_str(self._config_name(cfg)) for cfg in self.config_list]
+            arms = [f"                Config::C{i} => tick_c{i}(ctx)," for i in range(len(self.config_list))]
+            step = STEP % "\n".join(arms)
+            write_template(sink, HEADER,
+                self.includes, active_set_items(self.index) + deadline_items(self.plans)
+                + (trace_items(self.trace, self.index, self.plans) if self.trace else "")
+                + (self.instrument.items() if self.instrument else "")
+                + (RTC_ITEMS % self.microsteps if self.microsteps else ""),
+                event_items(events, event_queue_size(self.data)) if events else "",
+                "\n".join(variants), len(names), "\n    " + ",\n    ".join(names) + ",\n",
+                (EVENT_FIELDS if events else "") + (TRACE_FIELDS if self.trace else "")
+                + (self.instrument.fields() if self.instrument else "") + (RTC_FIELDS if self.microsteps else ""),
+                "\n    ".join(hist_fields), self.data.get('context', ''),
+                (EVENT_INIT % events[0] if events else "") + (TRACE_INIT if self.trace else "")
+                + (self.instrument.init() if self.instrument else "") + (RTC_INIT if self.microsteps else ""),
+                "\n            ".join(hist_init), self.data.get('context_init', ''),
+                (TRACE_TICK if self.trace else "") + (EVENT_DRAIN if events else ""),
+                run_to_completion(step) if self.microsteps else step,
+                DISPATCH % "\n".join(dispatch) if events else "",
+                ACTIVE_SET_METHODS + DEADLINE_METHOD,
+                (EVENT_METHODS if events else "") + (TRACE_METHODS if self.trace else "")
+                + (self.instrument.methods() if self.instrument else ""), "\n    ".join(impls))
+            sink.write("\n// --- State Logic ---\n")
+            functions.copy_to(sink)
+        finally:
+            functions.close()
+
+    def _state_functions(self, info):
+        set_hist = ""
+        if info.parent and info.parent.index in self.history:
+            set_hist = f"\n    ctx.hist_{info.parent.c_name} = {info.index};"
+        hook_entry = trace_hook('entry', self.hooks.get('entry', ''))
+        hook_exit = trace_hook('exit', self.hooks.get('exit', ''))
+        entry_code, exit_code = self._code(info, 'entry'), self._code(info, 'exit')
+        if self.instrument:
+            entry_code = self.instrument.user_code(info.index, 'entry', entry_code)
+            exit_code = self.instrument.user_code(info.index, 'exit', exit_code)
+        return STATE_TEMPLATE.format(
+            c_name=info.c_name, state_id=info.index,
+            entry_preamble=preamble(PREAMBLE_LINES, info, hook_entry, entry_code),
+            exit_preamble=preamble(PREAMBLE_LINES, info, hook_exit, exit_code),
+            hook_entry=hook_entry, hook_exit=hook_exit, entry=entry_code, exit=exit_code, set_hist=set_hist)
+
+    # --- Configurations ---
+
+    def _config_id(self, active):
+        cid = self.configs.get(active)
+        if cid is None:
+            if len(self.config_list) >= self.max_configurations:
+                raise BuildError(f"Flat runtime: more than {self.max_configurations} reachable configurations; "
+                                 f"use --runtime pointer or table for this model.")
+            cid = self.configs[active] = len(self.config_list)
+            self.config_list.append(active)
+        return cid
+
+    def _active_child(self, s, active):
+        # The pointer runtime keeps the last started child; a steady configuration has at most one.
+        found = None
+        for child in self.states[s].children:
+            if child.index in active:
+                found = child.index
+        return found
+
+    def _config_name(self, active):
+        # Same format as the inspectors of the other runtimes.
+        out = []
+        stack = [0]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, str):
+                out.append(item)
+                continue
+            info = self.states[item]
+            if info.parent:
+                out.append(info.name)
+            if not info.is_composite:
+                continue
+            if info.is_orthogonal:
+                parts = ["/["]
+                for i, child in enumerate(info.children):
+                    if i:
+                        parts.append(",")
+                    parts.append(child.index)
+                parts.append("]")
+                stack.extend(reversed(parts))
+            else:
+                child = self._active_child(item, active)
+                if child is not None:
+                    stack.extend([child, "/"])
+        return "".join(out) if active else ""
+
+    # --- Symbolic execution of transition steps ---
+
+    def _exits(self, s, active):
+        """Exit calls for state s and its active descendants, children first."""
+        calls = []
+        stack = [(s, False)]
+        while stack:
+            item, expanded = stack.pop()
+            info = self.states[item]
+            if expanded or not info.is_composite:
+                calls.append(f"exit_{info.c_name}(ctx);")
+                active.discard(item)
+                continue
+            stack.append((item, True))
+            if info.is_orthogonal:
+                stack.extend((c.index, False) for c in reversed(info.children) if c.index in active)
+            else:
+                child = self._active_child(item, active)
+                if child is not None:
+                    stack.append((child, False))
+        return calls
+
+    def _steps(self, steps, active, known, indent):
+        """
+        Code for a step list run from configuration active, ending with the
+        assignment of the resulting configuration. known maps history
+        composites to the child their hist is known to hold (or NONE).
+        """
+        active = set(active)
+        known = dict(known)
+        pending = [(op, s if isinstance(s, int) else self.index.get(s).index) for op, s in steps]
+        pending.reverse()
+        lines = []
+        while pending:
+            op, s = pending.pop()
+            info = self.states[s]
+            if op == 'exit_child':
+                child = self._active_child(s, active)
+                if child is not None:
+                    lines += [indent + call for call in self._exits(child, active)]
+            elif op == 'exit_region':
+                if s in active:
+                    lines += [indent + call for call in self._exits(s, active)]
+            elif op == 'exit':
+                lines += [indent + call for call in self._exits(s, active)]
+            else:
+                lines.append(f"{indent}start_{info.c_name}(ctx);")
+                active.add(s)
+                if info.parent and info.parent.index in self.history:
+                    known[info.parent.index] = s
+                if op != 'entry' or not info.is_composite:
+                    continue
+                if info.is_orthogonal:
+                    pending.extend(('entry', c.index) for c in reversed(info.children))
+                    continue
+                initial = self.initial[s]
+                last = known.get(s, UNKNOWN) if s in self.history else NONE
+                if last != UNKNOWN:
+                    pending.append(('entry', initial if last == NONE else last))
+                    continue
+                # Resume each possible history child with the remaining steps.
+                rest = [(o, x) for o, x in reversed(pending)]
+                branches = [c.index for c in info.children if c.index != initial]
+                keyword = "if"
+                for child in branches:
+                    lines.append(f"{indent}{keyword} ctx.hist_{info.c_name} == {child} {{")
+                    lines += self._steps([('entry', child)] + rest, active, known, indent + "    ")
+                    keyword = "} else if"
+                if branches:
+                    lines.append(f"{indent}}} else {{")
+                    lines += self._steps([('entry', initial)] + rest, active, known, indent + "    ")
+                    lines.append(f"{indent}}}")
+                else:
+                    lines += self._steps([('entry', initial)] + rest, active, known, indent)
+                return lines
+        lines.append(f"{indent}ctx.config = Config::C{self._config_id(frozenset(active))};")
+        return lines
+
+    # --- Tick ---
+
+    def _guard_code(self, guard):
+        if guard is True:
+            return "true"
+        if guard is False:
+            return "false"
+        return re.sub(r'IN_STATE\(([\w_]+)\)', r'ctx.in_state_\1()', str(guard))
+
+    def _transition(self, plan, active, indent):
+        return ([f"{indent}if {self._guard_code(plan.guard)} {{"] + self._fire(plan, active, indent + "    ")
+                + [f"{indent}}}"])
+
+    def _fire(self, plan, active, inner):
+        # Body of a plan's guard block, from the hook to the return.
+        lines = []
+        if plan.kind != 'decision':
+            hook = self.hooks.get('transition', '')
+            used = referenced_vars(hook, plan.action)
+            if 't_src' in used:
+                lines.append(f"{inner}let t_src = {_rust_str(plan.src_str)};")
+            if 't_dst' in used:
+                lines.append(f"{inner}let t_dst = {_rust_str(plan.dst_str)};")
+            lines += _indent(trace_hook('transition', hook, ""), inner)
+        lines.append(f"{inner}ctx.transition_fired = true;")
+        if self.trace and plan.kind != 'decision':
+            lines.append(inner + trace_call(plan))
+        if self.instrument:
+            lines.append(inner + self.instrument.fire(plan))
+        if plan.action:
+            lines += _indent(plan.action, inner)
+        if plan.kind == 'decision':
+            # The decision's guards are evaluated once, by its shared function.
+            lines.append(f"{inner}match {decision_call(self.plans, plan.decision)} {{")
+            for number, branch in enumerate(plan.branches, 1):
+                lines.append(f"{inner}    {number} => {{")
+                lines += self._fire(branch, active, inner + "        ")
+                lines.append(f"{inner}    }}")
+            lines += [f"{inner}    _ => {{}}", f"{inner}}}"]
+        else:
+            lines += self._steps(plan.steps, active, {}, inner)
+            if plan.terminate:
+                lines.append(f"{inner}ctx.terminated = true;")
+            lines.append(f"{inner}return;")
+        return lines
+
+    def _state_block(self, info, active, event=None):
+        transitions = []
+        for plan in self.plans.for_event(info.path, event):
+            transitions += self._transition(plan, active, "        ")
+        # Dispatching an event runs no hooks or do code.
+        hook = trace_hook('do', self.hooks.get('do', '')) if event is None else ''
+        do = self._code(info, 'do') if event is None else ''
+        if not (transitions or hook.strip() or do.strip()):
+            return []
+        if self.instrument and event is None:
+            do = self.instrument.timed(info.index, 'do', do)
+        if self.microsteps:
+            hook, do = first_microstep(hook), first_microstep(do)
+        lines = [f"    // {state_path(info)}", "    {"]
+        lines += _indent(preamble(PREAMBLE_LINES, info, hook, do, *transitions, indent=""), "        ")
+        lines += _indent(hook, "        ")
+        lines += transitions
+        lines += _indent(do, "        ")
+        lines.append("    }")
+        return lines
+
+    def _tick_function(self, cid, event=None):
+        active = self.config_list[cid]
+        name = f"tick_c{cid}" if event is None else f"event_c{cid}_{event}"
+        lines = [f"// {self._config_name(active) or '(no active state)'}",
+                 f"fn {name}(ctx: &mut Context) {{"]
+        # The pointer runtime's do order: a state's own code, then its active child
+        # or each of its regions, stopping once a transition has fired.
+        stack = [0] if active else []
+        while stack:
+            item = stack.pop()
+            if item is None:
+                lines.append("    if ctx.transition_fired { return; }")
+                continue
+            info = self.states[item]
+            lines += self._state_block(info, active, event)
+            if not info.is_composite:
+                continue
+            if info.is_orthogonal:
+                if item not in active:
+                    continue
+                order = [None]
+                for child in info.children:
+                    order += [child.index, None]
+                stack.extend(reversed(order))
+            else:
+                child = self._active_child(item, active)
+                if child is not None:
+                    stack.append(child)
+        lines.append("}\n")
+        return "\n".join(lines)
@@ -1,19 +1,34 @@
-from .common import flatten_name, resolve_target_path, get_exit_sequence, get_entry_sequence, parse_fork_target, resolve_state_data, get_lca_index
+from .common import (flatten_name, walk_nested, event_queue_size, trace_buffer_size, microstep_limit, state_path,
+                     referenced_vars, preamble, decision_params, TRACE_LEVELS)
+from .model import ModelIndex
+from .trace import model_id, record_args
+from .instrument import profile_buckets, user_slot
+from .plan import ModelPlans, describe_steps
+from .layout import ContextLayout
+from .machines import Instances
+from .stream import Spool, write_template
+import io
+import time
 import sys
+import re
 
 HEADER = """
 #![allow(unused_variables)]
 #![allow(dead_code)]
 #![allow(non_snake_case)]
+#![allow(non_upper_case_globals)]
+#![allow(unexpected_cfgs)]
 
 // --- User Includes / Context Types ---
 %s
 
-pub struct Context {
-    pub now: f64,
-    pub state_timers: [f64; %d],
+%s%s
+pub struct Context {%s
     pub transition_fired: bool,
     pub terminated: bool,
+
+    // One bit per active state id
+    pub active_states: [u64; ACTIVE_WORDS],%s
     
     // Hierarchy Pointers (Option<fn>)
     %s
@@ -32,11 +47,10 @@ pub struct StateMachine {
 
 impl StateMachine {
     pub fn new() -> Self {
-        let ctx = Context {
-            now: 0.0,
-            state_timers: [0.0; %d],
+        let ctx = Context {%s
             transition_fired: false,
             terminated: false,
+            active_states: [0; ACTIVE_WORDS],%s
             
             // Init Hierarchy Pointers
             %s
@@ -57,15 +71,7 @@ impl StateMachine {
     }
 
     pub fn tick(&mut self) {
-        self.ctx.transition_fired = false;
-        
-        if let Some(do_fn) = self.root {
-            do_fn(&mut self.ctx);
-            
-            if self.ctx.terminated {
-                self.root = None;
-            }
-        }
+        self.ctx.transition_fired = false;%s%s
     }
 
     pub fn is_running(&self) -> bool {
@@ -74,51 +80,59 @@ impl StateMachine {
 
     pub fn get_state_str(&self) -> String {
         let mut buffer = String::new();
+        self.write_state_str(&mut buffer);
+        buffer
+    }
+
+    // get_state_str into a caller-owned buffer: no allocation once it has grown.
+    pub fn write_state_str(&self, buffer: &mut String) {
+        buffer.clear();
         if self.root.is_some() {
-             inspect_root(&self.ctx, &mut buffer);
+            inspect_root(&self.ctx, buffer);
         } else {
-             buffer.push_str("FINISHED");
+            buffer.push_str("FINISHED");
         }
-        buffer
-    }
+    }%s
 }
 
 // --- Helper Macros/Methods ---
 impl Context {
+%s%s
     %s 
 }
 
 // --- State Logic ---
 """
 
-FUNC_PREAMBLE = """
-    let state_name = "{short_name}";
-    let state_full_name = "{display_name}";
-    let time = ctx.now - ctx.state_timers[{state_id}];
-"""
+# Variables user code may use; a function declares only those its code mentions.
+PREAMBLE_LINES = (
+    ('state_name', 'let state_name = "{short_name}";'),
+    ('state_full_name', 'let state_full_name = "{display_name}";'),
+    ('time', 'let time = ctx.now - ctx.state_timers[{state_id}];'),
+)
 
 LEAF_TEMPLATE = """
-fn state_{c_name}_start(ctx: &mut Context) {{
-    ctx.state_timers[{state_id}] = ctx.now;
-    {preamble}
+fn state_{c_name}_start(ctx: &mut Context{params}) {{
+    {start_timer}
+    {entry_preamble}
     {hook_entry}
     {entry}
     {set_parent}
 }}
 
-fn state_{c_name}_entry(ctx: &mut Context) {{
-    state_{c_name}_start(ctx);
+fn state_{c_name}_entry(ctx: &mut Context{params}) {{
+    state_{c_name}_start(ctx{args});
 }}
 
-fn state_{c_name}_exit(ctx: &mut Context) {{
-    {preamble}
+fn state_{c_name}_exit(ctx: &mut Context{params}) {{
+    {exit_preamble}
     {hook_exit}
     {exit}
     {clear_parent}
 }}
 
-fn state_{c_name}_do(ctx: &mut Context) {{
-    {preamble}
+fn state_{c_name}_do(ctx: &mut Context{params}) {{
+    {do_preamble}
     {hook_do}
     {transitions}
     {do}
@@ -126,65 +140,56 @@ fn state_{c_name}_do(ctx: &mut Context) {{
 """
 
 COMPOSITE_OR_TEMPLATE = """
-fn state_{c_name}_start(ctx: &mut Context) {{
-    ctx.state_timers[{state_id}] = ctx.now;
-    {preamble}
+fn state_{c_name}_start(ctx: &mut Context{params}) {{
+    {start_timer}
+    {entry_preamble}
     {hook_entry}
     {entry}
     {set_parent}
 }}
 
-fn state_{c_name}_entry(ctx: &mut Context) {{
-    state_{c_name}_start(ctx);
-    if ({history}) && ctx.{self_hist_ptr}.is_some() {{
-        let hist_fn = ctx.{self_hist_ptr}.unwrap();
-        hist_fn(ctx);
-    }} else {{
-        state_{initial_target}_entry(ctx);
-    }}
+fn state_{c_name}_entry(ctx: &mut Context{params}) {{
+    state_{c_name}_start(ctx{args});
+    {enter_child}
 }}
 
-fn state_{c_name}_exit(ctx: &mut Context) {{
-    {preamble}
+fn state_{c_name}_exit(ctx: &mut Context{params}) {{
+    {exit_preamble}
     // RECURSIVE EXIT: Kill active child first
-    if let Some(child_exit) = ctx.{self_exit_ptr} {{
-        child_exit(ctx);
-    }}
+    {exit_child}
 
     {hook_exit}
     {exit}
     {clear_parent}
 }}
 
-fn state_{c_name}_do(ctx: &mut Context) {{
-    {preamble}
+fn state_{c_name}_do(ctx: &mut Context{params}) {{
+    {do_preamble}
     {hook_do}
     {transitions}
     {do}
     
     // Tick active child
-    if let Some(child_do) = ctx.{self_ptr} {{
-        child_do(ctx);
-    }}
+    {do_child}
 }}
 """
 
 COMPOSITE_AND_TEMPLATE = """
-fn state_{c_name}_start(ctx: &mut Context) {{
-    ctx.state_timers[{state_id}] = ctx.now;
-    {preamble}
+fn state_{c_name}_start(ctx: &mut Context{params}) {{
+    {start_timer}
+    {entry_preamble}
     {hook_entry}
     {entry}
     {set_parent}
 }}
 
-fn state_{c_name}_entry(ctx: &mut Context) {{
-    state_{c_name}_start(ctx);
+fn state_{c_name}_entry(ctx: &mut Context{params}) {{
+    state_{c_name}_start(ctx{args});
     {parallel_entries}
 }}
 
-fn state_{c_name}_exit(ctx: &mut Context) {{
-    {preamble}
+fn state_{c_name}_exit(ctx: &mut Context{params}) {{
+    {exit_preamble}
     // RECURSIVE EXIT
     {parallel_exits}
     
@@ -193,8 +198,8 @@ fn state_{c_name}_exit(ctx: &mut Context) {{
     {clear_parent}
 }}
 
-fn state_{c_name}_do(ctx: &mut Context) {{
-    {preamble}
+fn state_{c_name}_do(ctx: &mut Context{params}) {{
+    {do_preamble}
     {hook_do}
     {transitions}
     {do}
@@ -206,32 +211,669 @@ fn state_{c_name}_do(ctx: &mut Context) {{
 }}
 """
 
+# Time fields of the pointer Context.
+TIME_FIELDS = """
+    pub now: %s,
+    pub state_timers: [%s; %d],"""
+
+TIME_INIT = """
+            now: %s,
+            state_timers: [%s; %d],"""
+
+# How an OR composite reaches its active child: function pointers by default.
+ENTER_CHILD = """if ({history}) && ctx.{hist}.is_some() {{
+        let hist_fn = ctx.{hist}.unwrap();
+        hist_fn(ctx);
+    }} else {{
+        state_{initial}_entry(ctx);
+    }}"""
+
+EXIT_CHILD = """if let Some(child_exit) = ctx.{exit_ptr} {{
+        child_exit(ctx);
+    }}"""
+
+DO_CHILD = """if let Some(child_do) = ctx.{ptr} {{
+        child_do(ctx);
+    }}"""
+
+# --compact: child numbers instead of function pointers, timers only where time is read (layout.py).
+COMPACT_ITEMS = """
+// --- Compact Context ---
+pub type Time = %s;
+// States whose code reads `time` keep a timer
+pub const TIMERS: usize = %d;
+pub const CONTEXT_SIZE: usize = std::mem::size_of::<Context>();
+
+// Polled transitions with a time-bound guard: (source state, its timer, time in state
+// before it can hold, whether it must be exceeded)
+static TIMED: [(usize, usize, Time, bool); %d] = [%s];
+%s"""
+
+COMPACT_DEADLINE_METHOD = """
+    // Earliest `now` at or after which a timed transition of an active state can fire,
+    // past the bound for `time > C`, so a tick at the deadline fires it.
+    // Guards that do not depend on time are not considered: tick() after changing what they read.
+    pub fn next_deadline(&self) -> Option<Time> {
+        let mut next: Option<Time> = None;
+        for &(s, t, after, strict) in TIMED.iter() {
+            if self.in_state(s) {
+                let at = %s;
+                if next.map_or(true, |n| %s) {
+                    next = Some(at);
+                }
+            }
+        }
+        next
+    }
+"""
+
+# Functions shared by the instances of a machine: the id is an expression of the instance number.
+SHARED_PREAMBLE_LINES = PREAMBLE_LINES[:1] + (
+    ('state_full_name', 'let state_full_name = STATE_PATHS[{state_id}];'),
+) + PREAMBLE_LINES[2:]
+
+COMPACT_PREAMBLE_LINES = PREAMBLE_LINES[:2] + (
+    ('time', 'let time = ctx.now - ctx.state_timers[{timer}];'),
+)
+
+TICKS_PREAMBLE_LINES = PREAMBLE_LINES[:2] + (
+    ('time', 'let time = ctx.now.wrapping_sub(ctx.state_timers[{timer}]);'),
+)
+
+COMPACT_CHILD_TEMPLATE = """
+#[inline]
+fn state_{c_name}_child_{op}(ctx: &mut Context{params}) {{
+    match ctx.{field}_{c_name}{slot} {{
+{arms}
+        _ => {default}
+    }}
+}}
+"""
+
+# Machines (machines.py): the functions of a machine's states take the instance number.
+MACHINE_ITEMS = """
+// Machine '{name}': the states of instance k have ids MACHINE_{name}[k] + offset
+static MACHINE_{name}: [usize; {count}] = [{ids}];
+"""
+
+def machine_items(instances):
+    return "".join(MACHINE_ITEMS.format(name=name, count=len(users), ids=", ".join(str(u.index) for u in users))
+                   for name, users in instances.users.items())
+
+def compact_items(layout, plans):
+    timed = [(s, layout.timers[s]) + layout.timed_bound(after, strict) for s, after, strict in plans.timed()]
+    return COMPACT_ITEMS % ("u32" if layout.ticks else "f64", len(layout.timers), len(timed),
+                            ", ".join(f"({s}, {t}, {after!r}, {str(strict).lower()})" for s, t, after, strict in timed),
+                            "" if layout.ticks else DEADLINE_AT)
+
+def compact_deadline_method(layout):
+    if layout.ticks:
+        # Wrapping tick counts: compare by signed distance.
+        return COMPACT_DEADLINE_METHOD % ("self.state_timers[t].wrapping_add(after).wrapping_add(strict as u32)",
+                                          "(at.wrapping_sub(n) as i32) < 0")
+    return COMPACT_DEADLINE_METHOD % ("deadline_at(self.state_timers[t], after, strict)", "at < n")
+
+# Active-state bitset shared by the pointer and table runtimes.
+ACTIVE_SET_ITEMS = """// --- State Ids ---
+pub const TOTAL_STATES: usize = %d;
+pub const ACTIVE_WORDS: usize = (TOTAL_STATES + 63) / 64;
+%s
+
+// Last descendant of each state; a state's subtree is the id range up to it
+static SUBTREE_END: [u32; TOTAL_STATES] = [%s];
+
+// Most states active at once: the length of an active_ids snapshot
+pub const MAX_ACTIVE: usize = %d;
+
+pub static STATE_PATHS: [&str; TOTAL_STATES] = [%s];
+
+// Paths of the innermost states of an active_ids snapshot, comma separated.
+pub fn write_active_paths<W: std::fmt::Write>(ids: &[usize], out: &mut W) -> std::fmt::Result {
+    let mut first = true;
+    for (k, &id) in ids.iter().enumerate() {
+        // Innermost: the next active id is outside this state's subtree.
+        if k + 1 < ids.len() && ids[k + 1] <= SUBTREE_END[id] as usize {
+            continue;
+        }
+        if !first {
+            out.write_str(",")?;
+        }
+        out.write_str(STATE_PATHS[id])?;
+        first = false;
+    }
+    Ok(())
+}
+"""
+
+ACTIVE_SET_METHODS = """
+    #[inline]
+    pub fn in_state(&self, id: usize) -> bool {
+        (self.active_states[id >> 6] >> (id & 63)) & 1 != 0
+    }
+
+    // True if any state strictly below id is active.
+    pub fn in_substate_of(&self, id: usize) -> bool {
+        let (mut lo, hi) = (id + 1, SUBTREE_END[id] as usize + 1);
+        while lo < hi {
+            let end = hi.min((lo | 63) + 1);
+            let mask = (!0u64 >> (64 - (end - lo))) << (lo & 63);
+            if self.active_states[lo >> 6] & mask != 0 {
+                return true;
+            }
+            lo = end;
+        }
+        false
+    }
+
+    // Active state ids in pre-order (root first); returns how many were written.
+    pub fn active_ids(&self, ids: &mut [usize; MAX_ACTIVE]) -> usize {
+        let mut n = 0;
+        for (w, &word) in self.active_states.iter().enumerate() {
+            let mut bits = word;
+            while bits != 0 {
+                ids[n] = (w << 6) + bits.trailing_zeros() as usize;
+                n += 1;
+                bits &= bits - 1;
+            }
+        }
+        n
+    }
+
+    #[inline]
+    fn set_active(&mut self, id: usize) {
+        self.active_states[id >> 6] |= 1 << (id & 63);
+    }
+
+    #[inline]
+    fn clear_active(&mut self, id: usize) {
+        self.active_states[id >> 6] &= !(1 << (id & 63));
+    }
+"""
+
+# Timed transitions, shared by all Rust runtimes: lets the host sleep until the next one can fire.
+DEADLINE_AT = """
+// First `now` at which `now - since` reaches after, or exceeds it if strict: the
+// instant a guard `time >= after` (`time > after`) computed from it starts to hold.
+fn deadline_at(since: f64, after: f64, strict: bool) -> f64 {
+    let mut at = since + after;
+    while at - since < after || (strict && at - since <= after) {
+        // Next f64 up
+        at = if at == 0.0 { f64::from_bits(1) } else if at > 0.0 { f64::from_bits(at.to_bits() + 1) } else { f64::from_bits(at.to_bits() - 1) };
+    }
+    at
+}
+"""
+
+DEADLINE_ITEMS = """
+// Polled transitions with a time-bound guard: (source state, seconds in state before it
+// can hold, whether they must be exceeded)
+static TIMED: [(usize, f64, bool); %d] = [%s];
+""" + DEADLINE_AT
+
+DEADLINE_METHOD = """
+    // Earliest `now` at or after which a timed transition of an active state can fire,
+    // past the bound for `time > C`, so a tick at the deadline fires it.
+    // Guards that do not depend on time are not considered: tick() after changing what they read.
+    pub fn next_deadline(&self) -> Option<f64> {
+        let mut next: Option<f64> = None;
+        for &(s, after, strict) in TIMED.iter() {
+            if self.in_state(s) {
+                let at = deadline_at(self.state_timers[s], after, strict);
+                if next.map_or(true, |n| at < n) {
+                    next = Some(at);
+                }
+            }
+        }
+        next
+    }
+"""
+
+def deadline_items(plans):
+    return DEADLINE_ITEMS % (len(plans.timed()), ", ".join(f"({s}, {after!r}, {str(strict).lower()})"
+                                                          for s, after, strict in plans.timed()))
+
+# Exit/entry steps several transitions take (ModelPlans.shared_steps), outlined;
+# never inlined back, which is the point.
+STEPS_FUNCTION = """
+// {steps}
+#[inline(never)]
+fn transition_steps_{number}(ctx: &mut Context) {{
+{calls}
+}}
+"""
+
+# Decisions, shared by the pointer and flat runtimes: one function per decision
+# evaluates its flattened route table (plan.flatten_decisions).
+DECISION_FUNCTION = """
+// Decision '{name}': number of the first route whose guards hold, 0 if none.
+#[allow(unused_variables)]
+fn decision_{name}(ctx: &mut Context{params}) -> usize {{
+{routes}
+}}
+"""
+
+def decision_functions(plans, time_type="f64"):
+    types = {'time': time_type, 'state_name': "&str", 'state_full_name': "&str"}
+    functions = []
+    for name in plans.used_decisions():
+        routes = plans.routes[name]
+        lines = []
+        for number, route in enumerate(routes, 1):
+            if route['guard'] is True:
+                lines.append(f"    {number}")
+            else:
+                guard = re.sub(r'IN_STATE\(([\w_]+)\)', r'ctx.in_state_\1()', str(route['guard']))
+                lines.append(f"    if {guard} {{\n        return {number};\n    }}")
+        if not routes or routes[-1]['guard'] is not True:
+            lines.append("    0")
+        params = "".join(f", {var}: {types[var]}" for var in decision_params(routes))
+        functions.append(DECISION_FUNCTION.format(name=name, params=params, routes="\n".join(lines)))
+    return "".join(functions)
+
+def decision_call(plans, name):
+    return f"decision_{name}({', '.join(['ctx'] + decision_params(plans.routes[name]))})"
+
+# Transition trace, shared by all Rust runtimes. Only emitted with 'trace_buffer: N'; format in trace.py.
+TRACE_ITEMS = """
+// --- Transition Trace ---
+pub const TRACE_BUFFER: usize = %d;
+pub const TRACE_MODEL_ID: u32 = 0x%08x;
+// Target of a transition that terminates the machine
+pub const TRACE_NONE: u32 = u32::MAX;
+
+#[derive(Clone, Copy, Default, Debug)]
+pub struct TraceRecord {
+    pub tick: u64,
+    pub now: f64,
+    pub source: u32,
+    pub target: u32,
+    pub transition: u32,
+}
+"""
+
+TRACE_FIELDS = """
+
+    // Last TRACE_BUFFER fired transitions (ring buffer); trace_total counts all of them
+    pub trace: [TraceRecord; TRACE_BUFFER],
+    pub trace_total: u64,
+    pub ticks: u64,"""
+
+TRACE_INIT = """
+            trace: [TraceRecord::default(); TRACE_BUFFER],
+            trace_total: 0,
+            ticks: 0,"""
+
+TRACE_TICK = """
+        self.ctx.ticks += 1;"""
+
+TRACE_METHODS = """
+    #[inline]
+    fn record_transition(&mut self, source: u32, target: u32, transition: u32) {
+        let slot = (self.trace_total % TRACE_BUFFER as u64) as usize;
+        self.trace[slot] = TraceRecord { tick: self.ticks, now: self.now, source, target, transition };
+        self.trace_total += 1;
+    }
+
+    // Recorded transitions, oldest first.
+    pub fn trace_records(&self) -> impl Iterator<Item = &TraceRecord> + '_ {
+        let count = self.trace_total.min(TRACE_BUFFER as u64) as usize;
+        let start = ((self.trace_total - count as u64) % TRACE_BUFFER as u64) as usize;
+        (0..count).map(move |i| &self.trace[(start + i) % TRACE_BUFFER])
+    }
+
+    // The buffer as sm-trace.py reads it.
+    pub fn write_trace<W: std::io::Write>(&self, out: &mut W) -> std::io::Result<()> {
+        out.write_all(b"SMTR")?;
+        out.write_all(&1u32.to_ne_bytes())?;
+        out.write_all(&TRACE_MODEL_ID.to_ne_bytes())?;
+        out.write_all(&(TRACE_BUFFER as u32).to_ne_bytes())?;
+        out.write_all(&self.trace_total.to_ne_bytes())?;
+        for r in self.trace_records() {
+            out.write_all(&r.tick.to_ne_bytes())?;
+            out.write_all(&r.now.to_ne_bytes())?;
+            out.write_all(&r.source.to_ne_bytes())?;
+            out.write_all(&r.target.to_ne_bytes())?;
+            out.write_all(&r.transition.to_ne_bytes())?;
+        }
+        Ok(())
+    }
+"""
+
+def trace_items(size, index, plans):
+    return TRACE_ITEMS % (size, model_id(index, plans))
+
+def trace_call(plan):
+    """The statement recording that plan fired."""
+    return "ctx.record_transition(%d, %d, %d);" % record_args(plan)
+
+STEP = """
+        
+        if let Some(do_fn) = self.root {
+            do_fn(&mut self.ctx);
+            
+            if self.ctx.terminated {
+                self.root = None;
+            }
+        }"""
+
+# Run to completion, shared by all Rust runtimes. Only emitted with 'run_to_completion'.
+RTC_ITEMS = """
+// --- Run to completion ---
+// Microsteps a tick may take to settle; a tick whose next microstep still fires stops
+// after that one and sets ctx.livelock.
+pub const MAX_MICROSTEPS: u32 = %d;
+"""
+
+RTC_FIELDS = """
+
+    // Run to completion: microsteps (steps that fired a transition) the last tick took
+    pub microsteps: u32,
+    pub livelock: bool,"""
+
+RTC_INIT = """
+            microsteps: 0,
+            livelock: false,"""
+
+RTC_LOOP = """
+
+        // Run to completion: step until no transition fires, at most MAX_MICROSTEPS times
+        // plus the one that tells a chain still firing from one that settled.
+        self.ctx.microsteps = 0;
+        self.ctx.livelock = false;
+        loop {
+%s
+
+            if !self.ctx.transition_fired || self.ctx.terminated {
+                break;
+            }
+            self.ctx.microsteps += 1;
+            if self.ctx.microsteps > MAX_MICROSTEPS {
+                self.ctx.livelock = true;
+                break;
+            }
+            self.ctx.transition_fired = false;
+        }"""
+
+def run_to_completion(step):
+    """A tick's step, repeated by the run-to-completion loop."""
+    return RTC_LOOP % "\n".join("    " + line if line.strip() else "" for line in step.strip("\n").splitlines())
+
+def first_microstep(code):
+    """User do code, run only by the first microstep of a run-to-completion tick."""
+    if not code or not str(code).strip():
+        return code
+    return f"if ctx.microsteps == 0 {{\n{code}\n}}"
+
+# Instrumentation, shared by all Rust runtimes. Only emitted with --instrument; layout in instrument.py.
+PROFILE_ITEMS = """
+// --- Instrumentation ---
+pub const PROFILE_TRANSITIONS: usize = %d;
+pub const PROFILE_BUCKETS: usize = %d;
+pub const PROFILE_MODEL_ID: u32 = 0x%08x;
+// Words export_profile writes
+pub const PROFILE_LEN: usize = 6 + 2 * TOTAL_STATES + PROFILE_TRANSITIONS + 3 * TOTAL_STATES * PROFILE_BUCKETS;
+"""
+
+PROFILE_CYCLES = """
+// Cycle counter on x86_64, nanoseconds elsewhere.
+#[inline]
+fn sm_cycles() -> u64 {
+    #[cfg(target_arch = "x86_64")]
+    {
+        unsafe { core::arch::x86_64::_rdtsc() }
+    }
+    #[cfg(not(target_arch = "x86_64"))]
+    {
+        static START: std::sync::OnceLock<std::time::Instant> = std::sync::OnceLock::new();
+        START.get_or_init(std::time::Instant::now).elapsed().as_nanos() as u64
+    }
+}
+"""
+
+PROFILE_FIELDS = """
+
+    // Instrumentation: entries and time active per state, fires per transition
+    pub entry_counts: [u64; TOTAL_STATES],
+    pub dwell: [f64; TOTAL_STATES],
+    pub fire_counts: [u64; PROFILE_TRANSITIONS],"""
+
+PROFILE_TIMING_FIELDS = """
+    // log2 histograms of the cycles user entry/do/exit code took, 3 per state
+    pub user_cycles: [[u64; PROFILE_BUCKETS]; 3 * TOTAL_STATES],"""
+
+PROFILE_INIT = """
+            entry_counts: [0; TOTAL_STATES],
+            dwell: [0.0; TOTAL_STATES],
+            fire_counts: [0; PROFILE_TRANSITIONS],"""
+
+PROFILE_TIMING_INIT = """
+            user_cycles: [[0; PROFILE_BUCKETS]; 3 * TOTAL_STATES],"""
+
+PROFILE_METHODS = """
+    // The counters as one flat array of PROFILE_LEN words; active states include their current stay.
+    pub fn export_profile(&self, out: &mut [u64]) {
+        let n = TOTAL_STATES;
+        out[..6].copy_from_slice(&[0x46504D53, 1, PROFILE_MODEL_ID as u64, n as u64,
+                                   PROFILE_TRANSITIONS as u64, PROFILE_BUCKETS as u64]);
+        for s in 0..n {
+            let stay = if self.in_state(s) { self.now - self.state_timers[s] } else { 0.0 };
+            out[6 + s] = self.entry_counts[s];
+            out[6 + n + s] = (self.dwell[s] + stay).to_bits();
+        }
+        out[6 + 2 * n..6 + 2 * n + PROFILE_TRANSITIONS].copy_from_slice(&self.fire_counts);%s
+    }
+
+    // export_profile as sm-builder --heatmap reads it.
+    pub fn write_profile<W: std::io::Write>(&self, out: &mut W) -> std::io::Result<()> {
+        let mut flat = vec![0u64; PROFILE_LEN];
+        self.export_profile(&mut flat);
+        for word in flat {
+            out.write_all(&word.to_ne_bytes())?;
+        }
+        Ok(())
+    }
+"""
+
+PROFILE_TIMING_EXPORT = """
+        let base = 6 + 2 * n + PROFILE_TRANSITIONS;
+        for (i, hist) in self.user_cycles.iter().enumerate() {
+            out[base + i * PROFILE_BUCKETS..base + (i + 1) * PROFILE_BUCKETS].copy_from_slice(hist);
+        }"""
+
+PROFILE_TIMING_METHODS = """
+    #[inline]
+    fn time_user(&mut self, slot: usize, start: u64) {
+        let cycles = sm_cycles().wrapping_sub(start);
+        let bucket = ((64 - cycles.leading_zeros()) as usize).min(PROFILE_BUCKETS - 1);
+        self.user_cycles[slot][bucket] += 1;
+    }
+"""
+
+class RustInstrumentation:
+    """What --instrument adds to a Rust runtime, by template slot."""
+    def __init__(self, mode, index, plans):
+        self.mode = mode
+        self.timing = mode == 'timing'
+        self.index = index
+        self.plans = plans
+
+    def items(self):
+        items = PROFILE_ITEMS % (len(self.plans.all), profile_buckets(self.mode), model_id(self.index, self.plans))
+        return items + (PROFILE_CYCLES if self.timing else "")
+
+    def fields(self):
+        return PROFILE_FIELDS + (PROFILE_TIMING_FIELDS if self.timing else "")
+
+    def init(self):
+        return PROFILE_INIT + (PROFILE_TIMING_INIT if self.timing else "")
+
+    def methods(self):
+        return (PROFILE_METHODS % (PROFILE_TIMING_EXPORT if self.timing else "")
+                + (PROFILE_TIMING_METHODS if self.timing else ""))
+
+    def fire(self, plan):
+        return f"ctx.fire_counts[{plan.number}] += 1;"
+
+    def timed(self, state_id, kind, code):
+        """User code, timed into its histogram when timing."""
+        if not self.timing or not code or not str(code).strip():
+            return code
+        return (f"let sm_cycles_start = sm_cycles();\n{code}\n"
+                f"ctx.time_user({user_slot(state_id, kind)}, sm_cycles_start);")
+
+    def entered(self, state):
+        return f"ctx.entry_counts[{state}] += 1;"
+
+    def exited(self, state):
+        return f"ctx.dwell[{state}] += ctx.now - ctx.state_timers[{state}];"
+
+    def user_code(self, state_id, kind, code):
+        """User code of one state with its counters: entries before entry code, dwell after exit code."""
+        code = self.timed(state_id, kind, code) or ""
+        if kind == 'entry':
+            return f"{self.entered(state_id)}\n{code}"
+        if kind == 'exit':
+            return f"{code}\n{self.exited(state_id)}"
+        return code
+
+# Events, shared by all Rust runtimes. Only emitted when a transition has an 'event:'.
+EVENT_ITEMS = """
+// --- Events ---
+#[allow(non_camel_case_types)]
+#[derive(Clone, Copy, PartialEq, Eq, Debug)]
+pub enum Event {
+%s
+}
+
+pub const EVENT_QUEUE_SIZE: usize = %d;
+"""
+
+EVENT_FIELDS = """
+
+    // Queued events (ring buffer), dispatched at the start of the next tick
+    pub events: [Event; EVENT_QUEUE_SIZE],
+    pub event_head: usize,
+    pub event_count: usize,"""
+
+EVENT_INIT = """
+            events: [Event::%s; EVENT_QUEUE_SIZE],
+            event_head: 0,
+            event_count: 0,"""
+
+EVENT_DRAIN = """
+
+        // Events queued before this tick, in order; events they post wait for the next one.
+        for _ in 0..self.ctx.event_count {
+            let event = self.ctx.events[self.ctx.event_head];
+            self.ctx.event_head = (self.ctx.event_head + 1) % EVENT_QUEUE_SIZE;
+            self.ctx.event_count -= 1;
+            self.dispatch(event);
+        }
+        self.ctx.transition_fired = false;"""
+
+EVENT_METHODS = """
+    // Queue an event for the next tick; false if the queue is full.
+    pub fn post_event(&mut self, event: Event) -> bool {
+        if self.event_count == EVENT_QUEUE_SIZE {
+            return false;
+        }
+        self.events[(self.event_head + self.event_count) % EVENT_QUEUE_SIZE] = event;
+        self.event_count += 1;
+        true
+    }
+"""
+
+def event_items(events, queue_size):
+    return EVENT_ITEMS % ("\n".join(f"    {event}," for event in events), queue_size)
+
+def active_set_items(index):
+    ids = "\n".join(f"pub const STATE_{info.c_name}: usize = {info.index};" for info in index)
+    ends = index.subtree_ends()
+    lines = [", ".join(str(e) for e in ends[i:i + 16]) for i in range(0, len(ends), 16)]
+    paths = [_rust_str(state_path(info)) for info in index]
+    paths = [", ".join(paths[i:i + 4]) for i in range(0, len(paths), 4)]
+    return ACTIVE_SET_ITEMS % (len(index), ids, "\n    " + ",\n    ".join(lines) + ",\n",
+                               index.max_active(), "\n    " + ",\n    ".join(paths) + ",\n")
+
+def trace_hook(hook, code, indent="    "):
+    """Hook code, compiled in unless --cfg sm_trace_level is below the hook's level."""
+    if not code or not str(code).strip():
+        return ""
+    below = ", ".join(f'sm_trace_level = "{level}"' for level in range(TRACE_LEVELS[hook]))
+    body = "\n".join(f"{indent}    {line}" for line in str(code).splitlines())
+    return f"#[cfg(not(any({below})))]\n{indent}{{\n{body}\n{indent}}}"
+
+def _rust_str(text):
+    return '"' + str(text).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+EVENT_TEMPLATE = """
+fn state_{c_name}_event(ctx: &mut Context, event: Event{params}) {{
+    {preamble}
+    match event {{
+{arms}
+        _ => {{}}
+    }}
+    {children}
+}}
+"""
+
+POINTER_EVENT_ITEMS = """
+type EventFn = fn(&mut Context, Event);
+"""
+
+POINTER_DISPATCH = """
+
+    // Run the transitions listening to event on the active states, now.
+    pub fn dispatch(&mut self, event: Event) {
+        if self.root.is_some() {
+            self.ctx.transition_fired = false;
+            state_root_event(&mut self.ctx, event);
+            if self.ctx.terminated {
+                self.root = None;
+            }
+        }
+    }"""
+
 INSPECTOR_TEMPLATE = """
-fn inspect_{c_name}(ctx: &Context, buf: &mut String) {{
+fn inspect_{c_name}(ctx: &Context, buf: &mut String{params}) {{
     {push_name}
     {content}
 }}
 """
 
 class RustGenerator:
-    def __init__(self, data):
+    BACKEND = "rust"
+
+    def __init__(self, data, index=None, plans=None, profile=None, instrument=None,
+                 compact=None):
         self.data = data
-        self.state_counter = 0
-        self.outputs = {'context_ptrs': [], 'context_init': [], 'functions': [], 'impls': []}
-        self.inspect_list = []
+        self.profile = profile
+        self.index = index or ModelIndex(data)
+        self.outputs = {'context_ptrs': Spool("\n    "), 'context_init': Spool("\n            "),
+                        'functions': Spool("\n"), 'impls': Spool("\n    ")}
+        self.inspect_list = Spool("\n")
         self.decisions = data.get('decisions', {})
+        self.plans = plans or ModelPlans(self.index, self.decisions, ticks=compact == 'ticks')
         self.hooks = data.get('hooks', {})
         if 'transition' not in self.hooks and 'transition' in data:
              self.hooks['transition'] = data['transition']
         self.includes = data.get('includes', '')
-
-    def _fmt_func(self, path):
-        return "state_" + flatten_name(path, "_") + "_exit"
-        
-    def _fmt_entry(self, path, suffix="_entry"):
-        return "state_" + flatten_name(path, "_") + suffix
+        self.events = self.plans.events
+        self.subtree_events = self.plans.subtree_events() if self.events else None
+        self.trace = trace_buffer_size(data)
+        self.microsteps = microstep_limit(data)
+        self.instrument = RustInstrumentation(instrument, self.index, self.plans) if instrument else None
+        self.layout = ContextLayout(self.index, self.plans, self.hooks, compact, bool(instrument)) if compact else None
+        # Machine instances share their functions unless the layout or the counters need a state's own id.
+        self.instances = None if compact or self.trace or instrument else Instances(self.index)
 
     def generate(self):
+        sink = io.StringIO()
+        self.write(sink)
+        return sink.getvalue(), ""
+
+    def write(self, sink):
+        """Generate the machine and stream it to the file-like sink."""
         root_data = {
             'initial': self.data['initial'], 
             'states': self.data['states'],
@@ -241,299 +883,316 @@ class RustGenerator:
             'exit': self.data.get('exit', '// Root Exit')
         }
         
+        if self.plans.used_decisions():
+            self.outputs['functions'].append(decision_functions(self.plans, "Time" if self.layout else "f64"))
+        for key, number in self.plans.shared_steps().items():
+            self.outputs['functions'].append(STEPS_FUNCTION.format(
+                steps=describe_steps(key), number=number,
+                calls="\n".join(f"    {self._fmt_step(op, path)}" for op, path in key)))
         self.recurse(['root'], root_data, None)
         self.gen_inspector(['root'], root_data, 'root')
 
         user_init = self.data.get('context_init', '')
 
-        header = HEADER % (
+        events = self.events
+        write_template(sink, HEADER,
             self.includes, 
-            self.state_counter,
-            "\n    ".join(self.outputs['context_ptrs']),
+            active_set_items(self.index)
+            + (compact_items(self.layout, self.plans) if self.layout else deadline_items(self.plans))
+            + (trace_items(self.trace, self.index, self.plans) if self.trace else "")
+            + (self.instrument.items() if self.instrument else "")
+            + (RTC_ITEMS % self.microsteps if self.microsteps else "")
+            + (machine_items(self.instances) if self.instances else ""),
+            event_items(events, event_queue_size(self.data)) + POINTER_EVENT_ITEMS if events else "",
+            TIME_FIELDS % (("Time", "Time", len(self.layout.timers)) if self.layout else ("f64", "f64", len(self.index))),
+            (EVENT_FIELDS if events else "") + (TRACE_FIELDS if self.trace else "")
+            + (self.instrument.fields() if self.instrument else "") + (RTC_FIELDS if self.microsteps else ""),
+            self.outputs['context_ptrs'],
             self.data.get('context', ''), 
-            self.state_counter,
-            "\n            ".join(self.outputs['context_init']),
+            TIME_INIT % ((("0", "0") if self.layout.ticks else ("0.0", "0.0")) + (len(self.layout.timers),)
+                         if self.layout else ("0.0", "0.0", len(self.index))),
+            (EVENT_INIT % events[0] if events else "") + (TRACE_INIT if self.trace else "")
+            + (self.instrument.init() if self.instrument else "") + (RTC_INIT if self.microsteps else ""),
+            self.outputs['context_init'],
             user_init,
-            "\n    ".join(self.outputs['impls'])
+            (TRACE_TICK if self.trace else "") + (EVENT_DRAIN if events else ""),
+            run_to_completion(STEP) if self.microsteps else STEP,
+            POINTER_DISPATCH if events else "",
+            ACTIVE_SET_METHODS + (compact_deadline_method(self.layout) if self.layout else DEADLINE_METHOD),
+            (EVENT_METHODS if events else "") + (TRACE_METHODS if self.trace else "")
+            + (self.instrument.methods() if self.instrument else ""),
+            self.outputs['impls']
         )
         
-        source = "\n".join(self.outputs['functions'])
-        source += "\n// --- Inspection ---\n" + "\n".join(self.inspect_list)
+        self.outputs['functions'].copy_to(sink)
+        sink.write("\n// --- Inspection ---\n")
+        self.inspect_list.copy_to(sink)
 
-        return header + source, ""
+        for spool in list(self.outputs.values()) + [self.inspect_list]:
+            spool.close()
 
-    def emit_transition_logic(self, name_path, t, indent_level=1):
+    def emit_transition_logic(self, plan, indent_level=1):
         indent = "    " * indent_level
         code = ""
-        raw_target = t.get('to')
         
-        test_val = t.get('guard', True)
+        test_val = plan.guard
         if test_val is True: test_cond = "true"
         elif test_val is False: test_cond = "false"
         else: test_cond = str(test_val)
         
-        import re
         test_cond = re.sub(r'IN_STATE\(([\w_]+)\)', r'ctx.in_state_\1()', test_cond)
 
         code += f"{indent}if {test_cond} {{\n"
-        
-        src_str = "/" + "/".join(name_path[1:])
-        dst_str = "???"
-        is_termination = False
-        
-        if raw_target is None or raw_target == "null" or raw_target == "":
-            dst_str = "Termination"
-            is_termination = True
-        elif raw_target in self.decisions:
-            dst_str = f"Decision({raw_target})" 
-        else:
-            base_target, forks = parse_fork_target(raw_target)
-            target_path = resolve_target_path(name_path, base_target)
-            if forks:
-                dst_str = "/" + "/".join(target_path[1:]) + str(forks)
-            else:
-                dst_str = "/" + "/".join(target_path[1:])
+        code += self._fire_code(plan, indent)
+        code += f"{indent}}}\n"
+        return code
 
+    def _fire_code(self, plan, indent):
+        # Body of a plan's guard block (indent is the block's), from the hook to the return.
+        code = ""
         hook_code = self.hooks.get('transition', '')
-        if raw_target not in self.decisions:
-             code += f'{indent}    let t_src = "{src_str}";\n'
-             code += f'{indent}    let t_dst = "{dst_str}";\n'
+        shared = self._shared(plan.source)
+        if plan.kind != 'decision':
+             used = referenced_vars(hook_code, plan.action)
+             src, dst = self._instance_paths(plan) if shared else (_rust_str(plan.src_str), _rust_str(plan.dst_str))
+             if 't_src' in used:
+                 code += f'{indent}    let t_src = {src};\n'
+             if 't_dst' in used:
+                 code += f'{indent}    let t_dst = {dst};\n'
              if hook_code:
-                 formatted_hook = "\n".join([f"{indent}    {line}" for line in hook_code.splitlines()])
-                 code += formatted_hook + "\n"
+                 code += f"{indent}    {trace_hook('transition', hook_code, indent + '    ')}\n"
 
         code += f"{indent}    ctx.transition_fired = true;\n"
+        if self.trace and plan.kind != 'decision':
+            code += f"{indent}    {trace_call(plan)}\n"
+        if self.instrument:
+            code += f"{indent}    {self.instrument.fire(plan)}\n"
         
-        action_code = t.get('action')
+        action_code = plan.action
         if action_code:
              formatted_action = "\n".join([f"{indent}    {line}" for line in action_code.splitlines()])
              code += formatted_action + "\n"
 
-        if is_termination:
-            exit_funcs = get_exit_sequence(name_path, ['root'], self._fmt_func)
-            code += "".join([f"{indent}    {fn}(ctx);\n" for fn in exit_funcs])
-            code += f"{indent}    state_root_exit(ctx);\n"
-            code += f"{indent}    ctx.terminated = true;\n"
-            code += f"{indent}    return;\n"
-
-        elif raw_target in self.decisions:
-            decision_rules = self.decisions[raw_target]
-            for rule in decision_rules:
-                code += self.emit_transition_logic(name_path, rule, indent_level + 1)
+        if plan.kind == 'decision':
+            # The decision's guards are evaluated once, by its shared function.
+            code += f"{indent}    match {decision_call(self.plans, plan.decision)} {{\n"
+            for number, branch in enumerate(plan.branches, 1):
+                code += f"{indent}        {number} => {{\n{self._fire_code(branch, indent + '        ')}{indent}        }}\n"
+            code += f"{indent}        _ => {{}}\n{indent}    }}\n"
         else:
-            base_target, forks = parse_fork_target(raw_target)
-            target_path = resolve_target_path(name_path, base_target)
-            
-            # LCA calculation
-            lca_index = get_lca_index(name_path, target_path)
-
-            # --- CROSS-LIMB ORTHOGONAL CHECK ---
-            is_cross_limb = False
-            container_path = name_path[:lca_index]
-            lca_data = resolve_state_data(self.data, container_path)
-            
-            if lca_data and lca_data.get('orthogonal', False):
-                limb_idx = lca_index
-                
-                if len(name_path) > limb_idx and len(target_path) > limb_idx:
-                    source_limb = name_path[limb_idx]
-                    target_limb = target_path[limb_idx]
-                    
-                    if source_limb != target_limb:
-                        is_cross_limb = True
-                        
-                        target_limb_path = name_path[:lca_index] + [target_limb]
-                        target_limb_c_name = flatten_name(target_limb_path, "_")
-                        
-                        # --- OPTIMIZED HOT-SWAP ---
-                        # If the target limb is Composite (has children) and we are targeting deeper,
-                        # we only exit the active child of the limb, keeping the limb itself active.
-                        limb_data = resolve_state_data(self.data, target_limb_path)
-                        is_composite_limb = limb_data and 'states' in limb_data
-                        is_targeting_deeper = len(target_path) > len(target_limb_path)
-                        
-                        if is_composite_limb and is_targeting_deeper:
-                            # 1. Exit active child of target limb (Keep Limb Active)
-                            code += f"{indent}    if let Some(exit_fn) = ctx.ptr_{target_limb_c_name}_exit {{ exit_fn(ctx); }}\n"
-                            # 2. Start entry from INSIDE the limb
-                            entry_source = target_limb_path
-                        else:
-                            # Standard Reset (Exit Limb -> Enter Limb)
-                            code += f"{indent}    if let Some(exit_fn) = ctx.ptr_{target_limb_c_name}_region_exit {{ exit_fn(ctx); }}\n"
-                            entry_source = container_path
-
-                        # 3. Entry Sequence
-                        if forks is None:
-                             entry_funcs = get_entry_sequence(entry_source, target_path, self._fmt_entry)
-                             code += "".join([f"{indent}    {fn}(ctx);\n" for fn in entry_funcs])
-                        else:
-                             def _fmt_entry_forced_start(path, suffix):
-                                if path == target_path:
-                                    return "state_" + flatten_name(path, "_") + "_start"
-                                return "state_" + flatten_name(path, "_") + suffix
-                             entry_funcs = get_entry_sequence(entry_source, target_path, _fmt_entry_forced_start)
-                             code += "".join([f"{indent}    {fn}(ctx);\n" for fn in entry_funcs])
-                        
-                        code += f"{indent}    return;\n"
-                        code += f"{indent}}}\n"
-                        return code
-
-            # --- IMPLICIT ORTHOGONAL / LOCAL LIMB LOGIC ---
-            if forks is None:
-                parallel_ancestor_idx = -1
-                for i in range(len(target_path)):
-                    partial_path = target_path[:i+1]
-                    s_data = resolve_state_data(self.data, partial_path)
-                    if s_data and s_data.get('orthogonal', False):
-                        parallel_ancestor_idx = i
-                        break
-                
-                if parallel_ancestor_idx != -1 and parallel_ancestor_idx < len(target_path) - 1:
-                    limb_idx = parallel_ancestor_idx + 1
-                    is_same_limb = False
-                    if len(name_path) > limb_idx:
-                        if name_path[limb_idx] == target_path[limb_idx]:
-                            is_same_limb = True
-                    
-                    if not is_same_limb:
-                        base_path_list = target_path[:parallel_ancestor_idx+1]
-                        fork_parts = target_path[parallel_ancestor_idx+1:]
-                        fork_str = "/".join(fork_parts)
-                        target_path = base_path_list
-                        forks = [fork_str]
-                        base_target = "/" + "/".join(base_path_list[1:])
-
-            # --- DYNAMIC CHILD EXIT FIX (For Container Transitions) ---
-            if lca_index >= len(name_path):
-                 my_data = resolve_state_data(self.data, name_path)
-                 if my_data and 'states' in my_data and not my_data.get('orthogonal', False):
-                      my_c_name = flatten_name(name_path, "_")
-                      code += f"{indent}    if let Some(exit_fn) = ctx.ptr_{my_c_name}_exit {{ exit_fn(ctx); }}\n"
-
-            # --- Standard Exit Sequence ---
-            exit_funcs = get_exit_sequence(name_path, target_path, self._fmt_func)
-            code += "".join([f"{indent}    {fn}(ctx);\n" for fn in exit_funcs])
-
-            if forks is None:
-                entry_funcs = get_entry_sequence(name_path, target_path, self._fmt_entry)
-                code += "".join([f"{indent}    {fn}(ctx);\n" for fn in entry_funcs])
+            outlined = self.plans.shared_steps().get(plan.step_key)
+            if outlined is not None:
+                code += f"{indent}    transition_steps_{outlined}(ctx);\n"
             else:
-                def _fmt_entry_forced_start(path, suffix):
-                    if path == target_path:
-                        return "state_" + flatten_name(path, "_") + "_start"
-                    return "state_" + flatten_name(path, "_") + suffix
-                
-                entry_funcs = get_entry_sequence(name_path, target_path, _fmt_entry_forced_start)
-                code += "".join([f"{indent}    {fn}(ctx);\n" for fn in entry_funcs])
-                
-                parallel_data = resolve_state_data(self.data, target_path)
-                if not parallel_data or 'states' not in parallel_data:
-                     pass 
-                else:
-                    for child_name, child_data in parallel_data['states'].items():
-                        matching_fork = None
-                        for fork in forks:
-                            parts = fork.split('/')
-                            if parts[0] == child_name:
-                                matching_fork = fork
-                                break
-                        
-                        if matching_fork:
-                            fork_target_path = target_path + matching_fork.split('/')
-                            deep_entries = get_entry_sequence(target_path, fork_target_path, self._fmt_entry)
-                            code += "".join([f"{indent}    {fn}(ctx);\n" for fn in deep_entries])
-                        else:
-                            child_path = target_path + [child_name]
-                            init_func = self._fmt_entry(child_path, "_entry")
-                            code += f"{indent}    {init_func}(ctx);\n"
-
+                slot = "inst" if shared else None
+                code += "".join([f"{indent}    {self._fmt_step(op, path, slot)}\n" for op, path in plan.steps])
+            if plan.terminate:
+                code += f"{indent}    ctx.terminated = true;\n"
             code += f"{indent}    return;\n"
-
-        code += f"{indent}}}\n"
         return code
 
+    def _fmt_step(self, op, path, slot=None):
+        if self.instances:
+            info = self.index.get(path)
+            if self.instances.of(info) or (op == 'exit_child' and self.instances.using(info)):
+                return self._instance_step(op, info, slot)
+        c_name = flatten_name(path, "_")
+        if op == 'exit_child':
+            if self.layout:
+                return f"state_{c_name}_child_exit(ctx);"
+            return f"if let Some(exit_fn) = ctx.ptr_{c_name}_exit {{ exit_fn(ctx); }}"
+        if op == 'exit_region':
+            if self.layout:
+                return f"if ctx.in_state({self.index.get(path).index}) {{ state_{c_name}_exit(ctx); }}"
+            return f"if let Some(exit_fn) = ctx.ptr_{c_name}_region_exit {{ exit_fn(ctx); }}"
+        return f"state_{c_name}_{op}(ctx);"
+
+    def _instance_step(self, op, info, slot):
+        # A step into a machine instance: the instance's number, or slot in the machine's shared functions.
+        name = self.instances.shared_name(info)
+        if slot is None:
+            owner = self.instances.of(info)
+            slot, state_id = (owner[1] if owner else self.instances.using(info)[1]), info.index
+        else:
+            state_id = self.instances.state_id(info, slot)
+        if op == 'exit_child':
+            return f"state_{name}_child_exit(ctx, {slot});"
+        if op == 'exit_region':
+            return f"if ctx.in_state({state_id}) {{ state_{name}_exit(ctx, {slot}); }}"
+        return f"state_{name}_{op}(ctx, {slot});"
+
+    def _shared(self, info):
+        # True for the states whose functions all instances of their machine share.
+        return bool(self.instances) and self.instances.of(info) is not None
+
+    def _instance_paths(self, plan):
+        # t_src / t_dst of a transition inside a machine, for the instance running it.
+        src = f"STATE_PATHS[{self.instances.state_id(plan.source, 'inst')}]"
+        if not plan.forks:
+            return src, f"STATE_PATHS[{self.instances.state_id(plan.target, 'inst')}]"
+        machine, _, first = self.instances.of(plan.source)
+        tail = plan.dst_str[len(state_path(first)):]
+        paths = ", ".join(_rust_str(state_path(user) + tail) for user in self.instances.users[machine])
+        return src, f"[{paths}][inst]"
+
+    def _transition_code(self, name_path, event=None):
+        trans_code = ""
+        for i, plan in enumerate(self.plans.for_event(name_path, event)):
+            try:
+                trans_code += self.emit_transition_logic(plan, 1)
+            except Exception as e:
+                raise Exception(f"Transition #{i+1} logic error: {e}")
+        return trans_code
+
+    def _preamble(self, info, *code):
+        if self._shared(info):
+            return preamble(SHARED_PREAMBLE_LINES, info, *code, state_id=self.instances.state_id(info, "inst"))
+        if not self.layout:
+            return preamble(PREAMBLE_LINES, info, *code)
+        lines = TICKS_PREAMBLE_LINES if self.layout.ticks else COMPACT_PREAMBLE_LINES
+        return preamble(lines, info, *code, timer=self.layout.timer(info))
+
+    def _render(self, info, template, do_uses=(), **fields):
+        # One state's function bodies; timed per state when profiling.
+        # do_uses: the do function's code besides its transitions, for its preamble.
+        t0 = time.perf_counter()
+        transitions = self._transition_code(info.path)
+        t1 = time.perf_counter()
+        body = template.format(transitions=transitions, do_preamble=self._preamble(info, transitions, *do_uses),
+                               **fields)
+        if self.profile:
+            self.profile.record_state(self.BACKEND, info.path, time.perf_counter() - t0, t1 - t0)
+        return body
+
+    def _event_function(self, info, children, c_name, params=""):
+        # Dispatch for one state: its own listeners, then the active child / each region.
+        arms = []
+        for event in self.events:
+            code = self._transition_code(info.path, event)
+            if code:
+                arms.append(f"        Event::{event} => {{\n{code}        }}")
+        below = set()
+        for child in info.children:
+            below |= self.subtree_events[child.index]
+        return EVENT_TEMPLATE.format(c_name=c_name, params=params, preamble=self._preamble(info, *arms),
+                                     arms="\n".join(arms), children=children if below else "")
+
     def recurse(self, name_path, data, parent_ptrs):
-        # ... recurse implementation remains same as previous ...
-        # (Included in full below for completeness)
+        walk_nested(self._recurse(self.index.get(name_path), data, parent_ptrs))
+
+    def _recurse(self, info, data, parent_ptrs):
+        # Visitor for walk_nested: 'yield self._recurse(...)' visits a child.
+        name_path = info.path
         try:
-            my_id_num = self.state_counter
-            self.state_counter += 1
-            my_c_name = flatten_name(name_path, "_")
+            my_id_num = info.index
+            shared = self._shared(info)
+            if shared:
+                # A state of a machine instance: its functions take the instance number.
+                my_c_name = self.instances.shared_name(info)
+                state_id = self.instances.state_id(info, "inst")
+                shape = dict(params=", inst: usize", args=", inst")
+            else:
+                my_c_name = info.c_name
+                state_id = my_id_num
+                shape = dict(params="", args="")
             
-            disp_name = "/" + "/".join(name_path[1:]) if len(name_path) > 1 else "/"
-            preamble = FUNC_PREAMBLE.format(short_name=name_path[-1], display_name=disp_name, state_id=my_id_num)
-
             parent_run_ptr = parent_ptrs[0] if parent_ptrs else None
             parent_exit_ptr = parent_ptrs[1] if parent_ptrs else None
             parent_hist_ptr = parent_ptrs[2] if parent_ptrs else None
 
             if parent_run_ptr:
                 method = f"""
-        pub fn in_state_{my_c_name}(&self) -> bool {{
-            self.{parent_run_ptr}.map(|f| f as usize) == Some(state_{my_c_name}_do as usize)
+        pub fn in_state_{info.c_name}(&self) -> bool {{
+            self.in_state({my_id_num})
         }}"""
                 self.outputs['impls'].append(method)
 
-            set_parent_code = ""
-            clear_parent_code = ""
+            if shared and not self.instances.is_first(info):
+                # The other instances run the functions of the machine's first one.
+                for child in info.children:
+                    yield self._recurse(child, child.data, parent_ptrs)
+                return
+
+            set_parent_code = f"ctx.set_active({state_id});"
+            clear_parent_code = f"ctx.clear_active({state_id});"
             
-            if parent_run_ptr:
-                set_parent_code += f"ctx.{parent_run_ptr} = Some(state_{my_c_name}_do);\n    "
+            if parent_run_ptr and (self.layout or shared):
+                if not info.parent.is_orthogonal:
+                    number = ContextLayout.child_number(info)
+                    parent = self.instances.shared_name(info.parent) + "[inst]" if shared else info.parent.c_name
+                    set_parent_code += f"\n    ctx.active_{parent} = {number};"
+                    if parent_hist_ptr:
+                        set_parent_code += f"\n    ctx.hist_{parent} = {number};"
+                    clear_parent_code += f"\n    ctx.active_{parent} = 0;"
+            elif parent_run_ptr:
+                set_parent_code += f"\n    ctx.{parent_run_ptr} = Some(state_{my_c_name}_do);\n    "
                 set_parent_code += f"ctx.{parent_exit_ptr} = Some(state_{my_c_name}_exit);"
                 
                 if parent_hist_ptr:
                     set_parent_code += f"\n    ctx.{parent_hist_ptr} = Some(state_{my_c_name}_entry);"
 
-                clear_parent_code += f"ctx.{parent_run_ptr} = None;\n    "
+                clear_parent_code += f"\n    ctx.{parent_run_ptr} = None;\n    "
                 clear_parent_code += f"ctx.{parent_exit_ptr} = None;"
-                
-            trans_code = ""
-            for i, t in enumerate(data.get('transitions', [])):
-                try:
-                    trans_code += self.emit_transition_logic(name_path, t, 1)
-                except Exception as e:
-                    raise Exception(f"Transition #{i+1} logic error: {e}")
 
+                if self.events and not info.parent.is_orthogonal:
+                    set_parent_code += f"\n    ctx.{parent_run_ptr}_event = Some(state_{my_c_name}_event);"
+                    clear_parent_code += f"\n    ctx.{parent_run_ptr}_event = None;"
+                
             is_composite = 'states' in data
             is_parallel = data.get('orthogonal', False)
             
-            h_entry = self.hooks.get('entry', '')
-            h_do = self.hooks.get('do', '')
-            h_exit = self.hooks.get('exit', '')
+            h_entry = trace_hook('entry', self.hooks.get('entry', ''))
+            h_do = trace_hook('do', self.hooks.get('do', ''))
+            h_exit = trace_hook('exit', self.hooks.get('exit', ''))
+            user = {kind: data.get(kind, '') for kind in ('entry', 'do', 'exit')}
+            if self.instrument:
+                user = {kind: self.instrument.user_code(my_id_num, kind, code) for kind, code in user.items()}
+            if self.microsteps:
+                user['do'], h_do = first_microstep(user['do']), first_microstep(h_do)
+            timer = self.layout.timer(info) if self.layout else state_id
+            preambles = dict(start_timer="" if timer is None else f"ctx.state_timers[{timer}] = ctx.now;",
+                             entry_preamble=self._preamble(info, h_entry, user['entry']),
+                             exit_preamble=self._preamble(info, h_exit, user['exit']),
+                             do_uses=(h_do, user['do']))
 
             if is_composite:
                 if is_parallel:
-                    if parent_run_ptr:
+                    if shared:
+                        safety_check = f"if !ctx.in_state({state_id}) || ctx.transition_fired {{ return; }}"
+                    elif parent_run_ptr:
                         safety_check = f"if !ctx.in_state_{my_c_name}() || ctx.transition_fired {{ return; }}"
                     else:
                         safety_check = f"if ctx.transition_fired {{ return; }}"
 
                     p_entries, p_exits, p_ticks = "", "", ""
-                    for child_name, child_data in data['states'].items():
-                        child_path = name_path + [child_name]
-                        child_c_name = flatten_name(child_path, "_")
+                    event_children = f"{safety_check}\n"
+                    for child in info.children:
+                        child_c_name, args, child_id = self._child_ref(info, child)
                         
-                        region_ptr = f"ptr_{child_c_name}_region"
+                        region_ptr = f"ptr_{child.c_name}_region"
                         region_exit_ptr = f"{region_ptr}_exit"
 
-                        self.outputs['context_ptrs'].append(f"pub {region_ptr}: Option<StateFn>,")
-                        self.outputs['context_ptrs'].append(f"pub {region_exit_ptr}: Option<StateFn>,")
-                        self.outputs['context_init'].append(f"{region_ptr}: None,")
-                        self.outputs['context_init'].append(f"{region_exit_ptr}: None,")
-
-                        p_entries += f"    state_{child_c_name}_entry(ctx);\n"
-                        p_exits += f"    if let Some(f) = ctx.{region_exit_ptr} {{ f(ctx); }}\n"
-                        p_ticks += f"    state_{child_c_name}_do(ctx);\n"
+                        if self.layout or args:
+                            p_exits += f"    if ctx.in_state({child_id}) {{ state_{child_c_name}_exit(ctx{args}); }}\n"
+                        else:
+                            self.outputs['context_ptrs'].append(f"pub {region_ptr}: Option<StateFn>,")
+                            self.outputs['context_ptrs'].append(f"pub {region_exit_ptr}: Option<StateFn>,")
+                            self.outputs['context_init'].append(f"{region_ptr}: None,")
+                            self.outputs['context_init'].append(f"{region_exit_ptr}: None,")
+                            p_exits += f"    if let Some(f) = ctx.{region_exit_ptr} {{ f(ctx); }}\n"
+
+                        p_entries += f"    state_{child_c_name}_entry(ctx{args});\n"
+                        p_ticks += f"    state_{child_c_name}_do(ctx{args});\n"
                         if safety_check:
                             p_ticks += f"    {safety_check}\n"
+                        event_children += f"    state_{child_c_name}_event(ctx, event{args});\n    {safety_check}\n"
                         
-                        self.recurse(child_path, child_data, (region_ptr, region_exit_ptr, None))
+                        yield self._recurse(child, child.data, (region_ptr, region_exit_ptr, None))
 
-                    func_body = COMPOSITE_AND_TEMPLATE.format(
-                        c_name=my_c_name, state_id=my_id_num, preamble=preamble,
+                    func_body = self._render(info, COMPOSITE_AND_TEMPLATE,
+                        c_name=my_c_name, **shape, **preambles,
                         hook_entry=h_entry, hook_do=h_do, hook_exit=h_exit,
-                        entry=data.get('entry', ''), exit=data.get('exit', ''), do=data.get('do', ''),
-                        transitions=trans_code, 
+                        **user,
                         set_parent=set_parent_code, clear_parent=clear_parent_code,
                         parallel_entries=p_entries, parallel_exits=p_exits, parallel_ticks=p_ticks,
                         safety_check=safety_check
@@ -543,77 +1202,159 @@ class RustGenerator:
                     my_ptr = f"ptr_{my_c_name}"
                     my_exit_ptr = f"{my_ptr}_exit"
                     my_hist = f"hist_{my_c_name}"
-                    
-                    self.outputs['context_ptrs'].append(f"pub {my_ptr}: Option<StateFn>,")
-                    self.outputs['context_ptrs'].append(f"pub {my_exit_ptr}: Option<StateFn>,")
-                    self.outputs['context_ptrs'].append(f"pub {my_hist}: Option<StateFn>,")
-                    
-                    self.outputs['context_init'].append(f"{my_ptr}: None,")
-                    self.outputs['context_init'].append(f"{my_exit_ptr}: None,")
-                    self.outputs['context_init'].append(f"{my_hist}: None,")
-                    
-                    init_target = flatten_name(name_path + [data['initial']], "_")
+                    init_target = flatten_name(name_path + (data['initial'],), "_")
                     hist_bool = "true" if data.get('history', False) else "false"
 
-                    func_body = COMPOSITE_OR_TEMPLATE.format(
-                        c_name=my_c_name, state_id=my_id_num, preamble=preamble,
+                    if shared or (self.instances and self.instances.using(info)):
+                        children = self._machine_children(info)
+                    elif self.layout:
+                        children = self._compact_children(info, init_target)
+                    else:
+                        self.outputs['context_ptrs'].append(f"pub {my_ptr}: Option<StateFn>,")
+                        self.outputs['context_ptrs'].append(f"pub {my_exit_ptr}: Option<StateFn>,")
+                        self.outputs['context_ptrs'].append(f"pub {my_hist}: Option<StateFn>,")
+
+                        self.outputs['context_init'].append(f"{my_ptr}: None,")
+                        self.outputs['context_init'].append(f"{my_exit_ptr}: None,")
+                        self.outputs['context_init'].append(f"{my_hist}: None,")
+                        if self.events:
+                            self.outputs['context_ptrs'].append(f"pub {my_ptr}_event: Option<EventFn>,")
+                            self.outputs['context_init'].append(f"{my_ptr}_event: None,")
+                        children = dict(
+                            enter_child=ENTER_CHILD.format(history=hist_bool, hist=my_hist, initial=init_target),
+                            exit_child=EXIT_CHILD.format(exit_ptr=my_exit_ptr),
+                            do_child=DO_CHILD.format(ptr=my_ptr),
+                            event_children=f"if let Some(f) = ctx.{my_ptr}_event {{ f(ctx, event); }}")
+                    event_children = children.pop('event_children')
+
+                    func_body = self._render(info, COMPOSITE_OR_TEMPLATE,
+                        c_name=my_c_name, **shape, **preambles,
                         hook_entry=h_entry, hook_do=h_do, hook_exit=h_exit,
-                        entry=data.get('entry', ''), exit=data.get('exit', ''), do=data.get('do', ''),
-                        transitions=trans_code, history=hist_bool,
-                        self_ptr=my_ptr, self_exit_ptr=my_exit_ptr, self_hist_ptr=my_hist,
-                        initial_target=init_target, 
+                        **user,
+                        **children,
                         set_parent=set_parent_code, clear_parent=clear_parent_code
                     )
                     
                     use_history = data.get('history', False)
                     child_hist_ptr = my_hist if use_history else None
 
-                    for child_name, child_data in data['states'].items():
-                        self.recurse(name_path + [child_name], child_data, (my_ptr, my_exit_ptr, child_hist_ptr))
+                    for child in info.children:
+                        yield self._recurse(child, child.data, (my_ptr, my_exit_ptr, child_hist_ptr))
             else:
-                func_body = LEAF_TEMPLATE.format(
-                    c_name=my_c_name, state_id=my_id_num, preamble=preamble,
+                event_children = ""
+                func_body = self._render(info, LEAF_TEMPLATE,
+                    c_name=my_c_name, **shape, **preambles,
                     hook_entry=h_entry, hook_do=h_do, hook_exit=h_exit,
-                    entry=data.get('entry', ''), exit=data.get('exit', ''), do=data.get('do', ''),
-                    transitions=trans_code, 
+                    **user,
                     set_parent=set_parent_code, clear_parent=clear_parent_code
                 )
 
             self.outputs['functions'].append(func_body)
+            if self.events:
+                self.outputs['functions'].append(self._event_function(info, event_children, my_c_name, shape['params']))
         
         except Exception as e:
             raise Exception(f"Error generating state '{'/'.join(name_path)}': {str(e)}")
 
+    def _compact_children(self, info, initial):
+        # --compact: the OR composite's child number fields and the helpers dispatching on them.
+        c_name = info.c_name
+        id_type = f"u{self.layout.id_bits(info)}"
+        fields = ["active"] + (["hist"] if info.data.get('history', False) else [])
+        for field in fields:
+            self.outputs['context_ptrs'].append(f"pub {field}_{c_name}: {id_type},")
+            self.outputs['context_init'].append(f"{field}_{c_name}: 0,")
+        helpers = [('do', 'active', "", "(ctx)", "{}"), ('exit', 'active', "", "(ctx)", "{}")]
+        if 'hist' in fields:
+            helpers.append(('entry', 'hist', "", "(ctx)", f"state_{initial}_entry(ctx),"))
+        if self.events:
+            helpers.append(('event', 'active', ", event: Event", "(ctx, event)", "{}"))
+        for op, field, params, args, default in helpers:
+            arms = "\n".join(f"        {self.layout.child_number(child)} => state_{child.c_name}_{op}{args},"
+                             for child in info.children)
+            self.outputs['functions'].append(COMPACT_CHILD_TEMPLATE.format(
+                c_name=c_name, op=op, params=params, field=field, slot="", arms=arms, default=default))
+        return dict(
+            enter_child=f"state_{c_name}_child_entry(ctx);" if 'hist' in fields else f"state_{initial}_entry(ctx);",
+            exit_child=f"state_{c_name}_child_exit(ctx);",
+            do_child=f"state_{c_name}_child_do(ctx);",
+            event_children=f"state_{c_name}_child_event(ctx, event);")
+
+    def _child_ref(self, info, child):
+        # How info's functions reach a child: (function name part, arguments after ctx, id expression).
+        if not self._shared(child):
+            return child.c_name, "", child.index
+        if self._shared(info):
+            return self.instances.shared_name(child), ", inst", self.instances.state_id(child, "inst")
+        return self.instances.shared_name(child), f", {self.instances.using(info)[1]}", child.index
+
+    def _machine_children(self, info):
+        # Children of a using state or of an OR composite inside a machine: child numbers per
+        # instance, in arrays indexed by the instance number, dispatched by helpers the instances share.
+        name = self.instances.shared_name(info)
+        using = self.instances.using(info)
+        machine = using[0] if using else self.instances.of(info)[0]
+        slot = using[1] if using else "inst"
+        history = info.data.get('history', False)
+        first = self.instances.shared_name(next(c for c in info.children if c.name == info.data['initial']))
+        if slot in (0, "inst"):
+            count = len(self.instances.users[machine])
+            fields = ["active"] + (["hist"] if history else [])
+            for field in fields:
+                self.outputs['context_ptrs'].append(f"pub {field}_{name}: [u{ContextLayout.id_bits(info)}; {count}],")
+                self.outputs['context_init'].append(f"{field}_{name}: [0; {count}],")
+            helpers = [('do', 'active', ", inst: usize", "(ctx, inst)", "{}"),
+                       ('exit', 'active', ", inst: usize", "(ctx, inst)", "{}")]
+            if history:
+                helpers.append(('entry', 'hist', ", inst: usize", "(ctx, inst)", f"state_{first}_entry(ctx, inst),"))
+            if self.events:
+                helpers.append(('event', 'active', ", event: Event, inst: usize", "(ctx, event, inst)", "{}"))
+            for op, field, params, args, default in helpers:
+                arms = "\n".join(f"        {ContextLayout.child_number(child)} => "
+                                 f"state_{self.instances.shared_name(child)}_{op}{args},"
+                                 for child in info.children)
+                self.outputs['functions'].append(COMPACT_CHILD_TEMPLATE.format(
+                    c_name=name, op=op, params=params, field=field, slot="[inst]", arms=arms, default=default))
+        return dict(
+            enter_child=f"state_{name}_child_entry(ctx, {slot});" if history else f"state_{first}_entry(ctx, {slot});",
+            exit_child=f"state_{name}_child_exit(ctx, {slot});",
+            do_child=f"state_{name}_child_do(ctx, {slot});",
+            event_children=f"state_{name}_child_event(ctx, event, {slot});")
+
     def gen_inspector(self, name_path, data, ptr_name_struct):
-        my_c_name = flatten_name(name_path, "_")
-        disp_name = "" if name_path == ['root'] else name_path[-1]
+        walk_nested(self._gen_inspector(self.index.get(name_path), data))
+
+    def _gen_inspector(self, info, data):
+        shared = self._shared(info)
+        if shared and not self.instances.is_first(info):
+            return
+        my_c_name = self.instances.shared_name(info) if shared else info.c_name
+        disp_name = "" if info.parent is None else info.name
         push_name = f'buf.push_str("{disp_name}");' if disp_name else ""
-        content = ""
+        content = []
 
         is_composite = 'states' in data
         if is_composite:
             if data.get('orthogonal', False):
-                content += 'buf.push_str("/[");\n'
-                children = list(data['states'].items())
-                for i, (child_name, child_data) in enumerate(children):
-                    child_path = name_path + [child_name]
-                    child_func = f"inspect_{flatten_name(child_path, '_')}"
-                    self.gen_inspector(child_path, child_data, None)
-                    content += f"    {child_func}(ctx, buf);\n"
-                    if i < len(children)-1: content += '    buf.push_str(",");\n'
-                content += 'buf.push_str("]");\n'
+                content.append('buf.push_str("/[");\n')
+                for i, child in enumerate(info.children):
+                    yield self._gen_inspector(child, child.data)
+                    name, args, _ = self._child_ref(info, child)
+                    content.append(f"    inspect_{name}(ctx, buf{args});\n")
+                    if i < len(info.children)-1: content.append('    buf.push_str(",");\n')
+                content.append('buf.push_str("]");\n')
             else:
-                my_ptr = f"ptr_{my_c_name}"
-                for child_name, child_data in data['states'].items():
-                    self.gen_inspector(name_path + [child_name], child_data, my_ptr)
+                for child in info.children:
+                    yield self._gen_inspector(child, child.data)
                 first = True
-                for child_name, child_data in data['states'].items():
-                    c_name = flatten_name(name_path + [child_name], "_")
+                for child in info.children:
+                    c_name, args, child_id = self._child_ref(info, child)
                     else_txt = "else " if not first else ""
-                    content += f"    {else_txt}if ctx.{my_ptr}.map(|f| f as usize) == Some(state_{c_name}_do as usize) {{\n"
-                    content += f'        buf.push_str("/");\n'
-                    content += f"        inspect_{c_name}(ctx, buf);\n"
-                    content += "    }\n"
+                    content.append(f"    {else_txt}if ctx.in_state({child_id}) {{\n")
+                    content.append(f'        buf.push_str("/");\n')
+                    content.append(f"        inspect_{c_name}(ctx, buf{args});\n")
+                    content.append("    }\n")
                     first = False
 
-        self.inspect_list.append(INSPECTOR_TEMPLATE.format(c_name=my_c_name, push_name=push_name, content=content))
+        self.inspect_list.append(INSPECTOR_TEMPLATE.format(c_name=my_c_name, params=", inst: usize" if shared else "",
+                                                           push_name=push_name, content="".join(content)))
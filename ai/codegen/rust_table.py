@@ -0,0 +1,583 @@
+from .model import ModelIndex
+from .plan import ModelPlans
+from .common import event_queue_size, trace_buffer_size, microstep_limit, referenced_vars
+from .rust_lang import (trace_hook, ACTIVE_SET_METHODS, DEADLINE_METHOD, active_set_items, deadline_items,
+                        event_items, EVENT_FIELDS, EVENT_INIT, EVENT_DRAIN, EVENT_METHODS,
+                        trace_items, trace_call, TRACE_FIELDS, TRACE_INIT, TRACE_TICK, TRACE_METHODS,
+                        RustInstrumentation, RTC_ITEMS, RTC_FIELDS, RTC_INIT, run_to_completion)
+from .tables import MachineTables, ROW_DECISION, merge_arms
+import io
+import re
+
+HEADER = """
+#![allow(unused_variables)]
+#![allow(dead_code)]
+#![allow(non_snake_case)]
+#![allow(unreachable_patterns)]
+#![allow(non_upper_case_globals)]
+#![allow(unexpected_cfgs)]
+
+// --- User Includes / Context Types ---
+%s
+
+%s%s
+pub type StateId = %s;
+pub const TOTAL_SLOTS: usize = %d;
+const NO_STATE: StateId = %d;
+
+pub struct Context {
+    pub now: f64,
+    pub state_timers: [f64; TOTAL_STATES],
+    pub transition_fired: bool,
+    pub terminated: bool,
+
+    // One bit per active state id
+    pub active_states: [u64; ACTIVE_WORDS],
+
+    // State held by each slot, last child of each history composite
+    pub active: [StateId; TOTAL_SLOTS],
+    pub hist: [StateId; TOTAL_SLOTS],%s
+
+    // User Context Fields
+    %s
+}
+
+pub struct StateMachine {
+    pub ctx: Context,
+    running: bool,
+}
+
+impl StateMachine {
+    pub fn new() -> Self {
+        let ctx = Context {
+            now: 0.0,
+            state_timers: [0.0; TOTAL_STATES],
+            transition_fired: false,
+            terminated: false,
+            active_states: [0; ACTIVE_WORDS],
+            active: [NO_STATE; TOTAL_SLOTS],
+            hist: [NO_STATE; TOTAL_SLOTS],%s
+
+            // Init User Context
+            %s
+        };
+
+        let mut sm = StateMachine {
+            ctx,
+            running: true,
+        };
+
+        // Start Machine
+        sm_entry(&mut sm.ctx, 0);
+        sm
+    }
+
+    pub fn tick(&mut self) {
+        self.ctx.transition_fired = false;%s%s
+    }
+
+    pub fn is_running(&self) -> bool {
+        self.running
+    }
+
+    pub fn get_state_str(&self) -> String {
+        let mut buffer = String::new();
+        self.write_state_str(&mut buffer);
+        buffer
+    }
+
+    // get_state_str into a caller-owned buffer: no allocation once it has grown.
+    pub fn write_state_str(&self, buffer: &mut String) {
+        buffer.clear();
+        if self.running {
+            sm_inspect(&self.ctx, 0, buffer);
+        } else {
+            buffer.push_str("FINISHED");
+        }
+    }%s
+}
+
+// --- Helper Macros/Methods ---
+impl Context {
+%s%s
+    %s
+}
+"""
+
+STEP = """
+
+        if self.running {
+            sm_do(&mut self.ctx, 0);
+
+            if self.ctx.terminated {
+                self.running = false;
+            }
+        }"""
+
+TABLES = """
+// --- State Tables ---
+const LEAF: u8 = 0;
+const OR: u8 = 1;
+const AND: u8 = 2;
+
+const ROW_NORMAL: u8 = 0;
+const ROW_DECISION: u8 = 1;
+const ROW_TERMINATE: u8 = 2;
+
+const OP_EXIT_CHILD: u8 = 0;
+const OP_EXIT_REGION: u8 = 1;
+const OP_EXIT: u8 = 2;
+const OP_START: u8 = 3;
+const OP_ENTRY: u8 = 4;
+
+static PARENT: [StateId; TOTAL_STATES] = [%s];
+static KIND: [u8; TOTAL_STATES] = [%s];
+static SLOT: [StateId; TOTAL_STATES] = [%s];
+static CHILD_SLOT: [StateId; TOTAL_STATES] = [%s];
+static INITIAL: [StateId; TOTAL_STATES] = [%s];
+static HISTORY: [bool; TOTAL_STATES] = [%s];
+static CHILD_RANGE: [(u32, u32); TOTAL_STATES] = [%s];
+static CHILDREN: [StateId; %d] = [%s];
+static ROW_RANGE: [(u32, u32); TOTAL_STATES] = [%s];
+static STATE_NAMES: [&str; TOTAL_STATES] = [%s];
+
+// (kind, source state, first, last): ops first..last, or branch rows for decisions
+static ROWS: [(u8, StateId, u32, u32); %d] = [%s];
+// (op, state)
+static OPS: [(u8, StateId); %d] = [%s];
+"""
+
+EVENT_TABLES = """
+// Per state, its groups first..last in EVENT_ROWS; (event, first row, last row)
+static EVENT_RANGE: [(u32, u32); TOTAL_STATES] = [%s];
+static EVENT_ROWS: [(u16, u32, u32); %d] = [%s];
+// Whether some descendant listens to an event
+static LISTENING: [bool; TOTAL_STATES] = [%s];
+"""
+
+EVENT_DISPATCH = """
+
+    // Run the transitions listening to event on the active states, now.
+    pub fn dispatch(&mut self, event: Event) {
+        if self.running {
+            self.ctx.transition_fired = false;
+            sm_event(&mut self.ctx, 0, event as u16);
+            if self.ctx.terminated {
+                self.running = false;
+            }
+        }
+    }"""
+
+EVENT_INTERPRETER = """
+// Like sm_do, but only the rows listening to event; no hooks or do code.
+fn sm_event(ctx: &mut Context, s: StateId, event: u16) {
+    let i = s as usize;
+    let (first, end) = EVENT_RANGE[i];
+    for k in first..end {
+        let (e, a, b) = EVENT_ROWS[k as usize];
+        if e == event {
+            if sm_fire(ctx, a, b) {
+                return;
+            }
+            break;
+        }
+    }
+    if !LISTENING[i] {
+        return;
+    }
+    match KIND[i] {
+        OR => {
+            let child = ctx.active[CHILD_SLOT[i] as usize];
+            if child != NO_STATE {
+                sm_event(ctx, child, event);
+            }
+        }
+        AND => {
+            if !ctx.in_state(i) || ctx.transition_fired {
+                return;
+            }
+            let (first, end) = CHILD_RANGE[i];
+            for k in first..end {
+                sm_event(ctx, CHILDREN[k as usize], event);
+                if !ctx.in_state(i) || ctx.transition_fired {
+                    return;
+                }
+            }
+        }
+        _ => {}
+    }
+}
+"""
+
+INTERPRETER = """
+// --- Interpreter ---
+fn sm_start(ctx: &mut Context, s: StateId) {
+    let i = s as usize;
+    ctx.state_timers[i] = ctx.now;
+    on_entry(ctx, s);
+    ctx.set_active(i);
+    let slot = SLOT[i];
+    if slot != NO_STATE {
+        ctx.active[slot as usize] = s;
+    }
+    let parent = PARENT[i];
+    if parent != NO_STATE && HISTORY[parent as usize] {
+        ctx.hist[CHILD_SLOT[parent as usize] as usize] = s;
+    }
+}
+
+fn sm_entry(ctx: &mut Context, s: StateId) {
+    sm_start(ctx, s);
+    let i = s as usize;
+    match KIND[i] {
+        OR => {
+            let last = ctx.hist[CHILD_SLOT[i] as usize];
+            if HISTORY[i] && last != NO_STATE {
+                sm_entry(ctx, last);
+            } else {
+                sm_entry(ctx, INITIAL[i]);
+            }
+        }
+        AND => {
+            let (first, end) = CHILD_RANGE[i];
+            for k in first..end {
+                sm_entry(ctx, CHILDREN[k as usize]);
+            }
+        }
+        _ => {}
+    }
+}
+
+fn sm_exit(ctx: &mut Context, s: StateId) {
+    let i = s as usize;
+    match KIND[i] {
+        OR => {
+            let child = ctx.active[CHILD_SLOT[i] as usize];
+            if child != NO_STATE {
+                sm_exit(ctx, child);
+            }
+        }
+        AND => {
+            let (first, end) = CHILD_RANGE[i];
+            for k in first..end {
+                let region = CHILDREN[k as usize];
+                if ctx.active[SLOT[region as usize] as usize] == region {
+                    sm_exit(ctx, region);
+                }
+            }
+        }
+        _ => {}
+    }
+    on_exit(ctx, s);
+    ctx.clear_active(i);
+    let slot = SLOT[i];
+    if slot != NO_STATE {
+        ctx.active[slot as usize] = NO_STATE;
+    }
+}
+
+fn sm_do(ctx: &mut Context, s: StateId) {
+    let i = s as usize;
+    on_do_hook(ctx, s);
+    let (first, end) = ROW_RANGE[i];
+    if sm_fire(ctx, first, end) {
+        return;
+    }
+    on_do(ctx, s);
+    match KIND[i] {
+        OR => {
+            let child = ctx.active[CHILD_SLOT[i] as usize];
+            if child != NO_STATE {
+                sm_do(ctx, child);
+            }
+        }
+        AND => {
+            // Stop if we are exited OR if any transition fired globally
+            if !ctx.in_state(i) || ctx.transition_fired {
+                return;
+            }
+            let (first, end) = CHILD_RANGE[i];
+            for k in first..end {
+                sm_do(ctx, CHILDREN[k as usize]);
+                if !ctx.in_state(i) || ctx.transition_fired {
+                    return;
+                }
+            }
+        }
+        _ => {}
+    }
+}
+
+// Fire the first enabled row of first..end; true if a transition was taken.
+fn sm_fire(ctx: &mut Context, first: u32, end: u32) -> bool {
+    for r in first..end {
+        if !guard(ctx, r) {
+            continue;
+        }
+        let (kind, _, a, b) = ROWS[r as usize];
+        action(ctx, r);
+        if kind == ROW_DECISION {
+            if sm_fire(ctx, a, b) {
+                return true;
+            }
+            continue;
+        }
+        for k in a..b {
+            let (op, id) = OPS[k as usize];
+            match op {
+                OP_EXIT_CHILD => {
+                    let child = ctx.active[CHILD_SLOT[id as usize] as usize];
+                    if child != NO_STATE {
+                        sm_exit(ctx, child);
+                    }
+                }
+                OP_EXIT_REGION => {
+                    if ctx.active[SLOT[id as usize] as usize] == id {
+                        sm_exit(ctx, id);
+                    }
+                }
+                OP_EXIT => sm_exit(ctx, id),
+                OP_START => sm_start(ctx, id),
+                _ => sm_entry(ctx, id),
+            }
+        }
+        if kind == ROW_TERMINATE {
+            ctx.terminated = true;
+        }
+        return true;
+    }
+    false
+}
+
+fn sm_inspect(ctx: &Context, s: StateId, buf: &mut String) {
+    let i = s as usize;
+    if s != 0 {
+        buf.push_str(STATE_NAMES[i]);
+    }
+    match KIND[i] {
+        OR => {
+            let child = ctx.active[CHILD_SLOT[i] as usize];
+            if child != NO_STATE {
+                buf.push_str("/");
+                sm_inspect(ctx, child, buf);
+            }
+        }
+        AND => {
+            buf.push_str("/[");
+            let (first, end) = CHILD_RANGE[i];
+            for k in first..end {
+                if k != first {
+                    buf.push_str(",");
+                }
+                sm_inspect(ctx, CHILDREN[k as usize], buf);
+            }
+            buf.push_str("]");
+        }
+        _ => {}
+    }
+}
+"""
+
+# User code: hooks run for every state, entry/exit/do code per state.
+USER_FUNC = """
+fn {name}(ctx: &mut Context, s: StateId) {{
+    {preamble}
+    {hook}
+    match s {{
+{arms}
+        _ => {{}}
+    }}
+}}
+"""
+
+GUARD_FUNC = """
+fn guard(ctx: &mut Context, r: u32) -> bool {{
+    {preamble}
+    match r {{
+{arms}
+        _ => true,
+    }}
+}}
+"""
+
+ACTION_FUNC = """
+fn action(ctx: &mut Context, r: u32) {{
+    {preamble}
+    match r {{
+{arms}
+        _ => {{
+            ctx.transition_fired = true;
+        }}
+    }}
+}}
+"""
+
+# Variables user code may use, for the state id `s`; declared only when mentioned.
+PREAMBLE_LINES = (
+    ('state_name', 'let state_name = STATE_NAMES[s as usize];'),
+    ('state_full_name', 'let state_full_name = STATE_PATHS[s as usize];'),
+    ('time', 'let time = ctx.now - ctx.state_timers[s as usize];'),
+)
+
+def _preamble(*code):
+    used = referenced_vars(*code)
+    return "\n    ".join(line for var, line in PREAMBLE_LINES if var in used)
+
+
+def _rust_str(text):
+    return '"' + str(text).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def _join(values, per_line=16):
+    values = [str(v) for v in values]
+    if len(values) <= per_line:
+        return ", ".join(values)
+    lines = [", ".join(values[i:i + per_line]) for i in range(0, len(values), per_line)]
+    return "\n    " + ",\n    ".join(lines) + ",\n"
+
+def _indent(code, prefix):
+    return "\n".join(prefix + line for line in code.splitlines())
+
+
+class RustTableGenerator:
+    """
+    Rust backend for --runtime table: static tables plus a generic
+    interpreter instead of one set of functions per state.
+    profile is accepted for build_model; the output is generated
+    whole, there are no per-state bodies to time.
+    """
+    BACKEND = "rust-table"
+
+    def __init__(self, data, index=None, plans=None, profile=None, instrument=None):
+        self.data = data
+        self.index = index or ModelIndex(data)
+        self.decisions = data.get('decisions', {})
+        self.plans = plans or ModelPlans(self.index, self.decisions)
+        self.tables = MachineTables(self.index, self.plans)
+        self.hooks = dict(data.get('hooks', {}))
+        if 'transition' not in self.hooks and 'transition' in data:
+             self.hooks['transition'] = data['transition']
+        self.includes = data.get('includes', '')
+        self.trace = trace_buffer_size(data)
+        self.microsteps = microstep_limit(data)
+        self.instrument = RustInstrumentation(instrument, self.index, self.plans) if instrument else None
+
+    def generate(self):
+        sink = io.StringIO()
+        self.write(sink)
+        return sink.getvalue(), ""
+
+    def write(self, sink):
+        """Generate the machine and stream it to the file-like sink."""
+        t = self.tables
+        impls = []
+        for info in self.index:
+            if info.parent:
+                impls.append(f"""
+        pub fn in_state_{info.c_name}(&self) -> bool {{
+            self.in_state({info.index})
+        }}""")
+
+        events = t.events
+        sink.write(HEADER % (
+            self.includes, active_set_items(self.index) + deadline_items(self.plans)
+            + (trace_items(self.trace, self.index, self.plans) if self.trace else "")
+            + (self.instrument.items() if self.instrument else "")
+            + (RTC_ITEMS % self.microsteps if self.microsteps else ""),
+            event_items(events, event_queue_size(self.data)) if events else "",
+            f"u{t.state_type_bits}", t.slots, t.no_state,
+            (EVENT_FIELDS if events else "") + (TRACE_FIELDS if self.trace else "")
+            + (self.instrument.fields() if self.instrument else "") + (RTC_FIELDS if self.microsteps else ""),
+            self.data.get('context', ''),
+            (EVENT_INIT % events[0] if events else "") + (TRACE_INIT if self.trace else "")
+            + (self.instrument.init() if self.instrument else "") + (RTC_INIT if self.microsteps else ""),
+            self.data.get('context_init', ''),
+            (TRACE_TICK if self.trace else "") + (EVENT_DRAIN if events else ""),
+            run_to_completion(STEP) if self.microsteps else STEP, EVENT_DISPATCH if events else "",
+            ACTIVE_SET_METHODS + DEADLINE_METHOD,
+            (EVENT_METHODS if events else "") + (TRACE_METHODS if self.trace else "")
+            + (self.instrument.methods() if self.instrument else ""), "\n    ".join(impls)))
+
+        names = [_rust_str(info.name) for info in self.index]
+        sink.write(TABLES % (
+            _join(t.parent), _join(t.kind), _join(t.slot), _join(t.child_slot), _join(t.initial),
+            _join("true" if h else "false" for h in t.history),
+            _join(f"({a}, {b})" for a, b in t.child_range),
+            len(t.children), _join(t.children),
+            _join(f"({a}, {b})" for a, b in t.row_range),
+            _join(names, 8),
+            len(t.rows), _join((f"({r.kind}, {r.state}, {r.first}, {r.last})" for r in t.rows), 6),
+            len(t.ops), _join((f"({op}, {state})" for op, state in t.ops), 8)))
+
+        if events:
+            sink.write(EVENT_TABLES % (
+                _join(f"({a}, {b})" for a, b in t.event_range),
+                len(t.event_rows), _join((f"({e}, {a}, {b})" for e, a, b in t.event_rows), 8),
+                _join("true" if flag else "false" for flag in t.listening)))
+
+        sink.write(INTERPRETER)
+        if events:
+            sink.write(EVENT_INTERPRETER)
+        self._write_user_code(sink)
+        self._write_transitions(sink)
+
+    def _write_user_code(self, sink):
+        root = self.index.get(['root'])
+        defaults = {'entry': '// Root Entry', 'do': '// Root Do', 'exit': '// Root Exit'}
+        for func, key, hook in (('on_entry', 'entry', 'entry'), ('on_exit', 'exit', 'exit'),
+                                ('on_do_hook', None, 'do'), ('on_do', 'do', None)):
+            arms = []
+            if key:
+                for info in self.index:
+                    code = info.data.get(key, defaults[key] if info is root else '')
+                    if code and code.strip():
+                        if self.instrument:
+                            code = self.instrument.timed(info.index, key, code)
+                        arms.append((info.index, code))
+                arms = [f"        {' | '.join(map(str, states))} => {{\n{_indent(code, '            ')}\n        }}"
+                        for states, code in merge_arms(arms)]
+            hook_code = trace_hook(hook, self.hooks.get(hook, '')) if hook else ''
+            if self.instrument and func in ('on_entry', 'on_exit'):
+                count = self.instrument.entered if func == 'on_entry' else self.instrument.exited
+                hook_code = count("s as usize") + ("\n    " + hook_code if hook_code else "")
+            if self.microsteps and func in ('on_do_hook', 'on_do') and (hook_code or arms):
+                # Run to completion: do code runs in the first microstep of a tick only.
+                hook_code = "if ctx.microsteps != 0 {\n        return;\n    }" + ("\n    " + hook_code if hook_code else "")
+            sink.write(USER_FUNC.format(name=func, preamble=_preamble(hook_code, *arms), hook=hook_code,
+                                        arms="\n".join(arms)))
+
+    def _guard_code(self, guard):
+        return re.sub(r'IN_STATE\(([\w_]+)\)', r'ctx.in_state_\1()', str(guard))
+
+    def _write_transitions(self, sink):
+        guards, actions = [], []
+        hook = self.hooks.get('transition', '')
+        for row in self.tables.rows:
+            plan = row.plan
+            if plan.guard is not True:
+                guard = "false" if plan.guard is False else self._guard_code(plan.guard)
+                guards.append((row.number, guard))
+            body = []
+            if row.kind != ROW_DECISION:
+                used = referenced_vars(hook, plan.action)
+                if 't_src' in used:
+                    body.append(f"let t_src = {_rust_str(plan.src_str)};")
+                if 't_dst' in used:
+                    body.append(f"let t_dst = {_rust_str(plan.dst_str)};")
+                if hook:
+                    body.extend(trace_hook('transition', hook, "").splitlines())
+            if body or plan.action or (self.trace and row.kind != ROW_DECISION) or self.instrument:
+                body.append("ctx.transition_fired = true;")
+                if self.trace and row.kind != ROW_DECISION:
+                    body.append(trace_call(plan))
+                if self.instrument:
+                    body.append(self.instrument.fire(plan))
+                if plan.action:
+                    body.extend(plan.action.splitlines())
+                actions.append((row.number, "\n".join("            " + line for line in body)))
+        guards = [f"        {' | '.join(map(str, rows))} => {{ {guard} }}" for rows, guard in merge_arms(guards)]
+        actions = [f"        {' | '.join(map(str, rows))} => {{\n{body}\n        }}" for rows, body in merge_arms(actions)]
+        row_state = "let s = ROWS[r as usize].1 as usize;"
+        sink.write(GUARD_FUNC.format(preamble="\n    ".join(filter(None, (row_state, _preamble(*guards)))),
+                                     arms="\n".join(guards)))
+        sink.write(ACTION_FUNC.format(preamble="\n    ".join(filter(None, (row_state, _preamble(*actions)))),
+                                      arms="\n".join(actions)))
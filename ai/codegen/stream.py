@@ -0,0 +1,57 @@
+import re
+import shutil
+import tempfile
+
+SPOOL_MAX_MEMORY = 1 << 20
+
+
+class Spool:
+    """
+    Append-only text section of a generated file. Stays in memory while small
+    and rolls over to a temp file past SPOOL_MAX_MEMORY, so huge models do
+    not hold every function body in RAM. Items are joined with separator,
+    like "separator".join(items) would.
+    """
+    def __init__(self, separator="\n"):
+        self.separator = separator
+        self.count = 0
+        self.file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY, mode='w+')
+
+    def append(self, text):
+        if self.count:
+            self.file.write(self.separator)
+        self.file.write(text)
+        self.count += 1
+
+    def __len__(self):
+        return self.count
+
+    def copy_to(self, sink):
+        self.file.seek(0)
+        shutil.copyfileobj(self.file, sink)
+
+    def close(self):
+        self.file.close()
+
+
+_SLOT = re.compile(r'%[sd%]')
+
+def write_template(sink, template, *parts):
+    """
+    Stream a %-style template (only %s, %d and %%) to sink. Parts may be
+    plain values or Spools, which are copied without being joined in memory.
+    """
+    pos = 0
+    parts = iter(parts)
+    for match in _SLOT.finditer(template):
+        sink.write(template[pos:match.start()])
+        pos = match.end()
+        if match.group() == '%%':
+            sink.write('%')
+            continue
+        part = next(parts)
+        if isinstance(part, Spool):
+            part.copy_to(sink)
+        else:
+            sink.write(str(part))
+    sink.write(template[pos:])
@@ -0,0 +1,147 @@
+"""
+Language-neutral tables for the table-driven runtime (--runtime table).
+
+The model becomes flat arrays indexed by state id (ModelIndex pre-order):
+    parent, kind, slot, initial, history, child ranges, row ranges
+plus transition rows and one shared ops array the rows index into. The
+backends print the arrays and a small interpreter that walks them.
+
+A state's rows are grouped by event: row_range covers the per-tick rows,
+event_range indexes event_rows, one (event, first, last) group per event
+the state listens to.
+
+Runtime state is two arrays of slots per machine:
+    active[slot]  the state currently held by a slot, or NO_STATE
+    hist[slot]    last child started in a history composite, or NO_STATE
+Every OR composite owns one slot for its single active child
+(child_slot[s]) and every orthogonal region owns one for itself; slot[s]
+is the slot a state occupies while it is active.
+"""
+
+KIND_LEAF, KIND_OR, KIND_AND = 0, 1, 2
+ROW_NORMAL, ROW_DECISION, ROW_TERMINATE = 0, 1, 2
+OPS = ('exit_child', 'exit_region', 'exit', 'start', 'entry')
+OP_CODES = {op: code for code, op in enumerate(OPS)}
+
+
+def merge_arms(arms):
+    """
+    (key, code) pairs with the same code merged into (keys, code), in order of
+    first use. The states and rows of a machine's instances (machines.py)
+    carry the same code and share one arm.
+    """
+    merged = {}
+    for key, code in arms:
+        merged.setdefault(code, []).append(key)
+    return [(keys, code) for code, keys in merged.items()]
+
+
+class Row:
+    """
+    One transition. For decisions, first..last are the rows of its branches;
+    otherwise they are the plan's steps in the ops array.
+    """
+    __slots__ = ('number', 'plan', 'state', 'kind', 'first', 'last')
+
+    def __init__(self, number, plan):
+        self.number = number
+        self.plan = plan
+        self.state = plan.source.index
+        if plan.kind == 'decision':
+            self.kind = ROW_DECISION
+        elif plan.terminate:
+            self.kind = ROW_TERMINATE
+        else:
+            self.kind = ROW_NORMAL
+        self.first = self.last = 0
+
+
+class MachineTables:
+    def __init__(self, index, plans):
+        self.index = index
+        self.count = len(index)
+        self.no_state = self.count
+        self.parent, self.kind, self.slot, self.initial, self.history = [], [], [], [], []
+        self.child_slot, self.child_range, self.children = [], [], []
+        self.slots = 0
+        for info in index:
+            self._add_state(info)
+        self.events = plans.events
+        self.row_range, self.rows, self.ops = [], [], []
+        self.event_range, self.event_rows = [], []
+        self._add_rows(plans)
+        below = plans.subtree_events()
+        # Whether dispatch has to descend below a state at all.
+        self.listening = [any(below[child.index] for child in info.children) for info in index]
+
+    @property
+    def state_type_bits(self):
+        # NO_STATE must fit too; slots never outnumber states.
+        return 16 if self.count < 0xFFFF else 32
+
+    def _add_state(self, info):
+        none = self.no_state
+        parent = info.parent
+        self.parent.append(parent.index if parent else none)
+        if info.is_composite:
+            self.kind.append(KIND_AND if info.is_orthogonal else KIND_OR)
+        else:
+            self.kind.append(KIND_LEAF)
+        if parent is None:
+            self.slot.append(none)
+        elif parent.is_orthogonal:
+            self.slot.append(self._new_slot())
+        else:
+            self.slot.append(self.child_slot[parent.index])
+        is_or = info.is_composite and not info.is_orthogonal
+        self.child_slot.append(self._new_slot() if is_or else none)
+        initial = info.data.get('initial') if is_or else None
+        self.initial.append(self.index.get(info.path + (initial,)).index if initial is not None else none)
+        # The root never restores history, whatever the top-level YAML says.
+        self.history.append(bool(is_or and parent is not None and info.data.get('history', False)))
+        start = len(self.children)
+        self.children.extend(child.index for child in info.children)
+        self.child_range.append((start, len(self.children)))
+
+    def _new_slot(self):
+        # Pre-order: a parent's child slot exists before its children are added.
+        self.slots += 1
+        return self.slots - 1
+
+    def _add_rows(self, plans):
+        # Top-level rows are contiguous per state; decision branches are appended
+        # afterwards, each decision's branches as one contiguous block.
+        for info in self.index:
+            start = len(self.rows)
+            for plan in plans.for_event(info.path):
+                self.rows.append(Row(len(self.rows), plan))
+            self.row_range.append((start, len(self.rows)))
+            groups = len(self.event_rows)
+            for code, event in enumerate(self.events):
+                start = len(self.rows)
+                for plan in plans.for_event(info.path, event):
+                    self.rows.append(Row(len(self.rows), plan))
+                if len(self.rows) > start:
+                    self.event_rows.append((code, start, len(self.rows)))
+            self.event_range.append((groups, len(self.event_rows)))
+        # Rows taking the same steps share one range of the ops array.
+        ranges = {}
+        i = 0
+        while i < len(self.rows):
+            row = self.rows[i]
+            if row.kind == ROW_DECISION:
+                row.first = len(self.rows)
+                for branch in row.plan.branches:
+                    self.rows.append(Row(len(self.rows), branch))
+                row.last = len(self.rows)
+            else:
+                key = row.plan.step_key
+                if key not in ranges:
+                    first = len(self.ops)
+                    self.ops.extend((OP_CODES[op], self.index.get(path).index) for op, path in row.plan.steps)
+                    ranges[key] = (first, len(self.ops))
+                row.first, row.last = ranges[key]
+            i += 1
+
+    def state_name(self, info):
+        return info.path[-1]
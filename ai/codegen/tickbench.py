@@ -0,0 +1,337 @@
+"""
+Runtime benchmark: builds a model with a timing driver (like main.rs) and
+measures the generated tick, overall and per kind of transition, and the
+size of the generated context.
+Driven by sm-bench.py --tick.
+"""
+import copy
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+
+from .model import ModelIndex
+from .plan import ModelPlans
+
+# Index 0 is a tick in which no transition fired.
+KINDS = ('idle', 'sibling', 'up', 'down', 'cross_limb', 'fork', 'history', 'termination')
+
+# Per-language bits injected into the model: two context fields and the
+# statement that every transition action is prefixed with.
+PROBES = {
+    'rust': {
+        'context': "pub bench_kind: u8,\npub bench_transitions: u64,\n",
+        'context_init': "bench_kind: 0,\nbench_transitions: 0,\n",
+        'action': "ctx.bench_kind = {kind}; ctx.bench_transitions += 1;",
+        'counter': "sm.ctx.{field} = i as _;",
+        'ticks': "sm.ctx.now = i as _;",
+    },
+    'c': {
+        'context': "unsigned char bench_kind;\nunsigned long long bench_transitions;\n",
+        'context_init': "",
+        'action': "ctx->bench_kind = {kind}; ctx->bench_transitions++;",
+        'counter': "sm->ctx.{field} = i;",
+        'ticks': "sm->ctx.now = (SM_Time)i;",
+    },
+}
+
+RUST_DRIVER = """
+mod statemachine;
+use statemachine::StateMachine;
+use std::time::Instant;
+
+const TICKS: u64 = %d;
+const DT: f64 = %s;
+const KINDS: usize = %d;
+
+#[inline(always)]
+fn feed(sm: &mut StateMachine, i: u64) {
+    %s
+    %s
+}
+
+fn join<T: std::fmt::Display>(values: &[T]) -> String {
+    values.iter().map(|v| v.to_string()).collect::<Vec<_>>().join(",")
+}
+
+fn main() {
+    // 1. Throughput: nothing but the tick in the loop.
+    let mut sm = StateMachine::new();
+    let mut transitions = 0u64;
+    let mut restarts = 0u64;
+    let t0 = Instant::now();
+    for i in 0..TICKS {
+        feed(&mut sm, i);
+        sm.tick();
+        if !sm.is_running() {
+            transitions += sm.ctx.bench_transitions;
+            sm = StateMachine::new();
+            restarts += 1;
+        }
+    }
+    let total_ns = t0.elapsed().as_nanos();
+    transitions += sm.ctx.bench_transitions;
+
+    // 2. Latency: every tick timed and filed under the kind of transition that fired.
+    let mut sm = StateMachine::new();
+    let mut kind_ns = [0u128; KINDS];
+    let mut kind_ticks = [0u64; KINDS];
+    for i in 0..TICKS {
+        feed(&mut sm, i);
+        sm.ctx.bench_kind = 0;
+        let t = Instant::now();
+        sm.tick();
+        let ns = t.elapsed().as_nanos();
+        let kind = sm.ctx.bench_kind as usize;
+        kind_ns[kind] += ns;
+        kind_ticks[kind] += 1;
+        if !sm.is_running() {
+            sm = StateMachine::new();
+        }
+    }
+
+    // 3. What the same clock reads measure around nothing.
+    let probes = TICKS / 10 + 1;
+    let mut empty_ns = 0u128;
+    for _ in 0..probes {
+        let t = Instant::now();
+        empty_ns += std::hint::black_box(t).elapsed().as_nanos();
+    }
+    let timer_ns = (empty_ns as f64) / (probes as f64);
+
+    println!("{{\\"ticks\\":{},\\"total_ns\\":{},\\"transitions\\":{},\\"restarts\\":{},\\"timer_ns\\":{},\\"kind_ns\\":[{}],\\"kind_ticks\\":[{}],\\"context_bytes\\":{}}}",
+             TICKS, total_ns, transitions, restarts, timer_ns, join(&kind_ns), join(&kind_ticks),
+             std::mem::size_of_val(&sm.ctx));
+}
+"""
+
+C_DRIVER = """
+#include "statemachine.h"
+#include <time.h>
+
+#define TICKS %dULL
+#define DT %s
+#define KINDS %d
+
+static unsigned long long now_ns(void) {
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return (unsigned long long)ts.tv_sec * 1000000000ULL + (unsigned long long)ts.tv_nsec;
+}
+
+static inline void feed(StateMachine* sm, unsigned long long i) {
+    %s
+    %s
+}
+
+static void print_array(const char* name, const unsigned long long* values) {
+    printf(",\\"%%s\\":[", name);
+    for (int k = 0; k < KINDS; k++) printf("%%s%%llu", k ? "," : "", values[k]);
+    printf("]");
+}
+
+int main(void) {
+    static StateMachine sm;
+    unsigned long long transitions = 0, restarts = 0;
+
+    // 1. Throughput: nothing but the tick in the loop.
+    sm_init(&sm);
+    unsigned long long t0 = now_ns();
+    for (unsigned long long i = 0; i < TICKS; i++) {
+        feed(&sm, i);
+        sm_tick(&sm);
+        if (!sm_is_running(&sm)) {
+            transitions += sm.ctx.bench_transitions;
+            sm_init(&sm);
+            restarts++;
+        }
+    }
+    unsigned long long total_ns = now_ns() - t0;
+    transitions += sm.ctx.bench_transitions;
+
+    // 2. Latency: every tick timed and filed under the kind of transition that fired.
+    unsigned long long kind_ns[KINDS] = {0}, kind_ticks[KINDS] = {0};
+    sm_init(&sm);
+    for (unsigned long long i = 0; i < TICKS; i++) {
+        feed(&sm, i);
+        sm.ctx.bench_kind = 0;
+        unsigned long long t = now_ns();
+        sm_tick(&sm);
+        unsigned long long ns = now_ns() - t;
+        kind_ns[sm.ctx.bench_kind] += ns;
+        kind_ticks[sm.ctx.bench_kind]++;
+        if (!sm_is_running(&sm)) sm_init(&sm);
+    }
+
+    // 3. What the same clock reads measure around nothing.
+    unsigned long long probes = TICKS / 10 + 1, empty_ns = 0;
+    for (unsigned long long p = 0; p < probes; p++) {
+        unsigned long long t = now_ns();
+        empty_ns += now_ns() - t;
+    }
+    double timer_ns = (double)empty_ns / (double)probes;
+
+    printf("{\\"ticks\\":%%llu,\\"total_ns\\":%%llu,\\"transitions\\":%%llu,\\"restarts\\":%%llu,\\"timer_ns\\":%%f",
+           TICKS, total_ns, transitions, restarts, timer_ns);
+    print_array("kind_ns", kind_ns);
+    print_array("kind_ticks", kind_ticks);
+    printf(",\\"context_bytes\\":%%zu}\\n", sizeof(sm.ctx));
+    return 0;
+}
+"""
+
+COMPILERS = {
+    'rust': lambda: ["rustc", "-O", "-A", "warnings", "main.rs", "-o", "bench"],
+    'c': lambda: [os.environ.get("CC", "cc"), "-O2", "-w", "-I.", "main.c", "statemachine.c", "-o", "bench"],
+}
+
+
+class TickBenchError(Exception):
+    pass
+
+
+def classify(plan, index):
+    """Kind of a (non-decision) transition plan, one of KINDS[1:]."""
+    if plan.terminate:
+        return 'termination'
+    if plan.forks or plan.fork_entries:
+        return 'fork'
+    if plan.cross_limb:
+        return 'cross_limb'
+    for path, op in plan.entries:
+        info = index.get(path)
+        if op == 'entry' and info and info.is_composite and info.data.get('history', False):
+            return 'history'
+    target_depth = plan.target.depth if plan.target else len(plan.target_path) - 1
+    if target_depth < plan.source.depth:
+        return 'up'
+    if target_depth > plan.source.depth:
+        return 'down'
+    return 'sibling'
+
+def instrument(data, lang, ticks=False):
+    """
+    Benchmark copy of a model: hooks off, probe fields added and every
+    transition action prefixed with its kind probe. Returns (data, index, plans, kind counts).
+    """
+    probe = PROBES[lang]
+    data = copy.deepcopy(data)
+    data.pop('hooks', None)
+    data.pop('transition', None)
+    data['context'] = data.get('context', '') + probe['context']
+    data['context_init'] = data.get('context_init', '') + probe['context_init']
+
+    index = ModelIndex(data)
+    plans = ModelPlans(index, data.get('decisions', {}), ticks)
+    counts = dict.fromkeys(KINDS[1:], 0)
+    for plan in plans.all:
+        if plan.kind == 'decision':
+            continue
+        kind = classify(plan, index)
+        counts[kind] += 1
+        marker = probe['action'].format(kind=KINDS.index(kind))
+        plan.action = marker + ("\n" + plan.action if plan.action else "")
+    return data, index, plans, counts
+
+def _driver(lang, ticks, dt, counter, compact=None):
+    # --compact ticks: now counts ticks, one per iteration.
+    if compact == 'ticks':
+        clock = PROBES[lang]['ticks']
+    else:
+        clock = "sm.ctx.now = i as f64 * DT;" if lang == 'rust' else "sm->ctx.now = (double)i * DT;"
+    feed = PROBES[lang]['counter'].format(field=counter) if counter else ""
+    if lang == 'rust':
+        return "main.rs", RUST_DRIVER % (ticks, repr(float(dt)), len(KINDS), clock, feed)
+    return "main.c", C_DRIVER % (ticks, repr(float(dt)), len(KINDS), clock, feed)
+
+def _generate(lang, data, index, plans, workdir, runtime='pointer', compact=None):
+    from .build import generator_class
+
+    options = {'compact': compact} if compact else {}
+    gen = generator_class(lang, runtime)(data, index, plans, **options)
+    if lang == 'rust':
+        code, _ = gen.generate()
+        outputs = {"statemachine.rs": code}
+    else:
+        header, source = gen.generate()
+        outputs = {"statemachine.h": header, "statemachine.c": source}
+    for name, content in outputs.items():
+        with open(os.path.join(workdir, name), 'w') as f:
+            f.write(content)
+
+def _run(cmd, workdir, what):
+    try:
+        proc = subprocess.run(cmd, cwd=workdir, capture_output=True, text=True)
+    except OSError as e:
+        raise TickBenchError(f"{what} failed: {e}")
+    if proc.returncode != 0:
+        raise TickBenchError(f"{what} failed:\n" + "\n".join((proc.stderr or proc.stdout).splitlines()[:20]))
+    return proc.stdout
+
+def tick_bench(data, lang='rust', ticks=1000000, dt=0.001, counter=None, keep=None, runtime='pointer',
+               compact=None):
+    """
+    Compile data for lang with the timing driver and run it. ctx.now advances
+    dt per tick; counter names an integer context field set to the tick number.
+    keep is a directory to leave the generated sources in, runtime the
+    generated code's shape (build.RUNTIMES), compact a --compact layout of
+    the pointer runtime.
+    Raises TickBenchError if the build or the run fails.
+    """
+    if compact and runtime != 'pointer':
+        raise TickBenchError("--compact applies to the pointer runtime.")
+    bench_data, index, plans, counts = instrument(data, lang, compact == 'ticks')
+    workdir = keep or tempfile.mkdtemp(prefix="sm-tick-")
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        _generate(lang, bench_data, index, plans, workdir, runtime, compact)
+        name, driver = _driver(lang, ticks, dt, counter, compact)
+        with open(os.path.join(workdir, name), 'w') as f:
+            f.write(driver)
+        _run(COMPILERS[lang](), workdir, "compile")
+        raw = json.loads(_run([os.path.join(workdir, "bench")], workdir, "run").splitlines()[-1])
+    finally:
+        if keep is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return summarize(raw, counts)
+
+def summarize(raw, counts):
+    seconds = raw['total_ns'] / 1e9
+    kinds = {}
+    for k, name in enumerate(KINDS):
+        n = raw['kind_ticks'][k]
+        if n:
+            kinds[name] = {'ticks': n, 'ns_per_tick': raw['kind_ns'][k] / n - raw['timer_ns']}
+    return {
+        'ticks': raw['ticks'],
+        'ns_per_tick': raw['total_ns'] / raw['ticks'],
+        'transitions': raw['transitions'],
+        'transitions_per_sec': raw['transitions'] / seconds if seconds else 0.0,
+        'restarts': raw['restarts'],
+        'timer_overhead_ns': raw['timer_ns'],
+        'kinds': kinds,
+        'static_kinds': counts,
+        'context_bytes': raw['context_bytes'],
+    }
+
+def format_tick_results(report, baseline=None):
+    def key(e):
+        return e['model'], e['lang'], e.get('runtime', 'pointer'), e.get('compact')
+
+    base = {key(e): e for e in (baseline or {}).get('results', [])}
+    lines = []
+    for entry in report['results']:
+        runtime = entry.get('runtime', 'pointer')
+        variant = ('' if runtime == 'pointer' else '/' + runtime) + (f" compact={entry['compact']}" if entry.get('compact') else '')
+        head = f"{entry['model']} [{entry['lang']}{variant}]"
+        if 'error' in entry:
+            lines.append(f"{head}: ERROR {entry['error']}")
+            continue
+        old = base.get(key(entry))
+        ratio = f"   x{entry['ns_per_tick'] / old['ns_per_tick']:.2f} vs baseline" if old and 'ns_per_tick' in old else ""
+        lines.append(f"{head}: {entry['ns_per_tick']:.1f} ns/tick, {entry['transitions_per_sec']:.0f} transitions/s, "
+                     f"context {entry['context_bytes']} bytes{ratio}")
+        for kind, stats in entry['kinds'].items():
+            lines.append(f"    {kind:12} {stats['ns_per_tick']:10.1f} ns   ({stats['ticks']} ticks)")
+    return "\n".join(lines)
@@ -0,0 +1,144 @@
+"""
+Binary transition trace (model key 'trace_buffer: N').
+
+The generated context keeps the last N fired transitions in a ring buffer of
+fixed-size records; nothing is formatted or allocated while recording.
+write_trace (Rust) / sm_write_trace (C) dump it as
+
+    header   magic 'SMTR', format u32, model id u32, capacity u32, total u64
+    records  tick u64, now f64, source u32, target u32, transition u32
+
+oldest record first, in the byte order of the machine that wrote it (the
+format field tells the reader which). total counts every transition ever
+recorded, so total - len(records) were overwritten.
+
+source and target are ModelIndex state ids, target is NONE for a
+termination; transition is the TransitionPlan number. A decision records the
+branch that fired. The model id is a CRC of the ids and transitions, so a
+dump is only decoded against the model that produced it.
+"""
+import struct
+import zlib
+
+from .common import state_path
+
+MAGIC = b'SMTR'
+FORMAT = 1
+NONE = 0xFFFFFFFF
+HEADER = 'IIIQ'
+RECORD = 'QdIII'
+
+
+class TraceError(Exception):
+    pass
+
+
+def model_id(index, plans):
+    """CRC-32 of everything a record refers to: state paths and transition endpoints."""
+    lines = [f"s {info.index} {'/'.join(info.path)}" for info in index]
+    lines += [f"t {plan.number} {plan.source_id} {_target(plan)}" for plan in plans.all if plan.kind != 'decision']
+    return zlib.crc32("\n".join(lines).encode('utf-8'))
+
+def _target(plan):
+    return NONE if plan.terminate else plan.target_id
+
+def record_args(plan):
+    """(source, target, transition) a fired plan records."""
+    return plan.source_id, _target(plan), plan.number
+
+
+class Trace:
+    """A decoded dump: header fields and the records, oldest first."""
+    def __init__(self, model, capacity, total, records):
+        self.model = model
+        self.capacity = capacity
+        self.total = total
+        self.records = records
+
+    @property
+    def dropped(self):
+        return self.total - len(self.records)
+
+
+def read_trace(raw):
+    if raw[:4] != MAGIC:
+        raise TraceError("not a state machine trace (bad magic)")
+    for order in '<>':
+        if struct.unpack_from(order + 'I', raw, 4)[0] == FORMAT:
+            break
+    else:
+        raise TraceError("unsupported trace format")
+    header = struct.Struct(order + '4s' + HEADER)
+    record = struct.Struct(order + RECORD)
+    _, _, model, capacity, total = header.unpack_from(raw)
+    body = raw[header.size:]
+    count = min(total, capacity)
+    if len(body) < count * record.size:
+        raise TraceError(f"truncated trace: {count} records announced, {len(body) // record.size} present")
+    return Trace(model, capacity, total, [record.unpack_from(body, i * record.size) for i in range(count)])
+
+
+class TraceDecoder:
+    """Names for the ids in records of one model."""
+    def __init__(self, index, plans):
+        self.index = index
+        self.model = model_id(index, plans)
+        self.paths = [state_path(info) for info in index]
+        self.plans = {plan.number: plan for plan in plans.all}
+
+    def check(self, trace):
+        if trace.model != self.model:
+            raise TraceError(f"trace was written by another model (id {trace.model:08x}, expected {self.model:08x})")
+
+    def state(self, state_id):
+        if state_id == NONE:
+            return "Termination"
+        return self.paths[state_id] if state_id < len(self.paths) else f"<state {state_id}>"
+
+    def transition(self, number):
+        plan = self.plans.get(number)
+        if plan is None:
+            return f"#{number}"
+        label = f"#{number}"
+        if plan.event:
+            label += f" on {plan.event}"
+        if plan.guard is not True:
+            label += f" [{plan.guard}]"
+        return label
+
+    def format_records(self, trace):
+        lines = [f"{'TICK':>10} {'NOW':>12}  TRANSITION"]
+        for tick, now, source, target, number in trace.records:
+            lines.append(f"{tick:>10} {now:>12.6f}  {self.state(source)} -> {self.state(target)}  {self.transition(number)}")
+        return "\n".join(lines + [self._summary(trace)])
+
+    def format_timeline(self, trace):
+        """State changes in time order, with how long the source was held when its entry is in the trace."""
+        lines = [f"{'TICK':>10} {'NOW':>12} {'HELD':>12}  STATE CHANGE"]
+        entered = {}
+        for tick, now, source, target, number in trace.records:
+            held = f"{now - entered[source]:.6f}" if source in entered else "?"
+            lines.append(f"{tick:>10} {now:>12.6f} {held:>12}  {self.state(source)} => {self.state(target)}")
+            entered[target] = now
+        return "\n".join(lines + [self._summary(trace)])
+
+    def format_stats(self, trace):
+        """Fire counts per transition, most frequent first, and the span the records cover."""
+        counts = {}
+        for record in trace.records:
+            key = (record[4], record[2], record[3])
+            counts[key] = counts.get(key, 0) + 1
+        lines = [f"{'COUNT':>8} {'SHARE':>7}  TRANSITION"]
+        total = len(trace.records) or 1
+        for (number, source, target), count in sorted(counts.items(), key=lambda item: (-item[1], item[0])):
+            lines.append(f"{count:>8} {100.0 * count / total:>6.1f}%  "
+                         f"{self.state(source)} -> {self.state(target)}  {self.transition(number)}")
+        if trace.records:
+            first, last = trace.records[0], trace.records[-1]
+            ticks = last[0] - first[0]
+            seconds = last[1] - first[1]
+            lines.append(f"{len(trace.records)} transitions over {ticks} ticks, {seconds:.6f} s")
+        return "\n".join(lines + [self._summary(trace)])
+
+    def _summary(self, trace):
+        return f"{len(trace.records)} of {trace.total} recorded transitions kept ({trace.dropped} overwritten)"
@@ -0,0 +1,77 @@
+#!/bin/bash
+# Builds each regression model with every runtime and option it covers, runs
+# it with main.rs and compares the output with <model>.expect.
+#
+#   ./regress.sh            # all cases
+#   ./regress.sh events     # cases of models whose name contains 'events'
+
+PYTHON=${PYTHON:-python3}
+filter=$1
+
+cases=(
+  "transition-verification"
+  "transition-verification --runtime table"
+  "transition-verification --runtime flat"
+  "transition-verification --compact layout"
+  "events"
+  "events --runtime table"
+  "events --runtime flat"
+  "events --compact layout"
+  "run-to-completion"
+  "run-to-completion --runtime table"
+  "run-to-completion --runtime flat"
+  "run-to-completion --compact layout"
+  "trace-buffer"
+  "trace-buffer --runtime table"
+  "trace-buffer --runtime flat"
+  "trace-buffer --compact layout"
+  "machines"
+  "machines --runtime table"
+  "machines --runtime flat"
+  "machines --compact layout"
+  "decisions"
+  "decisions --runtime table"
+  "decisions --runtime flat"
+  "decisions --compact layout"
+  "instrument --instrument counts"
+  "instrument --instrument timing"
+  "instrument --instrument counts --runtime table"
+  "instrument --instrument counts --runtime flat"
+  "instrument --instrument counts --compact layout"
+)
+
+here=$(cd "$(dirname "$0")" && pwd)
+work=$(mktemp -d)
+trap 'rm -rf "$work"' EXIT
+
+failed=0
+for case in "${cases[@]}"; do
+  set -- $case
+  model=$1
+  shift
+  [[ "$model" != *"$filter"* ]] && continue
+  dir="$work/$(echo "$case" | tr ' ' '_')"
+  mkdir -p "$dir"
+  cp "$here/main.rs" "$dir/"
+  if ! $PYTHON "$here/sm-builder.py" "$here/$model.yaml" --lang rust --out-dir "$dir" "$@" >"$dir/build.log" 2>&1; then
+    echo "[FAIL] $case: build"
+    cat "$dir/build.log"
+    failed=1
+    continue
+  fi
+  if ! (cd "$dir" && rustc -O main.rs -o sm 2>"$dir/rustc.log"); then
+    echo "[FAIL] $case: rustc"
+    cat "$dir/rustc.log"
+    failed=1
+    continue
+  fi
+  (cd "$dir" && timeout 10 ./sm >output)
+  if diff -u "$here/$model.expect" "$dir/output" >"$dir/diff"; then
+    echo "[OK]   $case"
+  else
+    echo "[FAIL] $case"
+    cat "$dir/diff"
+    failed=1
+  fi
+done
+exit $failed
@@ -0,0 +1,83 @@
+import sys
+import argparse
+import os
+
+# Ensure we can import from local directory
+sys.path.append(os.getcwd())
+
+from codegen.bench import (FAMILIES, make_model, run_benchmarks, format_results, save_results, load_results, environment_info,
+                           run_stress, format_stress)
+from codegen.build import LANGUAGES, RUNTIMES, COMPACT_MODES, BuildError, load_model, validate_model
+from codegen.tickbench import TickBenchError, tick_bench, format_tick_results
+
+def run_tick(args, langs):
+    results = []
+    for name in args.tick:
+        for lang in langs:
+            for runtime in args.runtime or ['pointer']:
+                results.append(_tick_entry(args, name, lang, runtime))
+    return {'meta': environment_info(), 'results': results}
+
+def _tick_entry(args, name, lang, runtime):
+    entry = {'model': name, 'lang': lang, 'runtime': runtime}
+    if args.compact:
+        entry['compact'] = args.compact
+    print(f"{name} [{lang}/{runtime}] ...")
+    try:
+        if name in FAMILIES:
+            data, params = make_model(name, args.size, lang)
+            entry.update(size=args.size, params=params)
+            counter = args.counter or 'step'
+        else:
+            data = load_model(name)
+            counter = args.counter
+        validate_model(data, log=lambda msg: None)
+        keep = args.keep and f"{args.keep}/{os.path.basename(name)}.{lang}.{runtime}"
+        entry.update(tick_bench(data, lang, args.ticks, args.dt, counter, keep, runtime, args.compact))
+    except (BuildError, TickBenchError, OSError) as e:
+        entry['error'] = str(e)
+    return entry
+
+def main():
+    parser = argparse.ArgumentParser(description="State Machine Generator Benchmark")
+    parser.add_argument("--family", choices=sorted(FAMILIES), action='append', help="Model family (repeatable, default: all)")
+    parser.add_argument("--size", choices=("small", "medium", "large"), default="small", help="Model size preset")
+    parser.add_argument("--lang", choices=LANGUAGES, action='append', help="Backends to time (repeatable, default: all)")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per phase; min and median are reported")
+    parser.add_argument("--output", help="Save results as JSON")
+    parser.add_argument("--compare", metavar="JSON", help="Earlier results to compare against")
+    parser.add_argument("--profile", type=int, default=0, metavar="N",
+                        help="Add one profiled build per model and report its N slowest states")
+    parser.add_argument("--stress", action='store_true',
+                        help="Instead of timing, build deep_chain and wide_flat past the recursion limit with every runtime")
+    tick = parser.add_argument_group("runtime benchmark")
+    tick.add_argument("--tick", metavar="MODEL", action='append',
+                      help="Time the generated tick of a YAML file or synthetic family (repeatable)")
+    tick.add_argument("--ticks", type=int, default=1000000, help="Ticks per measurement")
+    tick.add_argument("--dt", type=float, default=0.001, help="Seconds ctx.now advances per tick")
+    tick.add_argument("--counter", help="Integer context field set to the tick number (families: step)")
+    tick.add_argument("--runtime", choices=RUNTIMES, action='append',
+                      help="Generated code shape to time (repeatable, default: pointer)")
+    tick.add_argument("--compact", choices=COMPACT_MODES,
+                      help="Time the pointer runtime with this --compact layout (ticks: now advances 1 per tick)")
+    tick.add_argument("--keep", metavar="DIR", help="Keep the generated driver and sources in DIR")
+    args = parser.parse_args()
+    langs = args.lang or LANGUAGES
+
+    baseline = load_results(args.compare) if args.compare else None
+    if args.stress:
+        report = run_stress(langs)
+        print(format_stress(report))
+    elif args.tick:
+        report = run_tick(args, langs)
+        print(format_tick_results(report, baseline))
+    else:
+        report = run_benchmarks(args.family or list(FAMILIES), args.size, langs, args.repeat, profile_top=args.profile)
+        print(format_results(report, baseline))
+    if args.output:
+        save_results(report, args.output)
+        print(f" -> {args.output} created.")
+    sys.exit(0 if all('error' not in r for r in report['results']) else 1)
+
+if __name__ == "__main__":
+    main()
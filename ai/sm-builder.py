@@ -1,141 +1,75 @@
-import yaml
 import sys
 import argparse
+import contextlib
 import os
+import time
 
 # Ensure we can import from local directory
 sys.path.append(os.getcwd())
 
-# Import the new parser helper
-from codegen.common import generate_dot, resolve_target_path, flatten_name, parse_fork_target, resolve_state_data
-from codegen.rust_lang import RustGenerator
-
-class BuildError(Exception):
-    pass
-
-def get_state_data(root_data, path_parts):
-    current = {'states': root_data.get('states', {}), 'initial': root_data.get('initial')}
-    if path_parts == ['root']:
-        return root_data
-    start_idx = 1 if (path_parts and path_parts[0] == 'root') else 0
-    for part in path_parts[start_idx:]:
-        if 'states' not in current or part not in current['states']:
-            return None
-        current = current['states'][part]
-    return current
-
-def validate_model(data):
-    print("Validating model...")
-    errors = []
-    
-    def check_state(name_path, state_data):
-        display_name = "/" + "/".join(name_path[1:])
-        
-        if 'states' in state_data:
-            # CHANGED: Check 'orthogonal' instead of 'parallel'
-            if 'initial' not in state_data and not state_data.get('orthogonal', False):
-                errors.append(f"State '{display_name}' is composite but missing 'initial' property.")
-            elif 'initial' in state_data:
-                init = state_data['initial']
-                if init not in state_data['states']:
-                    errors.append(f"State '{display_name}' defines initial='{init}', but that child does not exist.")
-
-        transitions = state_data.get('transitions', [])
-        for i, t in enumerate(transitions):
-            if 'to' not in t:
-                errors.append(f"State '{display_name}', transition #{i+1}: Missing 'to'.")
-                continue
-            
-            raw_target = t['to']
-            
-            if raw_target is None or raw_target == "null":
-                continue
-
-            if raw_target in data.get('decisions', {}):
-                continue
-
-            base_target, forks = parse_fork_target(raw_target)
-            
-            target_path = resolve_target_path(name_path, base_target)
-            target_obj = get_state_data(data, target_path)
-            
-            if target_obj is None:
-                errors.append(f"State '{display_name}', transition #{i+1}: Target '{base_target}' (resolved: {'/'.join(target_path)}) does not exist.")
-                continue 
-
-            if forks:
-                if 'states' not in target_obj:
-                    errors.append(f"State '{display_name}': Fork target '{base_target}' is not a composite state.")
-                else:
-                    for fork in forks:
-                        fork_parts = fork.split('/')
-                        fork_abs_path = target_path + fork_parts
-                        fork_obj = get_state_data(data, fork_abs_path)
-                        if fork_obj is None:
-                            errors.append(f"State '{display_name}': Fork branch '{fork}' does not exist inside '{base_target}'.")
-
-        if 'states' in state_data:
-            for child_name, child_data in state_data['states'].items():
-                check_state(name_path + [child_name], child_data)
-
-    if 'initial' not in data:
-        errors.append("Root model missing 'initial' state.")
-    else:
-        if data['initial'] not in data['states']:
-             errors.append(f"Root initial state '{data['initial']}' does not exist.")
-    
-    check_state(['root'], data)
-
-    if errors:
-        print("\n!!! VALIDATION ERRORS !!!")
-        for e in errors:
-            print(f"- {e}")
-        print("-------------------------")
-        sys.exit(1)
-    print("Model OK.")
+from codegen.build import BuildError, LANGUAGES, RUNTIMES, build_model, run_batch, expand_job_template, format_batch_report
+from codegen.compiled import COMPILED_SUFFIX
+from codegen.instrument import MODES as INSTRUMENT_MODES
+from codegen.layout import MODES as COMPACT_MODES
+from codegen.profiling import BuildProfile
 
 def main():
     parser = argparse.ArgumentParser(description="State Machine Builder")
-    parser.add_argument("file", help="Input YAML file")
-    parser.add_argument("--lang", choices=['c', 'rust'], default='rust', help="Output language")
+    parser.add_argument("files", nargs='+', metavar="file", help="Input YAML file(s)")
+    parser.add_argument("--lang", choices=LANGUAGES, action='append', help="Output language (repeatable, default: rust)")
+    parser.add_argument("--runtime", choices=RUNTIMES, default="pointer",
+                        help="Generated code: per-state functions (pointer), tables plus an interpreter (table) "
+                             "or one match arm per reachable configuration (flat, Rust only)")
+    parser.add_argument("--instrument", nargs='?', const='counts', choices=INSTRUMENT_MODES,
+                        help="Count entries, time in state and transition fires (counts, the default), "
+                             "plus cycle histograms of user entry/do/exit code (timing)")
+    parser.add_argument("--compact", nargs='?', const='layout', choices=COMPACT_MODES,
+                        help="Pointer runtime: keep active children as small ids and timers only for states that "
+                             "read time (layout, the default); with ticks also make time a u32 tick count")
+    parser.add_argument("--heatmap", metavar="PROFILE",
+                        help="Shade the DOT output with a profile exported by an --instrument build")
+    parser.add_argument("--compiled", action="store_true",
+                        help=f"Reuse the validated model from <file>{COMPILED_SUFFIX} while the YAML is unchanged (written if missing)")
+    parser.add_argument("--batch", action="store_true", help="Build every file in a process pool and report per-job status")
+    parser.add_argument("--out-dir", default=".", help="Output directory; '{stem}' expands to the YAML file name (batch: default '{stem}')")
+    parser.add_argument("--prefix", default="statemachine", help="Output file name prefix; '{stem}' expands as for --out-dir")
+    parser.add_argument("--jobs", type=int, default=None, help="Batch worker processes (default: CPU count)")
+    parser.add_argument("--profile", type=int, nargs='?', const=10, metavar="N",
+                        help="Report time, allocations and peak memory per phase and the N slowest states (default N: 10)")
+    parser.add_argument("--profile-time-only", action="store_true",
+                        help="With --profile: skip allocation tracing, which slows the build and the state timings down")
+    parser.add_argument("--cprofile", metavar="FILE", help="With --profile: dump cProfile stats to FILE")
     args = parser.parse_args()
-
-    if not os.path.exists(args.file):
-        sys.exit(f"Error: File '{args.file}' not found.")
-
-    try:
-        with open(args.file, 'r') as f:
-            data = yaml.safe_load(f)
-    except yaml.YAMLError as e:
-        sys.exit(f"YAML Syntax Error: {e}")
-
-    validate_model(data)
-
-    decisions = data.get('decisions', {})
+    langs = args.lang or ['rust']
+
+    if args.batch:
+        out_dir = args.out_dir if args.out_dir != "." else "{stem}"
+        jobs = [{'file': f, 'langs': langs, 'compiled': args.compiled,
+                 'runtime': args.runtime,
+                 'instrument': args.instrument, 'heatmap': args.heatmap, 'compact': args.compact,
+                 'out_dir': expand_job_template(out_dir, f), 'prefix': expand_job_template(args.prefix, f)}
+                for f in args.files]
+        t0 = time.perf_counter()
+        results = run_batch(jobs, args.jobs)
+        print(format_batch_report(results, time.perf_counter() - t0))
+        sys.exit(0 if all(r['status'] == 'ok' for r in results) else 1)
+
+    if len(args.files) > 1:
+        sys.exit("Error: several input files need --batch.")
+    path = args.files[0]
+    profile = None
+    if args.profile is not None:
+        profile = BuildProfile(args.profile, not args.profile_time_only, args.cprofile)
 
     try:
-        print(f"Generating Graphviz DOT...")
-        dot_content = generate_dot(data, decisions)
-        with open("statemachine.dot", "w") as f:
-            f.write(dot_content)
-        print(" -> statemachine.dot created.")
-
-        if args.lang == 'c':
-            from codegen.c_lang import CGenerator
-            print("Generating C code...")
-            gen = CGenerator(data)
-            header, source = gen.generate()
-            with open("statemachine.h", "w") as f: f.write(header)
-            with open("statemachine.c", "w") as f: f.write(source)
-            print(" -> statemachine.c / .h created.")
-            
-        elif args.lang == 'rust':
-            print("Generating Rust code...")
-            gen = RustGenerator(data)
-            source, _ = gen.generate()
-            with open("statemachine.rs", "w") as f: f.write(source)
-            print(" -> statemachine.rs created.")
-            
+        with profile or contextlib.nullcontext():
+            build_model(path, langs, expand_job_template(args.out_dir, path), expand_job_template(args.prefix, path),
+                        profile=profile, compiled=args.compiled, runtime=args.runtime,
+                        instrument=args.instrument, heatmap=args.heatmap, compact=args.compact)
+        if profile:
+            print(profile.format())
+    except BuildError as e:
+        sys.exit(f"Error: {e}")
     except Exception as e:
         print(f"\nCRITICAL ERROR during generation: {e}")
         import traceback
@@ -0,0 +1,43 @@
+import sys
+import argparse
+import os
+
+# Ensure we can import from local directory
+sys.path.append(os.getcwd())
+
+from codegen.build import BuildError, load_model, validate_model
+from codegen.model import ModelIndex
+from codegen.plan import ModelPlans
+from codegen.trace import TraceDecoder, TraceError, read_trace
+
+def main():
+    parser = argparse.ArgumentParser(description="Decode a transition trace dumped by write_trace / sm_write_trace")
+    parser.add_argument("model", help="YAML file the machine was generated from")
+    parser.add_argument("trace", help="Dumped trace buffer")
+    view = parser.add_mutually_exclusive_group()
+    view.add_argument("--timeline", action="store_true", help="State changes with how long each source state was held")
+    view.add_argument("--stats", action="store_true", help="How often each transition fired")
+    parser.add_argument("--any-model", action="store_true", help="Decode even if the trace's model id does not match")
+    args = parser.parse_args()
+
+    try:
+        data = load_model(args.model)
+        index = ModelIndex(data)
+        validate_model(data, index, log=lambda msg: None)
+        decoder = TraceDecoder(index, ModelPlans(index, data.get('decisions', {})))
+        with open(args.trace, 'rb') as f:
+            trace = read_trace(f.read())
+        if not args.any_model:
+            decoder.check(trace)
+    except (BuildError, TraceError, OSError) as e:
+        sys.exit(f"Error: {e}")
+
+    if args.timeline:
+        print(decoder.format_timeline(trace))
+    elif args.stats:
+        print(decoder.format_stats(trace))
+    else:
+        print(decoder.format_records(trace))
+
+if __name__ == "__main__":
+    main()